@@ -0,0 +1,113 @@
+from datetime import datetime
+
+from fastapi import APIRouter, Depends
+from sqlmodel import Session
+
+from auth.auth import get_user_dep
+from core.cache import cached_response_dep
+from core.session import get_session
+from core.snapshot import load_snapshot, EventKind, EventFlag
+from crud.statements import activity_filters, select_activity_buckets, select_hour_of_week, likes_rows, matches_rows
+from models.models import ActivityInterval, ActivityBucket, HingeActivity, HingeActivityHourOfWeek
+
+router = APIRouter()
+
+HOURS_PER_WEEK = 7 * 24
+
+
+@router.get("/activity", response_model=HingeActivity)
+async def read_activity(
+        user_data: get_user_dep,
+        cache: cached_response_dep,
+        interval: ActivityInterval = ActivityInterval.WEEK,
+        like_type: int | None = None,
+        match_type: int | None = None,
+        start_date: datetime | None = None,
+        end_date: datetime | None = None,
+        session: Session = Depends(get_session)
+):
+    """
+    Likes and matches bucketed over time, for drawing activity charts.
+
+    Answered from the user's event snapshot when there is one. Otherwise all
+    grouping is done by Postgres, so only one row per bucket comes back
+    regardless of how many likes and matches the user has.
+
+    Args:
+        interval: Bucket likes and matches by day, week or month.
+        like_type: Only count likes of this content type. 1 photo, 2 prompt, 3 video.
+        match_type: Only count matches of this type. 1 I liked them, 2 they liked me.
+        start_date: Only count events on or after this date.
+        end_date: Only count events on or before this date.
+
+    Returns:
+        HingeActivity: The bucketed counts, plus counts per hour of the week
+        where index 0 is Sunday 00:00.
+    """
+    if (cached := cache.hit()) is not None:
+        return cached
+
+    user_id = user_data.get("email")
+
+    snapshot = load_snapshot(user_id)
+    if snapshot is not None:
+        return cache.respond(
+            read_activity_from_snapshot(snapshot, interval, like_type, match_type, start_date, end_date)
+        )
+
+    likes = likes_rows().c
+    matches = matches_rows().c
+    likes_filters = activity_filters(likes, user_id, like_type, start_date, end_date)
+    matches_filters = activity_filters(matches, user_id, match_type, start_date, end_date)
+
+    def buckets(columns, filters):
+        rows = session.exec(select_activity_buckets(columns, interval, filters)).all()
+        return [ActivityBucket(bucket=bucket, count=count) for bucket, count in rows]
+
+    def hour_of_week(columns, filters):
+        counts = [0] * HOURS_PER_WEEK
+        for hour, count in session.exec(select_hour_of_week(columns, filters)).all():
+            counts[int(hour)] = count
+        return counts
+
+    return cache.respond(HingeActivity(
+        interval=interval,
+        likes=buckets(likes, likes_filters),
+        matches=buckets(matches, matches_filters),
+        hour_of_week=HingeActivityHourOfWeek(
+            description="Likes and matches per hour of the week, starting Sunday 00:00",
+            likes=hour_of_week(likes, likes_filters),
+            matches=hour_of_week(matches, matches_filters)
+        )
+    ))
+
+
+def read_activity_from_snapshot(snapshot, interval: ActivityInterval, like_type: int | None, match_type: int | None,
+                                start_date: datetime | None, end_date: datetime | None):
+    in_range = snapshot.between(start_date, end_date)
+
+    likes = in_range & snapshot.kind_mask(EventKind.LIKE)
+    if like_type is not None:
+        likes &= snapshot.like_types == like_type
+
+    matches = in_range & snapshot.kind_mask(EventKind.MATCH)
+    if match_type == 1:
+        matches &= snapshot.has_flag(EventFlag.YOU_LIKED)
+    elif match_type == 2:
+        matches &= ~snapshot.has_flag(EventFlag.YOU_LIKED)
+    elif match_type is not None:
+        matches[:] = False
+
+    def buckets(mask):
+        return [ActivityBucket(bucket=bucket, count=count) for bucket, count in snapshot.buckets(mask, interval.value)]
+
+    return HingeActivity(
+        interval=interval,
+        likes=buckets(likes),
+        matches=buckets(matches),
+        hour_of_week=HingeActivityHourOfWeek(
+            description="Likes and matches per hour of the week, starting Sunday 00:00",
+            likes=snapshot.hour_of_week(likes),
+            matches=snapshot.hour_of_week(matches)
+        )
+    )
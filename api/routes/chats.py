@@ -0,0 +1,110 @@
+import base64
+import binascii
+import statistics
+from datetime import datetime
+from typing import Optional, Tuple
+
+from fastapi import APIRouter, HTTPException, Depends, Query
+from sqlalchemy import tuple_
+from sqlmodel import Session, select
+
+from auth.auth import get_user_dep
+from core.cache import cached_response_dep
+from core.session import get_session
+from models.models import (Chat, ChatMessage, ChatPage, ConversationStats, HingeChatStats, HingeChatStatsSummary,
+                           Person)
+
+router = APIRouter()
+
+
+def encode_cursor(message: Chat) -> str:
+    position = f"{message.timestamp.isoformat()}|{message.position}"
+    return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        timestamp, position = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+        return datetime.fromisoformat(timestamp), int(position)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@router.get("/chats/stats", response_model=HingeChatStats)
+async def read_chat_stats(user_data: get_user_dep, cache: cached_response_dep,
+                          session: Session = Depends(get_session)):
+    """
+    Conversation metrics for every match, plus a summary across all of them.
+
+    Durations are in seconds. The reply gaps are between your consecutive
+    messages, as Hinge exports only include the messages you sent.
+    """
+    if (cached := cache.hit()) is not None:
+        return cached
+
+    statement = (select(ConversationStats)
+                 .where(ConversationStats.user_id == user_data.get("email"))
+                 .order_by(ConversationStats.match_timestamp))
+    conversations = session.exec(statement).all()
+
+    if not conversations:
+        raise HTTPException(status_code=404, detail="Chat stats not found for that user")
+
+    def median(values):
+        values = [value for value in values if value is not None]
+        return statistics.median(values) if values else None
+
+    ghosted_count = sum(c.ghosted for c in conversations)
+
+    summary = HingeChatStatsSummary(
+        conversation_count=len(conversations),
+        message_count=sum(c.message_count for c in conversations),
+        ghosted_count=ghosted_count,
+        ghosted_percentage=round(ghosted_count / len(conversations) * 100, 2),
+        median_reply_gap=median(c.median_reply_gap for c in conversations),
+        median_time_to_first_message=median(c.time_to_first_message for c in conversations)
+    )
+
+    return cache.respond(HingeChatStats(summary=summary, conversations=conversations))
+
+
+@router.get("/persons/{person_id}/chats", response_model=ChatPage)
+async def read_person_chats(person_id: int, user_data: get_user_dep, cache: cached_response_dep,
+                            cursor: Optional[str] = None, limit: int = Query(50, ge=1, le=500),
+                            session: Session = Depends(get_session)):
+    """
+    A page of the conversation with a person, oldest message first.
+
+    Args:
+        person_id: The person the conversation was with.
+        cursor: The `next_cursor` of the previous page, to carry on from it.
+        limit: The most messages to return.
+    """
+    if (cached := cache.hit()) is not None:
+        return cached
+
+    user_id = user_data.get("email")
+
+    # Keyset pagination, so every page is a single range of the Chat primary key
+    statement = (select(Chat)
+                 .where(Chat.user_id == user_id, Chat.person_id == person_id)
+                 .order_by(Chat.timestamp, Chat.position)
+                 .limit(limit + 1))
+    if cursor is not None:
+        statement = statement.where(tuple_(Chat.timestamp, Chat.position) > decode_cursor(cursor))
+
+    messages = session.exec(statement).all()
+
+    if not messages and cursor is None:
+        person = session.get(Person, person_id)
+        if person is None or person.user_id != user_id:
+            raise HTTPException(status_code=404, detail="Person not found for that user")
+
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+
+    return cache.respond(ChatPage(
+        person_id=person_id,
+        messages=[ChatMessage(timestamp=message.timestamp, body=message.body) for message in messages],
+        next_cursor=encode_cursor(messages[-1]) if has_more else None
+    ))
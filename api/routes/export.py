@@ -0,0 +1,41 @@
+from datetime import datetime
+
+from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi.responses import StreamingResponse
+from sqlmodel import Session, select
+
+from auth.auth import get_user_dep
+from core.session import get_session
+from models.models import ExportFormat, UserMetaData
+from services.export import iter_export_zip
+
+router = APIRouter()
+
+
+@router.get("/export")
+async def export_user_data(user_data: get_user_dep,
+                           export_format: ExportFormat = Query(ExportFormat.CSV, alias="format"),
+                           session: Session = Depends(get_session)):
+    """
+    Download everything held for the current user as a ZIP, with one file
+    per table: user_metadata, matches, likes, persons, person_media, chats
+    and conversation_stats.
+
+    The archive is streamed while it's being built, so its size isn't known
+    up front and there is no Content-Length.
+
+    Args:
+        export_format: The "format" query parameter, "csv" or "ndjson".
+    """
+    user_id = user_data.get("email")
+
+    if session.exec(select(UserMetaData).where(UserMetaData.user_id == user_id)).first() is None:
+        raise HTTPException(status_code=404, detail="No data found for that user")
+
+    file_name = f"hinge-export-{datetime.now():%Y%m%d}-{export_format.value}.zip"
+
+    return StreamingResponse(
+        iter_export_zip(user_id, export_format),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{file_name}"'}
+    )
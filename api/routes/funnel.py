@@ -0,0 +1,79 @@
+from fastapi import APIRouter, HTTPException, Depends
+from sqlmodel import Session
+
+from auth.auth import get_user_dep
+from core.cache import cached_response_dep
+from core.session import get_session
+from crud.statements import FUNNEL_PERCENTILES, TIME_TO_MATCH_BUCKETS
+from models.models import HingeFunnel, HingeFunnelBreakdown, HingeFunnelStage, HingeTimeToMatch, HingeTimeToMatchBucket
+from services.funnel import count_funnel
+
+router = APIRouter()
+
+STAGES = ("liked", "matched", "chatted", "met")
+
+
+def _percentage(count: int, total: int) -> float | None:
+    return round(count / total * 100, 2) if total else None
+
+
+@router.get("/funnel", response_model=HingeFunnel)
+async def read_funnel(user_data: get_user_dep, cache: cached_response_dep, session: Session = Depends(get_session)):
+    """
+    How your likes convert into matches, conversations and dates, overall
+    and for each like type, with how long matches took to come.
+
+    On Postgres every count and percentile is worked out in two grouped
+    queries over the user's persons, so only one row per like type comes
+    back however many likes the user has. Other databases only group the
+    counts, and the times to match are worked out in-process.
+
+    Returns:
+        HingeFunnel: The funnel stages of every like, then of each like type.
+        1 photo, 2 prompt, 3 video and 0 a like with only a comment. Times to
+        match are in seconds.
+    """
+    if (cached := cache.hit()) is not None:
+        return cached
+
+    rows, times_to_match = count_funnel(user_data.get("email"), session)
+
+    # The row of every like type together is there even without any likes
+    if not any(row.liked or row.matched for row in rows):
+        raise HTTPException(status_code=404, detail="Likes not found for that user")
+
+    def time_to_match(like_type):
+        times = times_to_match.get(like_type)
+        if times is None or times.percentiles is None:
+            return HingeTimeToMatch(match_count=0)
+
+        return HingeTimeToMatch(
+            match_count=sum(times.bucket_counts),
+            percentiles=dict(zip((f"p{round(fraction * 100)}" for fraction in FUNNEL_PERCENTILES), times.percentiles)),
+            buckets=[
+                HingeTimeToMatchBucket(up_to=up_to, count=count)
+                for up_to, count in zip(TIME_TO_MATCH_BUCKETS + (None,), times.bucket_counts)
+            ]
+        )
+
+    def breakdown(row):
+        counts = [getattr(row, stage) for stage in STAGES]
+        stages = [
+            HingeFunnelStage(
+                stage=stage,
+                count=count,
+                percentage_of_previous=_percentage(count, counts[index - 1]) if index else None,
+                percentage_of_likes=_percentage(count, counts[0]) if index else None
+            )
+            for index, (stage, count) in enumerate(zip(STAGES, counts))
+        ]
+
+        return HingeFunnelBreakdown(like_type=row.like_type, stages=stages, time_to_match=time_to_match(row.like_type))
+
+    breakdowns = [breakdown(row) for row in rows]
+
+    return cache.respond(HingeFunnel(
+        description="Of the likes you sent, how many matched, then chatted, then met",
+        overall=next(b for b in breakdowns if b.like_type is None),
+        like_types=sorted((b for b in breakdowns if b.like_type is not None), key=lambda b: b.like_type)
+    ))
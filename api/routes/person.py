@@ -3,54 +3,99 @@ import base64
 import io
 import math
 
-import httpx
-from PIL import Image
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query
 from fastapi.responses import StreamingResponse
-from sqlmodel import Session, select, desc
+from sqlalchemy.orm import selectinload
+from sqlmodel import Session, select, desc, func, or_
 
 from auth.auth import get_user_dep
+from core.cache import cached_response_dep
 from core.session import get_session
-from images.thumbnails import resize_with_aspect_ratio
 from models.image import ImageUrl
-from models.models import Person
+from models.models import Person, PersonRead, PersonSearchResult
 from models.tasks import TaskStatus
+from services.search import search_persons
 
 router = APIRouter()
 
 
 @router.get("/persons")
-async def read_person(page: int, user_data: get_user_dep, session: Session = Depends(get_session)):
+async def read_person(page: int, user_data: get_user_dep, cache: cached_response_dep,
+                      session: Session = Depends(get_session)):
+    if (cached := cache.hit()) is not None:
+        return cached
+
     # SELECT * FROM person
     # WHERE like_timestamp IS NOT NULL
     # OR match_timestamp IS NOT NULL
     # ORDER BY has_media DESC, like_timestamp DESC, match_timestamp DESC;
-    statement = (
-        select(Person)
-        .where(Person.user_id == user_data.get("email"))
-        .where(Person.like_timestamp is not None or Person.match_timestamp is not None)
-        .order_by(desc(Person.has_media), desc(Person.like_timestamp), desc(Person.match_timestamp))
+    filters = (
+        Person.user_id == user_data.get("email"),
+        or_(Person.like_timestamp.is_not(None), Person.match_timestamp.is_not(None))
     )
 
-    list_of_persons = session.exec(statement).all()
-
     # Pagination
     page_size = 10
-    page_count = math.ceil(len(list_of_persons) / page_size)
+    person_count = session.exec(select(func.count()).select_from(Person).where(*filters)).one()
+    page_count = math.ceil(person_count / page_size)
     page = min(page, page_count)
+    if page < 1:
+        raise HTTPException(status_code=404, detail="Persons not found for that user")
 
-    start_index = (page - 1) * page_size
-    end_index = start_index + page_size
+    # Only the requested page is read, with its media in a single extra query
+    statement = (
+        select(Person)
+        .where(*filters)
+        .order_by(desc(Person.has_media), desc(Person.like_timestamp), desc(Person.match_timestamp), Person.id)
+        .offset((page - 1) * page_size)
+        .limit(page_size)
+        .options(selectinload(Person.media))
+    )
 
-    list_of_persons = list_of_persons[start_index:end_index]
+    list_of_persons = session.exec(statement).all()
 
     if not list_of_persons:
         raise HTTPException(status_code=404, detail="Persons not found for that user")
-    return {
-        "persons": list_of_persons,
+    return cache.respond({
+        "persons": [PersonRead.from_person(person) for person in list_of_persons],
         "current_page": page,
         "page_count": page_count
-    }
+    })
+
+
+@router.get("/persons/search")
+async def search_person(user_data: get_user_dep, cache: cached_response_dep,
+                        query: str = Query(min_length=1, max_length=256, alias="q"),
+                        page: int = Query(1, ge=1),
+                        session: Session = Depends(get_session)):
+    """
+    Search the persons I liked by the prompt I liked and the comment I sent,
+    best match first.
+
+    Args:
+        query: The "q" query parameter. Every word must match, and words can
+            be excluded with a leading "-". On Postgres, "quoted phrases" and
+            "or" work as in `websearch_to_tsquery`.
+        page: The page of results, 10 to a page.
+    """
+    if (cached := cache.hit()) is not None:
+        return cached
+
+    page_size = 10
+    results, result_count = search_persons(user_data.get("email"), query, page, page_size, session)
+
+    persons = []
+    for person, rank in results:
+        result = PersonSearchResult.from_person(person)
+        result.rank = round(rank, 4)
+        persons.append(result)
+
+    return cache.respond({
+        "persons": persons,
+        "current_page": page,
+        "page_count": math.ceil(result_count / page_size),
+        "result_count": result_count
+    })
 
 
 @router.get("/person/{task_id}")
@@ -85,45 +130,81 @@ async def get_task_progress(task_id: str):
     from models.tasks import task_manager
 
     async def generate_events():
-        if task_manager.get_task(task_id) is None:
+        task = task_manager.get_task(task_id)
+        if task is None:
             yield "event: taskError\n"
             yield "data: Task not found\n\n"
             return
 
-        while task_manager.get_task(task_id).progress < 100:
+        # A failed task goes back to 0 progress, so it ends the stream too
+        while task.progress < 100 and task.status != TaskStatus.FAILED:
             yield f"event: {TaskStatus.PROCESSING.value}\n"
-            yield f"data: {task_manager.get_task(task_id).to_json()}\n\n"
+            yield f"data: {task.to_json()}\n\n"
             await asyncio.sleep(0.5)
+            # Looked up again each time, as it may be running on another worker
+            task = task_manager.get_task(task_id)
 
-        if task_manager.get_task(task_id).status == TaskStatus.FAILED:
+        if task.status == TaskStatus.FAILED:
             yield f"event: {TaskStatus.FAILED.value}\n"
-            yield f"data: {task_manager.get_task(task_id).to_json()}\n\n"
+            yield f"data: {task.to_json()}\n\n"
             return
 
-        if task_manager.get_task(task_id).status == TaskStatus.PENDING:
+        if task.status == TaskStatus.PENDING:
             yield f"event: {TaskStatus.PENDING.value}\n"
-            yield f"data: {task_manager.get_task(task_id).to_json()}\n\n"
+            yield f"data: {task.to_json()}\n\n"
 
-        if task_manager.get_task(task_id).progress == 100:
+        if task.progress == 100:
             yield f"event: {TaskStatus.COMPLETED.value}\n"
-            yield f"data: {task_manager.get_task(task_id).to_json()}\n\n"
+            yield f"data: {task.to_json()}\n\n"
 
     return StreamingResponse(generate_events(), media_type="text/event-stream")
 
 
 @router.post("/generate-thumbnail")
-async def generate_thumbnail(image_url: ImageUrl):
+async def generate_thumbnail(image_url: ImageUrl, session: Session = Depends(get_session)):
+    """
+    A thumbnail of the image at the given URL, as a base64 data URL.
+
+    Thumbnails are stored and indexed by their image's perceptual hash. A URL
+    seen before is answered without fetching it, and an image that is a
+    near-duplicate of one already stored, such as the same photo at another
+    CDN size, reuses that thumbnail instead of rendering and storing another.
+    """
+    # Only needed here, so they aren't imported until the first thumbnail
+    import httpx
+    from PIL import Image
+
+    from images.hashing import perceptual_hash
+    from images.thumbnails import resize_with_aspect_ratio
+    from services.thumbnails import find_thumbnail_for_url, find_near_duplicates, link_source, read_thumbnail, \
+        store_thumbnail
+
     def make_base64(source, mime_type):
         base64_str = base64.b64encode(source).decode("utf-8")
         return f"data:{mime_type};base64,{base64_str}"
 
+    url = image_url.url
+
+    stored = find_thumbnail_for_url(url, session)
+    if stored is not None and (stored_bytes := read_thumbnail(stored)) is not None:
+        return make_base64(stored_bytes, stored.image_format)
+
+    # Hand the connection back while the image is fetched, as requests waiting
+    # for one on the event loop would keep the fetch from finishing
+    session.close()
+
     async with httpx.AsyncClient() as client:
-        url = image_url.url
         try:
             response = await client.get(url)
             response.raise_for_status()
 
             image = Image.open(io.BytesIO(response.content))
+            image_hash = perceptual_hash(image)
+
+            for _, duplicate in find_near_duplicates(image_hash, session):
+                if (stored_bytes := read_thumbnail(duplicate)) is not None:
+                    link_source(url, duplicate, session)
+                    return make_base64(stored_bytes, duplicate.image_format)
 
             # Declare thumbnail
             thumbnail = image.copy()
@@ -133,6 +214,8 @@ async def generate_thumbnail(image_url: ImageUrl):
             thumbnail.save(thumbnail_io, format=image.format)
             thumbnail_io.seek(0)
 
+            store_thumbnail(url, image_hash, image.format, thumbnail_io.getvalue(), session)
+
             thumbnail_bytes = make_base64(thumbnail_io.getvalue(), image.format)
 
             return thumbnail_bytes
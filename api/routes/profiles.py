@@ -0,0 +1,32 @@
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Header, Path
+from fastapi.responses import FileResponse
+
+from auth.auth import get_user_dep
+from core.profiling import is_profile_authorised, profile_path
+
+router = APIRouter()
+
+
+@router.get("/profiles/{name}")
+async def read_profile(user_data: get_user_dep,
+                       name: str = Path(pattern=r"^[0-9a-f]{32}(-[a-z]+)?$"),
+                       x_profile: Optional[str] = Header(None)):
+    """
+    A profile taken with the X-Profile header, as collapsed stacks for
+    flamegraph.pl or speedscope.
+
+    Args:
+        name: The X-Profile-Id of the request, or "<id>-ingest" for the
+            person ingest of a profiled upload, once it has finished.
+        x_profile: The PROFILE_TOKEN.
+    """
+    if not is_profile_authorised(x_profile):
+        raise HTTPException(status_code=403, detail="Profiling isn't enabled for this token")
+
+    path = profile_path(name)
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="Profile not found")
+
+    return FileResponse(path, media_type="text/plain", filename=path.name)
@@ -0,0 +1,141 @@
+"""
+Cold start benchmark.
+
+Starts fresh interpreters and measures how long `import main` takes, how
+long the startup hooks take, and the latency of the first request to each
+read endpoint compared with a warm one. Runs once with the startup warm-up
+and once without. Needs a Postgres database, DATABASE_URL by default.
+
+    python -m benchmarks.cold_start --data matches.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+USER_ID = "cold-start@example.com"
+ENDPOINTS = [
+    "/api/v1/stats",
+    "/api/v1/likes",
+    "/api/v1/activity",
+    "/api/v1/chats/stats",
+    "/api/v1/persons?page=1",
+]
+
+
+def seed(data_path: str):
+    from sqlmodel import Session, select
+
+    from core import session as db
+    from models.models import UserMetaData
+    from services.ingest import save_upload_data
+    from services.uploads import load_events
+
+    db.create_db_and_tables()
+    with Session(db.engine) as session:
+        if session.exec(select(UserMetaData).where(UserMetaData.user_id == USER_ID)).first() is None:
+            save_upload_data(load_events(data_path), USER_ID, session)
+
+
+def measure():
+    """
+    Runs in a fresh interpreter and prints its timings as JSON.
+    """
+    start = time.perf_counter()
+    import main
+    import_ms = (time.perf_counter() - start) * 1000
+
+    import asyncio
+
+    import httpx
+    from jose import jwt
+
+    token = jwt.encode({"user_id": USER_ID, "email": USER_ID}, os.environ["SECRET_KEY"],
+                       algorithm=os.environ["ALGORITHM"])
+    headers = {"Authorization": f"Bearer {token}"}
+
+    async def run():
+        start = time.perf_counter()
+        await main.app.router.startup()
+        startup_ms = (time.perf_counter() - start) * 1000
+
+        first, warm = {}, {}
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://cold-start") as client:
+            for endpoint in ENDPOINTS:
+                start = time.perf_counter()
+                response = await client.get(endpoint, headers=headers)
+                first[endpoint] = (time.perf_counter() - start) * 1000
+                assert response.status_code in (200, 404), (endpoint, response.status_code)
+
+            for endpoint in ENDPOINTS:
+                timings = []
+                for attempt in range(5):
+                    # A distinct query string so the response cache doesn't answer
+                    separator = "&" if "?" in endpoint else "?"
+                    start = time.perf_counter()
+                    await client.get(f"{endpoint}{separator}attempt={attempt}", headers=headers)
+                    timings.append((time.perf_counter() - start) * 1000)
+                warm[endpoint] = statistics.median(timings)
+
+        return startup_ms, first, warm
+
+    startup_ms, first, warm = asyncio.run(run())
+    print(json.dumps({"import_ms": import_ms, "startup_ms": startup_ms, "first": first, "warm": warm}))
+
+
+def run_children(warm_up: bool, runs: int):
+    env = dict(os.environ, WARMUP_ON_STARTUP="true" if warm_up else "false")
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-m", "benchmarks.cold_start", "--measure"], env=env,
+                                check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+
+def median_of(results, *keys):
+    values = []
+    for result in results:
+        for key in keys:
+            result = result[key]
+        values.append(result)
+    return statistics.median(values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", help="A matches.json file to seed the benchmark user with")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--measure", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "cold-start")
+    os.environ.setdefault("ALGORITHM", "HS256")
+
+    if args.measure:
+        measure()
+        return
+
+    if args.data:
+        seed(args.data)
+
+    without = run_children(warm_up=False, runs=args.runs)
+    with_warm_up = run_children(warm_up=True, runs=args.runs)
+
+    print(f"median of {args.runs} fresh processes, ms")
+    print(f"{'':<28}{'no warm-up':>12}{'warm-up':>10}")
+    print(f"{'import main':<28}{median_of(without, 'import_ms'):>12.1f}{median_of(with_warm_up, 'import_ms'):>10.1f}")
+    print(f"{'startup':<28}{median_of(without, 'startup_ms'):>12.1f}"
+          f"{median_of(with_warm_up, 'startup_ms'):>10.1f}")
+    for endpoint in ENDPOINTS:
+        print(f"{'first ' + endpoint:<28}{median_of(without, 'first', endpoint):>12.1f}"
+              f"{median_of(with_warm_up, 'first', endpoint):>10.1f}"
+              f"   (warm {median_of(with_warm_up, 'warm', endpoint):.1f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Export memory benchmark.
+
+Seeds a scratch user with increasing numbers of persons, which their likes
+and matches are read from, streams their export ZIP and reports the peak
+Python memory allocated while doing so. Needs a Postgres database, DATABASE_URL by default.
+
+    python -m benchmarks.export_memory --sizes 10000 100000 1000000
+"""
+import argparse
+import time
+import tracemalloc
+
+from sqlalchemy import text
+from sqlmodel import Session
+
+from core import session as db
+from models.models import ExportFormat
+from services.export import iter_export_zip
+
+USER_ID = "export-benchmark@example.com"
+
+SEED = [
+    # Every third like matched, so there are :rows likes and :rows / 3 matches
+    """
+    INSERT INTO person (user_id, matched, who_liked, like_type, what_you_liked_prompt, like_timestamp,
+                        match_timestamp, has_media)
+    SELECT :user_id, mod(n, 3) = 0, 2, CASE WHEN mod(n, 5) = 0 THEN 2 ELSE 1 END,
+           CASE WHEN mod(n, 5) = 0 THEN jsonb_build_object('question', 'My simple pleasures',
+                                                           'answer', md5(n::text)) END,
+           timestamp '2020-01-01' + n * interval '1 minute',
+           CASE WHEN mod(n, 3) = 0 THEN timestamp '2020-01-02' + n * interval '1 minute' END,
+           mod(n, 5) <> 0
+    FROM generate_series(1, :rows) AS n
+    """,
+    """
+    INSERT INTO personmedia (person_id, kind, url)
+    SELECT id, 1, 'https://media.hingenexus.com/image/upload/' || md5(id::text) || '.jpg'
+    FROM person WHERE user_id = :user_id AND has_media
+    """,
+]
+
+CLEAN_UP = [
+    "DELETE FROM person WHERE user_id = :user_id",
+]
+
+
+def run(statements, **params):
+    with Session(db.engine) as session:
+        for statement in statements:
+            session.execute(text(statement), params)
+        session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+                        help="Likes (and persons) per run")
+    parser.add_argument("--format", choices=[f.value for f in ExportFormat], default=ExportFormat.CSV.value)
+    args = parser.parse_args()
+
+    db.create_db_and_tables()
+    export_format = ExportFormat(args.format)
+
+    print(f"{'likes':>10}{'rows':>10}{'zip MB':>9}{'seconds':>9}{'rows/s':>10}{'peak MB':>9}")
+    for size in args.sizes:
+        run(CLEAN_UP, user_id=USER_ID)
+        run(SEED, user_id=USER_ID, rows=size)
+
+        try:
+            tracemalloc.start()
+            start = time.perf_counter()
+            zip_size = sum(len(chunk) for chunk in iter_export_zip(USER_ID, export_format))
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        finally:
+            run(CLEAN_UP, user_id=USER_ID)
+
+        rows = size * 2 + size // 3 + size * 4 // 5
+        print(f"{size:>10}{rows:>10}{zip_size / 2 ** 20:>9.1f}{elapsed:>9.1f}{rows / elapsed:>10.0f}"
+              f"{peak / 2 ** 20:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
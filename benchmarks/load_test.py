@@ -0,0 +1,409 @@
+"""
+Load test for the whole API.
+
+Starts the app with uvicorn against a local Postgres (DATABASE_URL by
+default) or a throwaway SQLite file, alongside a stub server that signs
+Google-style ID tokens and serves test images. Every virtual user logs in
+through /token, uploads a generated export and then loops over a mix of
+requests. The run steps through increasing concurrency and reports
+latency percentiles and error rates per route at each step.
+
+    python -m benchmarks.load_test --concurrency 1 4 16 32 --duration 20
+    python -m benchmarks.load_test --sqlite
+    python -m benchmarks.load_test --server gunicorn --workers 4
+
+Runs one plain uvicorn worker by default. --server gunicorn runs the
+production profile from gunicorn.conf.py instead, with --workers workers.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import httpx
+import rsa
+from PIL import Image
+from google.auth import crypt, jwt
+
+from config import config
+
+# The app, with ID tokens verified against the stub server's certs
+APP = "benchmarks.load_test_app:app"
+CLIENT_ID = "load-test"
+KEY_ID = "load-test-key"
+IMAGE_COUNT = 16
+
+# Relative weights of what a virtual user does next
+MIX = {
+    "stats": 35,
+    "persons": 30,
+    "thumbnails": 10,
+    "upload": 5,
+}
+THUMBNAIL_BURST = 5
+# Responses that mean the request was turned away by admission control
+SHED_STATUSES = (429, 503)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class StubServer:
+    """
+    Stands in for Google and for the image CDN: serves the public key that
+    ID tokens are signed with at /certs, and JPEGs at /images/<n>.jpg.
+    """
+
+    def __init__(self):
+        public_key, private_key = rsa.newkeys(2048)
+        self.certs = json.dumps({KEY_ID: public_key.save_pkcs1().decode("utf-8")}).encode("utf-8")
+        self.signer = crypt.RSASigner.from_string(private_key.save_pkcs1().decode("utf-8"), key_id=KEY_ID)
+        self.images = [self._make_image(index) for index in range(IMAGE_COUNT)]
+
+        self.port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self._server = ThreadingHTTPServer(("127.0.0.1", self.port), self._handler())
+        self._server.daemon_threads = True
+
+    @staticmethod
+    def _make_image(index: int) -> bytes:
+        rng = random.Random(index)
+        image = Image.new("RGB", (1080, 1350), tuple(rng.randrange(256) for _ in range(3)))
+        image.paste(tuple(rng.randrange(256) for _ in range(3)), (100, 200, 900, 1100))
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=85)
+        return buffer.getvalue()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/certs":
+                    self._send(stub.certs, "application/json")
+                elif self.path.startswith("/images/"):
+                    index = int(self.path.rsplit("/", 1)[-1].split(".")[0])
+                    self._send(stub.images[index % IMAGE_COUNT], "image/jpeg")
+                else:
+                    self.send_error(404)
+
+            def _send(self, body: bytes, content_type: str):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def issue_id_token(self, email: str) -> str:
+        now = int(time.time())
+        payload = {
+            "iss": "https://accounts.google.com",
+            "aud": CLIENT_ID,
+            "iat": now,
+            "exp": now + 3600,
+            "sub": str(uuid.uuid5(uuid.NAMESPACE_URL, email).int),
+            "email": email,
+            "given_name": email.split("@")[0],
+            "picture": f"{self.base_url}/images/0.jpg",
+        }
+        return jwt.encode(self.signer, payload).decode("utf-8")
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+
+
+def make_export(seed: int, event_count: int, image_base_url: str) -> bytes:
+    """
+    A matches.json like the ones in Hinge exports, with a mix of likes,
+    matches with chats and blocks.
+    """
+    rng = random.Random(seed)
+    start = datetime(2022, 1, 1)
+    events = []
+
+    for index in range(event_count):
+        timestamp = start + timedelta(minutes=rng.randrange(60 * 24 * 365))
+        like_content = rng.choice([
+            {"photo": {"url": f"{image_base_url}/images/{index}.jpg"}},
+            {"prompt": {"question": "My simple pleasures", "answer": f"coffee and a long walk {index}"}},
+            {"video": {"url": f"{image_base_url}/videos/{index}.mp4"}},
+        ])
+        event = {"like": [{"timestamp": timestamp.isoformat(), "type": "like",
+                           "content": json.dumps([like_content])}]}
+
+        if rng.random() < 0.3:
+            matched_at = timestamp + timedelta(hours=rng.randrange(1, 48))
+            event["match"] = [{"timestamp": matched_at.isoformat(), "type": "match"}]
+            event["chats"] = [
+                {"body": f"Message {message}", "type": "chats",
+                 "timestamp": (matched_at + timedelta(minutes=rng.randrange(1, 600) * (message + 1))).isoformat()}
+                for message in range(rng.randrange(1, 6))
+            ]
+        elif rng.random() < 0.05:
+            event = {"block": [{"block_type": "remove", "timestamp": timestamp.isoformat(), "type": "block"}]}
+
+        events.append(event)
+
+    return json.dumps(events).encode("utf-8")
+
+
+@dataclass
+class Recorder:
+    latencies: dict = field(default_factory=lambda: defaultdict(list))
+    errors: dict = field(default_factory=lambda: defaultdict(int))
+    shed: dict = field(default_factory=lambda: defaultdict(int))
+    # What the errors were, by status code or exception name
+    causes: dict = field(default_factory=lambda: defaultdict(Counter))
+
+    def record(self, route: str, started: float, status: int | str | None):
+        self.latencies[route].append((time.perf_counter() - started) * 1000)
+        if not isinstance(status, int) or (status >= 400 and status not in SHED_STATUSES):
+            self.errors[route] += 1
+            self.causes[route][status or "no response"] += 1
+        elif status in SHED_STATUSES:
+            self.shed[route] += 1
+
+    async def request(self, client: httpx.AsyncClient, route: str, method: str, url: str, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError as error:
+            self.record(route, started, type(error).__name__)
+            return None
+        self.record(route, started, response.status_code)
+        return response
+
+
+@dataclass
+class VirtualUser:
+    email: str
+    headers: dict
+    page_count: int = 1
+
+
+async def log_in(client: httpx.AsyncClient, stub: StubServer, email: str, recorder: Recorder) -> VirtualUser:
+    response = await recorder.request(client, "POST /token", "POST", "/token",
+                                      json={"id_token": stub.issue_id_token(email)})
+    body = response.json()
+    if body.get("status") != "success":
+        raise RuntimeError(f"Logging in as {email} failed: {body}")
+    return VirtualUser(email=email, headers={"Authorization": f"Bearer {body['token']}"})
+
+
+async def watch_progress(client: httpx.AsyncClient, task_id: str, recorder: Recorder, timeout: float):
+    """
+    Follow an upload's progress stream until it completes, recording how
+    long that took.
+    """
+    route = "SSE /persons/progress"
+    started = time.perf_counter()
+    try:
+        async with asyncio.timeout(timeout):
+            async with client.stream("GET", "/api/v1/persons/progress", params={"task_id": task_id},
+                                     timeout=None) as response:
+                async for line in response.aiter_lines():
+                    if line in ("event: completed", "event: failed", "event: taskError"):
+                        recorder.record(route, started, 200 if line == "event: completed" else line[7:])
+                        return
+        recorder.record(route, started, "stream ended")
+    except TimeoutError:
+        recorder.record(route, started, "timeout")
+    except httpx.HTTPError as error:
+        recorder.record(route, started, type(error).__name__)
+
+
+async def upload(client: httpx.AsyncClient, user: VirtualUser, export: bytes, recorder: Recorder,
+                 watch_timeout: float):
+    response = await recorder.request(client, "POST /upload", "POST", "/api/v1/upload", headers=user.headers,
+                                      files={"file": ("matches.json", export, "application/json")})
+    if response is not None and response.status_code == 200:
+        await watch_progress(client, response.json()["task_id"], recorder, watch_timeout)
+
+
+async def act(client: httpx.AsyncClient, user: VirtualUser, stub: StubServer, export: bytes,
+              recorder: Recorder, rng: random.Random, watch_timeout: float):
+    action = rng.choices(list(MIX), weights=list(MIX.values()))[0]
+
+    if action == "stats":
+        await recorder.request(client, "GET /stats", "GET", "/api/v1/stats", headers=user.headers)
+
+    elif action == "persons":
+        page = rng.randint(1, user.page_count)
+        response = await recorder.request(client, "GET /persons", "GET", "/api/v1/persons",
+                                          params={"page": page}, headers=user.headers)
+        if response is not None and response.status_code == 200:
+            user.page_count = max(1, response.json()["page_count"])
+
+    elif action == "thumbnails":
+        await asyncio.gather(*(
+            recorder.request(client, "POST /generate-thumbnail", "POST", "/api/v1/generate-thumbnail",
+                             json={"url": f"{stub.base_url}/images/{rng.randrange(IMAGE_COUNT)}.jpg"})
+            for _ in range(THUMBNAIL_BURST)
+        ))
+
+    else:
+        await upload(client, user, export, recorder, watch_timeout)
+
+
+async def run_stage(client, users, stub, export, concurrency: int, duration: float, watch_timeout: float):
+    recorder = Recorder()
+    deadline = time.perf_counter() + duration
+
+    async def virtual_user(index: int):
+        rng = random.Random(index)
+        user = users[index]
+        while time.perf_counter() < deadline:
+            await act(client, user, stub, export, recorder, rng, watch_timeout)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(virtual_user(index) for index in range(concurrency)))
+    return recorder, time.perf_counter() - started
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+def report(concurrency: int, recorder: Recorder, elapsed: float):
+    total = sum(len(latencies) for latencies in recorder.latencies.values())
+    print(f"\nconcurrency {concurrency}: {total} requests in {elapsed:.1f}s, {total / elapsed:.1f} req/s")
+    print(f"  {'route':<28}{'count':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}{'shed':>7}")
+    for route, latencies in sorted(recorder.latencies.items()):
+        count = len(latencies)
+        print(f"  {route:<28}{count:>7}{percentile(latencies, 50):>9.1f}{percentile(latencies, 95):>9.1f}"
+              f"{percentile(latencies, 99):>9.1f}{recorder.errors[route] / count:>8.1%}"
+              f"{recorder.shed[route] / count:>7.1%}")
+        if recorder.causes[route]:
+            causes = ", ".join(f"{cause} x{count}" for cause, count in recorder.causes[route].most_common())
+            print(f"  {'':<28}errors: {causes}")
+
+
+def server_command(server: str, port: int, workers: int) -> list[str]:
+    if server == "gunicorn":
+        # Everything else comes from gunicorn.conf.py, as in production
+        return [sys.executable, "-m", "gunicorn", APP, "--bind", f"127.0.0.1:{port}",
+                "--workers", str(workers), "--log-level", "warning", "--access-logfile", "/dev/null"]
+
+    return [sys.executable, "-m", "uvicorn", APP, "--host", "127.0.0.1", "--port", str(port),
+            "--workers", str(workers), "--log-level", "warning"]
+
+
+def start_app(database_url: str, stub: StubServer, server: str, workers: int, work_dir: Path, log):
+    port = free_port()
+    env = dict(
+        os.environ,
+        DATABASE_URL=database_url,
+        SECRET_KEY=uuid.uuid4().hex,
+        ALGORITHM="HS256",
+        GOOGLE_CLIENT_ID=CLIENT_ID,
+        LOAD_TEST_CERTS_URL=f"{stub.base_url}/certs",
+        SNAPSHOT_DIR=str(work_dir / "snapshots"),
+        UPLOAD_DIR=str(work_dir / "uploads"),
+    )
+    process = subprocess.Popen(
+        server_command(server, port, workers),
+        cwd=Path(__file__).resolve().parent.parent, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The app exited, see {log.name}")
+        try:
+            if httpx.get(f"{base_url}/openapi.json").status_code == 200:
+                return process, base_url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+
+    process.terminate()
+    raise RuntimeError(f"The app didn't start, see {log.name}")
+
+
+async def run(args, stub: StubServer, base_url: str):
+    run_id = uuid.uuid4().hex[:8]
+    export = make_export(0, args.events, stub.base_url)
+    # Expire idle connections before uvicorn's 5 second keep-alive does, so
+    # requests aren't sent down connections the server is closing
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=max(args.concurrency) * 2,
+                          keepalive_expiry=2)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60, limits=limits) as client:
+        setup = Recorder()
+        users = await asyncio.gather(*(log_in(client, stub, f"load-{run_id}-{index}@example.com", setup)
+                                       for index in range(max(args.concurrency))))
+
+        print(f"Seeding {len(users)} users with {args.events} events each")
+        started = time.perf_counter()
+        await asyncio.gather(*(upload(client, user, make_export(index, args.events, stub.base_url), setup,
+                                      args.watch_timeout)
+                               for index, user in enumerate(users)))
+        report(len(users), setup, time.perf_counter() - started)
+
+        for concurrency in args.concurrency:
+            recorder, elapsed = await run_stage(client, users, stub, export, concurrency, args.duration,
+                                                args.watch_timeout)
+            report(concurrency, recorder, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=config.DATABASE_URL)
+    parser.add_argument("--sqlite", action="store_true", help="Use a throwaway SQLite database instead")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--duration", type=float, default=20, help="Seconds per concurrency step")
+    parser.add_argument("--events", type=int, default=40, help="Events per uploaded export")
+    parser.add_argument("--server", choices=["uvicorn", "gunicorn"], default="uvicorn",
+                        help="Plain uvicorn, or the production gunicorn profile")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--app-log", help="Keep the app's output in this file")
+    parser.add_argument("--watch-timeout", type=float, default=120,
+                        help="Seconds to follow an upload's progress before counting it as an error")
+    args = parser.parse_args()
+
+    stub = StubServer()
+    stub.start()
+
+    with tempfile.TemporaryDirectory(prefix="load-test-") as work_dir:
+        work_dir = Path(work_dir)
+        database_url = f"sqlite:///{work_dir / 'load-test.db'}" if args.sqlite else args.database_url
+
+        with open(args.app_log or work_dir / "app.log", "wb") as log:
+            process, base_url = start_app(database_url, stub, args.server, args.workers, work_dir, log)
+            try:
+                asyncio.run(run(args, stub, base_url))
+            finally:
+                process.terminate()
+                process.wait(timeout=30)
+                stub.stop()
+
+
+if __name__ == "__main__":
+    main()
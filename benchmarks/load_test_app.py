@@ -0,0 +1,22 @@
+"""
+The app as the load test runs it. Google's ID token verification is
+swapped for one against the certs of the load test's stub server, at
+LOAD_TEST_CERTS_URL, so its virtual users can log in through /token.
+
+Only ever served by benchmarks/load_test.py.
+"""
+import os
+
+from google.oauth2 import id_token
+
+from main import app
+
+__all__ = ["app"]
+
+
+def verify_with_stub_certs(token, request, audience=None, clock_skew_in_seconds=0):
+    return id_token.verify_token(token, request, audience, certs_url=os.environ["LOAD_TEST_CERTS_URL"],
+                                 clock_skew_in_seconds=clock_skew_in_seconds)
+
+
+id_token.verify_oauth2_token = verify_with_stub_certs
@@ -0,0 +1,100 @@
+"""
+Person search benchmark.
+
+Seeds a scratch user with persons whose liked prompts and like comments are
+drawn from a small vocabulary, then times /persons/search queries against
+the GIN index, the in-process index the SQLite fallback uses, and a LIKE
+scan over the serialised prompts for comparison. Needs a Postgres
+database, DATABASE_URL by default.
+
+    python -m benchmarks.person_search --sizes 10000 100000
+"""
+import argparse
+import statistics
+import time
+
+from sqlalchemy import text
+from sqlmodel import Session, select, func, or_
+
+from core import session as db
+from models.models import Person
+from services.search import search_persons, build_person_index
+
+USER_ID = "search-benchmark@example.com"
+QUERIES = ["hiking", "coffee dogs", "\"simple pleasures\"", "travel -beach", "nothingmatches"]
+
+SEED = """
+INSERT INTO person (user_id, matched, who_liked, like_timestamp, has_media, what_you_liked_prompt, like_comment)
+SELECT :user_id, false, 2, timestamp '2020-01-01' + n * interval '1 minute', false,
+       CASE WHEN mod(n, 3) <> 0 THEN jsonb_build_object(
+           'question', (ARRAY['My simple pleasures', 'Typical Sunday', 'I geek out on',
+                              'Dating me is like'])[mod(n, 4) + 1],
+           'answer', (ARRAY['hiking', 'coffee', 'dogs', 'travel', 'beach', 'books', 'cooking', 'music',
+                            'running', 'films'])[mod(n * 7, 10) + 1]
+                     || ' and ' ||
+                     (ARRAY['hiking', 'coffee', 'dogs', 'travel', 'beach', 'books', 'cooking', 'music',
+                            'running', 'films'])[mod(n / 10, 10) + 1]
+                     || ' ' || md5(n::text)) END,
+       CASE WHEN mod(n, 5) = 0 THEN 'Love the ' ||
+           (ARRAY['hiking', 'coffee', 'dogs', 'travel', 'beach'])[mod(n / 5, 5) + 1] || ' ' || md5(n::text) END
+FROM generate_series(1, :rows) AS n
+"""
+
+
+def time_query(run, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def like_scan(session, query):
+    # What searching without the index would take: a scan of the user's rows
+    word = query.split()[0].strip('"')
+    pattern = f"%{word}%"
+    statement = (select(func.count()).select_from(Person)
+                 .where(Person.user_id == USER_ID)
+                 .where(or_(text("what_you_liked_prompt::text ILIKE :pattern"), Person.like_comment.ilike(pattern))))
+    return session.execute(statement, {"pattern": pattern}).scalar_one()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000], help="Persons per run")
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    db.create_db_and_tables()
+
+    print(f"{'persons':>9}  {'query':<20}{'matches':>9}{'gin ms':>9}{'memory ms':>11}{'like ms':>9}")
+    for size in args.sizes:
+        with Session(db.engine) as session:
+            session.execute(text("DELETE FROM person WHERE user_id = :user_id"), {"user_id": USER_ID})
+            session.execute(text(SEED), {"user_id": USER_ID, "rows": size})
+            session.commit()
+            session.execute(text("ANALYZE person"))
+
+            # Built once, as the cache would keep it between requests
+            start = time.perf_counter()
+            index = build_person_index(USER_ID, session)
+            build_ms = (time.perf_counter() - start) * 1000
+
+            try:
+                for query in QUERIES:
+                    _, matches = search_persons(USER_ID, query, 1, 10, session)
+                    gin_ms = time_query(lambda: search_persons(USER_ID, query, 1, 10, session), args.repeats)
+                    # Only the ranking, loading the page's persons costs the same either way
+                    memory_ms = time_query(lambda: index.search(query), args.repeats)
+                    like_ms = time_query(lambda: like_scan(session, query), args.repeats)
+                    print(f"{size:>9}  {query:<20}{matches:>9}{gin_ms:>9.1f}{memory_ms:>11.1f}{like_ms:>9.1f}")
+            finally:
+                session.execute(text("DELETE FROM person WHERE user_id = :user_id"), {"user_id": USER_ID})
+                session.commit()
+
+        print(f"{size:>9}  in-process index built in {build_ms:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
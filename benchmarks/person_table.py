@@ -0,0 +1,187 @@
+"""
+Person table size and /persons scan benchmark.
+
+Fills a scratch schema with the person table as it was before
+migrations/001_compact_person.sql, measures it, runs the migration over it
+and measures again. Needs a Postgres database, DATABASE_URL by default.
+
+    python -m benchmarks.person_table --users 200 --persons 1000
+"""
+import argparse
+import re
+import statistics
+import time
+from pathlib import Path
+
+from sqlmodel import create_engine
+
+from config import config
+
+SCHEMA = "bench_person"
+MIGRATION = Path(__file__).resolve().parent.parent / "migrations" / "001_compact_person.sql"
+
+LEGACY_TABLE = """
+CREATE TABLE person (
+    id SERIAL PRIMARY KEY,
+    user_id VARCHAR,
+    matched BOOLEAN,
+    who_liked VARCHAR,
+    what_you_liked_photo VARCHAR,
+    what_you_liked_prompt VARCHAR,
+    what_you_liked_video VARCHAR,
+    like_timestamp TIMESTAMP,
+    match_timestamp TIMESTAMP,
+    we_met BOOLEAN,
+    blocked VARCHAR,
+    has_media BOOLEAN,
+    thumbnail VARCHAR
+);
+CREATE INDEX ix_person_user_id ON person (user_id);
+"""
+
+# Roughly what save_person_data writes: most persons are likes we sent with a
+# photo, some with a prompt or video instead, a third of them matched.
+LEGACY_ROWS = """
+INSERT INTO person (user_id, matched, who_liked, what_you_liked_photo, what_you_liked_prompt,
+                    what_you_liked_video, like_timestamp, match_timestamp, we_met, blocked, has_media)
+SELECT 'user' || u || '@example.com',
+       mod(n, 3) = 0,
+       CASE WHEN mod(n, 5) = 0 THEN 'Them' ELSE 'You' END,
+       CASE WHEN mod(n, 10) < 7 THEN 'https://media.hingenexus.com/image/upload/c_fill,h_1536,w_1536/'
+                                 || md5(u || ':' || n) || '.jpg' END,
+       CASE WHEN mod(n, 10) IN (7, 8) THEN '{"question": "My simple pleasures", "answer": "'
+                                       || left(md5(n::text), 12) || ' and a long walk"}' END,
+       CASE WHEN mod(n, 10) = 9 THEN 'https://media.hingenexus.com/video/upload/' || md5(u || ':' || n) || '.mp4' END,
+       timestamp '2023-01-01' + n * interval '37 minutes',
+       CASE WHEN mod(n, 3) = 0 THEN timestamp '2023-01-01' + n * interval '37 minutes' + interval '1 day' END,
+       CASE WHEN mod(n, 50) = 0 THEN true END,
+       CASE WHEN mod(n, 40) = 0 THEN 'true' END,
+       mod(n, 10) <> 7 AND mod(n, 10) <> 8
+FROM generate_series(1, %(users)s) AS u, generate_series(1, %(persons)s) AS n
+"""
+
+LEGACY_PAGE = """
+SELECT * FROM person
+WHERE user_id = %(user_id)s AND (like_timestamp IS NOT NULL OR match_timestamp IS NOT NULL)
+ORDER BY has_media DESC, like_timestamp DESC, match_timestamp DESC
+"""
+
+COMPACT_COUNT = """
+SELECT count(*) FROM person
+WHERE user_id = %(user_id)s AND (like_timestamp IS NOT NULL OR match_timestamp IS NOT NULL)
+"""
+
+COMPACT_PAGE = """
+SELECT * FROM person
+WHERE user_id = %(user_id)s AND (like_timestamp IS NOT NULL OR match_timestamp IS NOT NULL)
+ORDER BY has_media DESC, like_timestamp DESC, match_timestamp DESC, id
+LIMIT 10 OFFSET %(offset)s
+"""
+
+COMPACT_MEDIA = "SELECT * FROM personmedia WHERE person_id = ANY(%(ids)s)"
+
+SCAN = "SELECT * FROM person WHERE user_id = %(user_id)s"
+
+
+def relation_sizes(cursor):
+    cursor.execute("""
+        SELECT c.relname, pg_total_relation_size(c.oid)
+        FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relkind = 'r'
+    """, (SCHEMA,))
+    return dict(cursor.fetchall())
+
+
+def median_ms(cursor, run, users: int, repeat: int):
+    timings = []
+    for index in range(repeat):
+        user_id = f"user{index % users + 1}@example.com"
+        start = time.perf_counter()
+        run(cursor, user_id)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def explain_scan(cursor, users: int, repeat: int):
+    """
+    Median server-side execution time and pages touched by a per-user scan,
+    leaving out the time the driver spends building Python rows.
+    """
+    timings, pages = [], []
+    for index in range(repeat):
+        cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + SCAN, {"user_id": f"user{index % users + 1}@example.com"})
+        plan = "\n".join(row[0] for row in cursor.fetchall())
+        timings.append(float(re.search(r"Execution Time: ([\d.]+)", plan).group(1)))
+        pages.append(sum(int(count) for count in re.findall(r"Buffers: shared hit=(\d+)", plan)[:1]))
+    return statistics.median(timings), statistics.median(pages)
+
+
+def legacy_page(cursor, user_id):
+    # The endpoint used to read every row and slice the page out in Python
+    cursor.execute(LEGACY_PAGE, {"user_id": user_id})
+    cursor.fetchall()[:10]
+
+
+def compact_page(cursor, user_id):
+    cursor.execute(COMPACT_COUNT, {"user_id": user_id})
+    cursor.fetchone()
+    cursor.execute(COMPACT_PAGE, {"user_id": user_id, "offset": 0})
+    ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute(COMPACT_MEDIA, {"ids": ids})
+    cursor.fetchall()
+
+
+def run_migration(cursor):
+    # VACUUM can't run inside a multi-statement string, so send them one by one
+    statements = "\n".join(line for line in MIGRATION.read_text().splitlines() if not line.startswith("--"))
+    for statement in statements.split(";"):
+        if statement.strip():
+            cursor.execute(statement)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=config.DATABASE_URL)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--persons", type=int, default=1000, help="Persons per user")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    connection = create_engine(args.database_url).raw_connection().driver_connection
+    connection.autocommit = True
+    cursor = connection.cursor()
+
+    try:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        cursor.execute(f"CREATE SCHEMA {SCHEMA}")
+        cursor.execute(f"SET search_path TO {SCHEMA}")
+
+        cursor.execute(LEGACY_TABLE)
+        cursor.execute(LEGACY_ROWS, {"users": args.users, "persons": args.persons})
+        cursor.execute("VACUUM ANALYZE person")
+
+        before = relation_sizes(cursor)
+        before_scan, before_pages = explain_scan(cursor, args.users, args.repeat)
+        before_page = median_ms(cursor, legacy_page, args.users, args.repeat)
+
+        run_migration(cursor)
+
+        after = relation_sizes(cursor)
+        after_scan, after_pages = explain_scan(cursor, args.users, args.repeat)
+        after_page = median_ms(cursor, compact_page, args.users, args.repeat)
+    finally:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        connection.close()
+
+    print(f"{args.users * args.persons} persons, {args.users} users")
+    print(f"{'':<28}{'before':>10}{'after':>10}")
+    print(f"{'person table MB':<28}{before['person'] / 2 ** 20:>10.1f}{after['person'] / 2 ** 20:>10.1f}")
+    print(f"{'personmedia table MB':<28}{'':>10}{after['personmedia'] / 2 ** 20:>10.1f}")
+    print(f"{'total MB':<28}{sum(before.values()) / 2 ** 20:>10.1f}{sum(after.values()) / 2 ** 20:>10.1f}")
+    print(f"{'per-user scan ms (server)':<28}{before_scan:>10.3f}{after_scan:>10.3f}")
+    print(f"{'per-user scan pages':<28}{before_pages:>10.0f}{after_pages:>10.0f}")
+    print(f"{'/persons page query ms':<28}{before_page:>10.2f}{after_page:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
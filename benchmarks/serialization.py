@@ -0,0 +1,74 @@
+"""
+Serialisation and compression benchmark for the large JSON responses.
+
+Builds /matches, /likes and /persons shaped payloads from matches-dawd.json
+and compares FastAPI's default encoding with the app's FastJSONResponse, and
+the payload size with and without compression.
+
+    python -m benchmarks.serialization
+"""
+import gzip
+import json
+import random
+import timeit
+
+import brotli
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from core.responses import dumps
+from models.models import Matches, Likes, PersonRead
+from utils.dates import parse_timestamp
+
+USER_ID = "someone@example.com"
+
+
+def build_payloads(path="matches-dawd.json"):
+    with open(path) as file:
+        events = json.load(file)
+
+    rng = random.Random(0)
+    matches, likes, persons = [], [], []
+
+    for index, event in enumerate(events):
+        match = event.get("match")
+        like = event.get("like")
+        if match:
+            matches.append(Matches(id=len(matches) + 1, user_id=USER_ID, type=1 if like else 2,
+                                   timestamp=parse_timestamp(match[0])))
+        if like:
+            likes.append(Likes(id=len(likes) + 1, user_id=USER_ID, type=rng.randint(1, 3),
+                               timestamp=parse_timestamp(like[0])))
+            persons.append(PersonRead(
+                id=len(persons) + 1, user_id=USER_ID, matched=bool(match), who_liked="You",
+                what_you_liked_photo=f"https://media.hingenexus.com/image/upload/{index:08d}/photo.jpg",
+                what_you_liked_prompt=json.dumps({"question": "My simple pleasures",
+                                                  "answer": like[0].get("comment") or "Coffee and a long walk"}),
+                like_timestamp=parse_timestamp(like[0]),
+                match_timestamp=parse_timestamp(match[0]) if match else None,
+                has_media=True
+            ))
+
+    return {"/matches": matches, "/likes": likes, "/persons (all rows)": persons}
+
+
+def main():
+    payloads = build_payloads()
+
+    print(f"{'payload':<20}{'rows':>7}{'default ms':>12}{'orjson ms':>11}"
+          f"{'raw KB':>9}{'gzip KB':>9}{'br KB':>7}")
+
+    for name, rows in payloads.items():
+        default = timeit.timeit(lambda: JSONResponse(jsonable_encoder(rows)).body, number=5) / 5
+        fast = timeit.timeit(lambda: dumps(rows), number=5) / 5
+
+        body = dumps(rows)
+        assert json.loads(body) == json.loads(JSONResponse(jsonable_encoder(rows)).body)
+
+        print(f"{name:<20}{len(rows):>7}{default * 1000:>12.1f}{fast * 1000:>11.1f}"
+              f"{len(body) / 1024:>9.1f}{len(gzip.compress(body, 6)) / 1024:>9.1f}"
+              f"{len(brotli.compress(body, quality=4)) / 1024:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -13,7 +14,58 @@ class Config:
     POSTGRES_SERVER = os.getenv("POSTGRES_SERVER", "localhost")
     POSTGRES_PORT = os.getenv("POSTGRES_PORT", 5432)
     POSTGRES_DB = os.getenv("POSTGRES_DB", "postgres")
-    DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB}"
+    DATABASE_URL = os.getenv(
+        "DATABASE_URL",
+        f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB}"
+    )
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+    SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+    THUMBNAIL_DIR = os.getenv("THUMBNAIL_DIR", "thumbnails")
+    # Images whose perceptual hashes differ in at most this many bits share a thumbnail
+    THUMBNAIL_MAX_HASH_DISTANCE = int(os.getenv("THUMBNAIL_MAX_HASH_DISTANCE", 6))
+    RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 256))
+    # Per user search indexes kept in memory, only used without Postgres
+    SEARCH_INDEX_CACHE_SIZE = int(os.getenv("SEARCH_INDEX_CACHE_SIZE", 32))
+    COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+    UPLOAD_DIR = os.getenv("UPLOAD_DIR", os.path.join(tempfile.gettempdir(), "hinge-uploads"))
+    MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 200 * 1024 * 1024))
+    MAX_CONCURRENT_INGESTS = int(os.getenv("MAX_CONCURRENT_INGESTS", 4))
+    MAX_INGESTS_PER_USER = int(os.getenv("MAX_INGESTS_PER_USER", 1))
+    MAX_INGEST_QUEUE = int(os.getenv("MAX_INGEST_QUEUE", 32))
+    # Events per committed chunk of persons
+    PERSON_INGEST_CHUNK_SIZE = int(os.getenv("PERSON_INGEST_CHUNK_SIZE", 500))
+    # Processes that build person rows during ingest, up to one per core. 0 builds them in the request worker
+    INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 0))
+    # An ingest whose checkpoint hasn't moved for this long is resumed by another worker
+    INGEST_LEASE_SECONDS = int(os.getenv("INGEST_LEASE_SECONDS", 300))
+    EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+    PERCENTILE_RELATIVE_ACCURACY = float(os.getenv("PERCENTILE_RELATIVE_ACCURACY", 0.01))
+    # How often the percentile sketches are rebuilt from every user's metrics. 0 turns it off
+    PERCENTILE_REBUILD_INTERVAL = int(os.getenv("PERCENTILE_REBUILD_INTERVAL", 3600))
+    # How long a worker reuses the sketches it last read
+    PERCENTILE_CACHE_SECONDS = int(os.getenv("PERCENTILE_CACHE_SECONDS", 60))
+    # Requests carrying this token in the X-Profile header or the profile query parameter are profiled.
+    # Profiling is off when unset
+    PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+    PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+    # Seconds between stack samples of a profiled request
+    PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005))
+    # Web worker processes run by the production server, see gunicorn.conf.py
+    WEB_WORKERS = int(os.getenv("WEB_WORKERS", os.cpu_count() or 1))
+    # Seconds an idle keep-alive connection stays open. Keep it above the load balancer's idle timeout, so it's the
+    # load balancer that closes idle connections and never sends a request down one the worker is closing
+    KEEP_ALIVE_SECONDS = int(os.getenv("KEEP_ALIVE_SECONDS", 75))
+    # Connections and requests a web worker takes on at once before answering 503. 0 for no limit
+    WORKER_MAX_CONCURRENCY = int(os.getenv("WORKER_MAX_CONCURRENCY", 256))
+    # How long a stopping worker lets its ingests run before handing the rest over to the other workers
+    SHUTDOWN_DRAIN_SECONDS = int(os.getenv("SHUTDOWN_DRAIN_SECONDS", 120))
+    # How long any worker can still report a finished upload task's status
+    TASK_RETENTION_SECONDS = int(os.getenv("TASK_RETENTION_SECONDS", 24 * 60 * 60))
+    # Seconds between writes of a task's progress for the other workers. Status changes are written straight away
+    TASK_SAVE_INTERVAL = float(os.getenv("TASK_SAVE_INTERVAL", 2))
+    WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "true").lower() == "true"
+    # Loaded by the startup warm-up when set
+    NER_MODEL_PATH = os.getenv("NER_MODEL_PATH")
 
 
 config = Config()
@@ -0,0 +1,198 @@
+import asyncio
+import math
+import time
+from collections import Counter, deque
+from dataclasses import dataclass
+
+from config import config
+from models.tasks import TaskStatus, task_manager
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+@dataclass
+class _Waiter:
+    user_id: str
+    task_id: str
+    future: asyncio.Future
+
+
+class IngestAdmission:
+    """
+    Limits how many uploads a worker ingests at once.
+
+    Up to `max_concurrent` ingests run at a time. Further uploads wait in a
+    FIFO queue of at most `max_queue`, and each user can have at most
+    `max_per_user` ingests running or waiting. Anything beyond that is
+    rejected straight away with a Retry-After estimate, so a burst of uploads
+    queues up instead of all hitting Postgres at once.
+
+    Runs on the event loop, so it needs no locking.
+    """
+
+    def __init__(self, max_concurrent: int, max_per_user: int, max_queue: int):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+
+        self._active = 0
+        self._per_user = Counter()
+        self._waiters: deque[_Waiter] = deque()
+        # Every queued task until it's done waiting, including ones already granted a slot
+        self._queued: dict[str, _Waiter] = {}
+        self._started: dict[str, float] = {}
+        # Moving average of how long an ingest holds its slot, in seconds
+        self._average_duration = 30.0
+        # Set once the worker is stopping
+        self._closed = False
+
+    @property
+    def idle(self) -> bool:
+        return self._active == 0 and not self._waiters
+
+    def retry_after(self) -> int:
+        slots_ahead = len(self._waiters) + 1
+        return max(1, math.ceil(self._average_duration * slots_ahead / self.max_concurrent))
+
+    def acquire_nowait(self, user_id: str) -> bool:
+        """
+        Reserve an ingest for the given user.
+
+        :return: True if a slot was taken and the ingest can start now. False if
+            a place in the queue was reserved, which must be claimed with
+            `enqueue` before the next await.
+        :raises AdmissionRejected: 429 if the user already has too many ingests,
+            503 if the queue is full or the worker is stopping.
+        """
+        if self._closed:
+            # Another worker can take it straight away
+            raise AdmissionRejected(503, "The server is restarting, try again", 1)
+
+        if self._per_user[user_id] >= self.max_per_user:
+            raise AdmissionRejected(429, "An upload is already being processed for this user", self.retry_after())
+
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+            self._per_user[user_id] += 1
+            return True
+
+        if len(self._waiters) >= self.max_queue:
+            raise AdmissionRejected(503, "Too many uploads are being processed, try again later", self.retry_after())
+
+        self._per_user[user_id] += 1
+        return False
+
+    def enqueue(self, user_id: str, task_id: str):
+        """
+        Join the queue with a place reserved by `acquire_nowait`. The task's
+        status reports its position until a slot is granted.
+        """
+        waiter = _Waiter(user_id, task_id, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self._queued[task_id] = waiter
+        self._report_positions()
+
+    async def wait(self, task_id: str):
+        """
+        Wait until the queued task is granted a slot.
+        """
+        waiter = self._queued[task_id]
+
+        try:
+            await waiter.future
+            del self._queued[task_id]
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # The slot was granted just before cancellation, hand it on
+                del self._queued[task_id]
+                self.release(waiter.user_id)
+            else:
+                self.cancel(waiter.user_id, task_id)
+            raise
+
+    def cancel(self, user_id: str, task_id: str | None = None):
+        """
+        Give back a queued reservation, along with its slot if one was already
+        granted.
+        """
+        waiter = self._queued.pop(task_id, None)
+        if waiter is not None and waiter.future.done() and not waiter.future.cancelled():
+            # Granted while the upload was still being spooled, hand it on
+            self.release(user_id, task_id)
+            return
+
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+
+        self._forget(user_id)
+        self._report_positions()
+
+    def start(self, task_id: str):
+        self._started[task_id] = time.monotonic()
+
+    def release(self, user_id: str, task_id: str | None = None):
+        started = self._started.pop(task_id, None)
+        if started is not None:
+            self._average_duration = 0.8 * self._average_duration + 0.2 * (time.monotonic() - started)
+
+        self._active -= 1
+        self._forget(user_id)
+
+        while self._waiters and self._active < self.max_concurrent:
+            waiter = self._waiters.popleft()
+            if waiter.future.done():
+                # Cancelled while waiting, its own handler gives back the reservation
+                continue
+            self._active += 1
+            task_manager.update_task(waiter.task_id, status=TaskStatus.PENDING, queue_position=0,
+                                     message="Upload processing started")
+            waiter.future.set_result(None)
+
+        self._report_positions()
+
+    def close(self):
+        """
+        Turn away new ingests, as the worker is stopping.
+        """
+        self._closed = True
+
+    async def drain(self, timeout: float) -> bool:
+        """
+        Wait for the running and queued ingests to finish.
+
+        :return: Whether they had within `timeout` seconds.
+        """
+        deadline = time.monotonic() + timeout
+        while not self.idle:
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.5)
+
+        return True
+
+    def _forget(self, user_id: str):
+        self._per_user[user_id] -= 1
+        if self._per_user[user_id] <= 0:
+            del self._per_user[user_id]
+
+    def _report_positions(self):
+        for position, waiter in enumerate(self._waiters, start=1):
+            task_manager.update_task(
+                waiter.task_id,
+                status=TaskStatus.QUEUED,
+                queue_position=position,
+                message=f"Waiting to be processed. Position {position} of {len(self._waiters)} in the queue."
+            )
+
+
+ingest_admission = IngestAdmission(
+    max_concurrent=config.MAX_CONCURRENT_INGESTS,
+    max_per_user=config.MAX_INGESTS_PER_USER,
+    max_queue=config.MAX_INGEST_QUEUE
+)
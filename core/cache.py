@@ -0,0 +1,184 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Annotated, Any, Optional, Tuple
+
+from fastapi import Depends, Request, Response
+
+from auth.auth import get_user_dep
+from config import config
+from core.responses import dumps
+from core.snapshot import user_hash
+
+CACHE_CONTROL = "private, no-cache"
+
+
+def data_version_path(user_id: str) -> Path:
+    return Path(config.SNAPSHOT_DIR) / f"{user_hash(user_id)}.version"
+
+
+def percentile_version_path() -> Path:
+    return Path(config.SNAPSHOT_DIR) / "percentiles.version"
+
+
+def _read_version(path: Path) -> int:
+    try:
+        return int(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def _write_version(path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(str(time.time_ns()))
+
+
+def get_data_version(user_id: str) -> int:
+    """
+    The version of the given user's data. Kept on disk next to the snapshots
+    so every worker sees the same version without going to the database.
+    """
+    return _read_version(data_version_path(user_id))
+
+
+def bump_data_version(user_id: str):
+    """
+    Invalidate every cached response and ETag for the given user. Call this
+    whenever the user's data changes.
+    """
+    _write_version(data_version_path(user_id))
+
+
+def bump_all_data_versions():
+    for path in Path(config.SNAPSHOT_DIR).glob("*.version"):
+        path.write_text(str(time.time_ns()))
+
+
+def get_percentile_version() -> int:
+    """
+    The version of the cross-user percentile sketches, shared by every user.
+    """
+    return _read_version(percentile_version_path())
+
+
+def bump_percentile_version():
+    """
+    Invalidate every cached response that shows percentiles. Call this
+    whenever the sketches are rebuilt.
+    """
+    _write_version(percentile_version_path())
+
+
+class ResponseCache:
+    """
+    An LRU of serialised responses, keyed by user, route and query parameters.
+
+    Entries are only served while their ETag matches the user's current data
+    version, so a bump makes every older entry a miss.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    # Creates a singleton. Ensuring a single instance only gets create across the app
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    cls._instance = super().__new__(cls)
+
+                    cls._instance._entries: OrderedDict[Tuple, Tuple[str, bytes]] = OrderedDict()
+                    cls._instance.max_entries = config.RESPONSE_CACHE_SIZE
+
+        return cls._instance
+
+    def get(self, key: Tuple, etag: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != etag:
+                return None
+
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: Tuple, etag: str, body: bytes):
+        with self._lock:
+            self._entries[key] = (etag, body)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+response_cache = ResponseCache()
+
+
+class CachedResponse:
+    """
+    Per-request handle on the response cache.
+
+    Endpoints return `hit()` when it isn't None, and otherwise build their
+    result as usual and return `respond(result)`.
+    """
+
+    def __init__(self, request: Request, user_data: get_user_dep):
+        user_id = user_data.get("email")
+        params = tuple(sorted(request.query_params.multi_items()))
+
+        self.key = (user_id, request.url.path, params)
+        self.if_none_match = request.headers.get("if-none-match")
+
+        digest = hashlib.sha1(repr((self._version(user_id), self.key)).encode("utf-8")).hexdigest()
+        self.etag = f'"{digest}"'
+
+    def _version(self, user_id: str):
+        return get_data_version(user_id)
+
+    def _headers(self):
+        return {"ETag": self.etag, "Cache-Control": CACHE_CONTROL}
+
+    def _client_has_current(self) -> bool:
+        if self.if_none_match is None:
+            return False
+
+        tags = {tag.strip().removeprefix("W/") for tag in self.if_none_match.split(",")}
+        return self.etag in tags or "*" in tags
+
+    def hit(self) -> Optional[Response]:
+        """
+        The response to send without running the endpoint, if any. Either a
+        304 when the client already has this version, or the cached body.
+        """
+        if self._client_has_current():
+            return Response(status_code=304, headers=self._headers())
+
+        body = response_cache.get(self.key, self.etag)
+        if body is None:
+            return None
+
+        return Response(content=body, media_type="application/json", headers=self._headers())
+
+    def respond(self, content: Any) -> Response:
+        body = dumps(content)
+        response_cache.set(self.key, self.etag, body)
+
+        return Response(content=body, media_type="application/json", headers=self._headers())
+
+
+class CachedStatsResponse(CachedResponse):
+    """
+    A handle for responses that also show the cross-user percentiles, which
+    change with every user's data rather than only the user's own.
+    """
+
+    def _version(self, user_id: str):
+        return get_data_version(user_id), get_percentile_version()
+
+
+cached_response_dep = Annotated[CachedResponse, Depends()]
+cached_stats_response_dep = Annotated[CachedStatsResponse, Depends()]
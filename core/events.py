@@ -0,0 +1,355 @@
+import warnings
+from enum import IntEnum, IntFlag
+from typing import Iterable, Optional
+
+import numpy as np
+import orjson
+
+from core.snapshot import EPOCH, ONE_US, to_epoch_us
+from utils.dates import parse_timestamp
+
+# Stands in for a missing or unparseable timestamp in the timestamp columns
+NO_TIMESTAMP = np.iinfo(np.int64).min
+# Stands in for a missing string in the string id columns
+NO_STRING = -1
+
+
+class EventField(IntFlag):
+    """
+    What a Hinge event holds, one bit per key of its JSON object, plus
+    whether the user said they met.
+    """
+    LIKE = 1
+    MATCH = 2
+    CHATS = 4
+    BLOCK = 8
+    WE_MET = 16
+    MET = 32
+
+
+class LikeType(IntEnum):
+    """
+    What a like was sent on, as stored in Person.like_type.
+    """
+    UNKNOWN = 0
+    PHOTO = 1
+    PROMPT = 2
+    VIDEO = 3
+
+
+def like_type(content: Optional[dict]) -> LikeType:
+    """
+    :param content: The first item of a like's decoded content.
+    """
+    if not isinstance(content, dict):
+        return LikeType.UNKNOWN
+    if (content.get("photo") or {}).get("url"):
+        return LikeType.PHOTO
+    if (content.get("prompt") or {}).get("question"):
+        return LikeType.PROMPT
+    if (content.get("video") or {}).get("url"):
+        return LikeType.VIDEO
+    return LikeType.UNKNOWN
+
+
+def _decoded(value):
+    # Some fields of the export, such as a like's content, are JSON encoded strings
+    if isinstance(value, str):
+        try:
+            return orjson.loads(value)
+        except orjson.JSONDecodeError:
+            return value
+    return value
+
+
+def parse_timestamps(timestamps: list[Optional[str]]) -> np.ndarray:
+    """
+    Parse ISO 8601 timestamps into epoch microseconds in one vectorised
+    call, falling back to dateparser one by one for anything NumPy can't
+    read. Missing or unparseable timestamps become NO_TIMESTAMP.
+    """
+    try:
+        with warnings.catch_warnings():
+            # NumPy only warns about, and converts, timestamps with an offset
+            warnings.simplefilter("error", DeprecationWarning)
+            parsed = np.array([timestamp or "NaT" for timestamp in timestamps], dtype="datetime64[us]")
+        # NaT is the smallest int64, so missing timestamps come out as NO_TIMESTAMP
+        return parsed.astype(np.int64)
+    except (ValueError, DeprecationWarning):
+        pass
+
+    parsed = np.full(len(timestamps), NO_TIMESTAMP, dtype=np.int64)
+    for i, timestamp in enumerate(timestamps):
+        if timestamp:
+            value = parse_timestamp({"timestamp": timestamp})
+            if value is not None:
+                parsed[i] = to_epoch_us(value)
+    return parsed
+
+
+def to_datetime(timestamp: int):
+    return None if timestamp == NO_TIMESTAMP else EPOCH + int(timestamp) * ONE_US
+
+
+def to_datetimes(timestamps: np.ndarray) -> list:
+    # NO_TIMESTAMP is NaT, which comes out as None
+    return timestamps.astype("datetime64[us]").tolist()
+
+
+class StringPool:
+    """
+    Strings stored back to back in a single UTF-8 buffer and looked up by
+    id, so a string costs its bytes plus an 8 byte offset instead of a
+    Python object. Equal strings are stored once while the pool is built.
+    """
+
+    def __init__(self):
+        self._ids: Optional[dict[str, int]] = {}
+        self._parts: list[bytes] = []
+        self._size = 0
+        self._offsets = [0]
+        self.buffer = b""
+        self.offsets = np.zeros(1, dtype=np.int64)
+
+    def add(self, value: Optional[str]) -> int:
+        if value is None:
+            return NO_STRING
+        if not isinstance(value, str):
+            value = orjson.dumps(value).decode("utf-8")
+
+        string_id = self._ids.get(value)
+        if string_id is None:
+            encoded = value.encode("utf-8")
+            string_id = len(self._offsets) - 1
+            self._ids[value] = string_id
+            self._parts.append(encoded)
+            self._size += len(encoded)
+            self._offsets.append(self._size)
+        return string_id
+
+    def freeze(self):
+        """
+        Join the strings into the shared buffer and drop the build state.
+        """
+        self.buffer = b"".join(self._parts)
+        self.offsets = np.array(self._offsets, dtype=np.int64)
+        self._ids, self._parts, self._offsets = None, [], []
+
+    def get(self, string_id: int) -> Optional[str]:
+        if string_id == NO_STRING:
+            return None
+        return self.buffer[self.offsets[string_id]:self.offsets[string_id + 1]].decode("utf-8")
+
+    def subset(self, string_ids: np.ndarray) -> tuple["StringPool", np.ndarray]:
+        """
+        A frozen pool of just the given strings.
+
+        :return: The pool, and the ids in it of each of `string_ids`.
+        """
+        used = np.unique(string_ids[string_ids != NO_STRING])
+        starts, ends = self.offsets[used], self.offsets[used + 1]
+
+        pool = StringPool()
+        pool.freeze()
+        pool.buffer = b"".join(self.buffer[start:end] for start, end in zip(starts.tolist(), ends.tolist()))
+        pool.offsets = np.zeros(len(used) + 1, dtype=np.int64)
+        np.cumsum(ends - starts, out=pool.offsets[1:])
+
+        new_ids = np.searchsorted(used, string_ids).astype(np.int32)
+        new_ids[string_ids == NO_STRING] = NO_STRING
+        return pool, new_ids
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.buffer) + self.offsets.nbytes
+
+
+# Column name, dtype, value while the event doesn't have it
+EVENT_COLUMNS = (
+    ("fields", np.uint8, 0),
+    ("like_types", np.uint8, LikeType.UNKNOWN),
+    ("like_media_urls", np.int32, NO_STRING),
+    ("like_questions", np.int32, NO_STRING),
+    ("like_answers", np.int32, NO_STRING),
+    ("like_comments", np.int32, NO_STRING),
+)
+STRING_COLUMNS = ("like_media_urls", "like_questions", "like_answers", "like_comments")
+TIMESTAMP_COLUMNS = ("like_timestamps", "match_timestamps", "block_timestamps")
+
+
+class EventTable:
+    """
+    The events of an upload as parallel typed arrays, one row per event,
+    with their strings in a StringPool.
+
+    Takes a few dozen bytes per event, where the parsed JSON takes several
+    hundred per field, so it's cheap to keep alive for the background person
+    ingest. Built by `EventTableBuilder`.
+
+    The chats of event `i` are rows `chat_offsets[i]:chat_offsets[i + 1]` of
+    the chat columns, in the order they appear in the export.
+    """
+    __slots__ = ("fields", "like_types", "like_media_urls", "like_questions", "like_answers", "like_comments",
+                 "like_timestamps", "match_timestamps", "block_timestamps",
+                 "chat_offsets", "chat_timestamps", "chat_bodies", "strings", "event_types")
+
+    def __len__(self):
+        return len(self.fields)
+
+    def has(self, field: EventField) -> np.ndarray:
+        return (self.fields & field) != 0
+
+    def string(self, string_id: int) -> Optional[str]:
+        return self.strings.get(string_id)
+
+    def chat_rows(self, index: int) -> range:
+        return range(self.chat_offsets[index], self.chat_offsets[index + 1])
+
+    def slice(self, start: int, stop: int) -> "EventTable":
+        """
+        A table of events `start` to `stop`, holding only their own strings,
+        to send to another process.
+        """
+        table = EventTable()
+        for name, _, _ in EVENT_COLUMNS:
+            setattr(table, name, getattr(self, name)[start:stop])
+        for name in TIMESTAMP_COLUMNS:
+            setattr(table, name, getattr(self, name)[start:stop])
+
+        chat_start, chat_stop = self.chat_offsets[start], self.chat_offsets[stop]
+        table.chat_offsets = self.chat_offsets[start:stop + 1] - chat_start
+        table.chat_timestamps = self.chat_timestamps[chat_start:chat_stop]
+
+        # Every string column is renumbered against one pool of just the strings they use
+        count = stop - start
+        string_ids = np.concatenate([getattr(table, name) for name in STRING_COLUMNS]
+                                    + [self.chat_bodies[chat_start:chat_stop]])
+        table.strings, string_ids = self.strings.subset(string_ids)
+        for i, name in enumerate(STRING_COLUMNS):
+            setattr(table, name, string_ids[i * count:(i + 1) * count])
+        table.chat_bodies = string_ids[len(STRING_COLUMNS) * count:]
+
+        table.event_types = self.event_types
+        return table
+
+    def date_range(self):
+        """
+        The first and last like, match or block.
+
+        :raises ValueError: If none of the events has a timestamp.
+        """
+        timestamps = np.concatenate([getattr(self, name) for name in TIMESTAMP_COLUMNS])
+        timestamps = timestamps[timestamps != NO_TIMESTAMP]
+        if not len(timestamps):
+            raise ValueError("No timestamped Hinge events found")
+
+        return {
+            "start_date": to_datetime(timestamps.min()),
+            "end_date": to_datetime(timestamps.max())
+        }
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [getattr(self, name) for name, _, _ in EVENT_COLUMNS]
+        arrays += [getattr(self, name) for name in TIMESTAMP_COLUMNS]
+        arrays += [self.chat_offsets, self.chat_timestamps, self.chat_bodies]
+        return sum(array.nbytes for array in arrays) + self.strings.nbytes
+
+
+class EventTableBuilder:
+    """
+    Turns decoded Hinge events into an EventTable one at a time, so the
+    events can be streamed and dropped as they're read.
+    """
+
+    def __init__(self):
+        self._columns = {name: [] for name, _, _ in EVENT_COLUMNS}
+        self._timestamps = {name: [] for name in TIMESTAMP_COLUMNS}
+        self._chat_counts = []
+        self._chat_timestamps = []
+        self._chat_bodies = []
+        self._strings = StringPool()
+        self._event_types = set()
+
+    def add(self, event: dict):
+        if not isinstance(event, dict):
+            raise ValueError("Expected every Hinge event to be a JSON object")
+
+        strings = self._strings
+        row = {name: default for name, _, default in EVENT_COLUMNS}
+        timestamps = dict.fromkeys(TIMESTAMP_COLUMNS)
+        fields = 0
+        chats = ()
+
+        for key, value in event.items():
+            self._event_types.add(key)
+            value = _decoded(value)
+            first = value[0] if isinstance(value, list) and value and isinstance(value[0], dict) else None
+
+            if key == "like":
+                fields |= EventField.LIKE
+                if first is not None:
+                    timestamps["like_timestamps"] = first.get("timestamp")
+                    row["like_comments"] = strings.add(first.get("comment"))
+
+                    content = _decoded(first.get("content"))
+                    content = content[0] if isinstance(content, list) and content else None
+                    row["like_types"] = like_type(content)
+                    if row["like_types"] == LikeType.PHOTO:
+                        row["like_media_urls"] = strings.add(content["photo"]["url"])
+                    elif row["like_types"] == LikeType.VIDEO:
+                        row["like_media_urls"] = strings.add(content["video"]["url"])
+                    elif row["like_types"] == LikeType.PROMPT:
+                        row["like_questions"] = strings.add(content["prompt"].get("question"))
+                        row["like_answers"] = strings.add(content["prompt"].get("answer"))
+            elif key == "match":
+                fields |= EventField.MATCH
+                if first is not None:
+                    timestamps["match_timestamps"] = first.get("timestamp")
+            elif key == "block":
+                fields |= EventField.BLOCK
+                if first is not None:
+                    timestamps["block_timestamps"] = first.get("timestamp")
+            elif key == "we_met":
+                fields |= EventField.WE_MET
+                if first is not None and first.get("did_meet_subject") == "Yes":
+                    fields |= EventField.MET
+            elif key == "chats":
+                if value:
+                    fields |= EventField.CHATS
+                    chats = value
+
+        row["fields"] = fields
+        for name, value in row.items():
+            self._columns[name].append(value)
+        for name, value in timestamps.items():
+            self._timestamps[name].append(value)
+
+        chats = [chat for chat in chats if isinstance(chat, dict)]
+        self._chat_counts.append(len(chats))
+        for chat in chats:
+            self._chat_timestamps.append(chat.get("timestamp"))
+            self._chat_bodies.append(strings.add(chat.get("body") or ""))
+
+    def extend(self, events: Iterable[dict]) -> "EventTableBuilder":
+        for event in events:
+            self.add(event)
+        return self
+
+    def build(self) -> EventTable:
+        table = EventTable()
+        for name, dtype, _ in EVENT_COLUMNS:
+            setattr(table, name, np.array(self._columns[name], dtype=dtype))
+        for name in TIMESTAMP_COLUMNS:
+            setattr(table, name, parse_timestamps(self._timestamps[name]))
+
+        table.chat_offsets = np.zeros(len(self._chat_counts) + 1, dtype=np.int64)
+        np.cumsum(self._chat_counts, out=table.chat_offsets[1:])
+        table.chat_timestamps = parse_timestamps(self._chat_timestamps)
+        table.chat_bodies = np.array(self._chat_bodies, dtype=np.int32)
+
+        self._strings.freeze()
+        table.strings = self._strings
+        table.event_types = frozenset(self._event_types)
+
+        return table
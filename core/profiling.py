@@ -0,0 +1,169 @@
+import asyncio
+import hmac
+import logging
+import os
+import sys
+import threading
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Optional
+from urllib.parse import parse_qsl
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "x-profile"
+PROFILE_QUERY_PARAM = "profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+# The id of the profile the current request is being sampled into, inherited
+# by the background tasks it starts
+active_profile: ContextVar[Optional[str]] = ContextVar("active_profile", default=None)
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of a single asyncio task from a background thread, at
+    a fixed interval, into collapsed stacks ("outer;inner count" lines) that
+    flamegraph.pl, speedscope and most flame graph viewers read.
+
+    Samples are only taken while the task is the one running on its loop, so
+    other requests sharing the worker don't end up in the profile, and time
+    spent awaiting doesn't either.
+    """
+
+    def __init__(self, interval: float, task: Optional[asyncio.Task] = None):
+        self.interval = interval
+        self.task = task or asyncio.current_task()
+        self.loop = self.task.get_loop()
+        self.thread_id = threading.get_ident()
+        self.stacks: Counter[str] = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    @property
+    def running(self) -> bool:
+        return self._thread.is_alive() and not self._stopped.is_set()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stopped.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            if asyncio.current_task(self.loop) is not self.task:
+                continue
+
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+
+            self.stacks[";".join(reversed(stack))] += 1
+
+
+def profile_path(name: str) -> Path:
+    return Path(config.PROFILE_DIR) / f"{name}.folded"
+
+
+def write_profile(name: str, stacks: Counter):
+    directory = Path(config.PROFILE_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    lines = [f"{stack} {count}\n" for stack, count in stacks.most_common()]
+    profile_path(name).write_text("".join(lines), encoding="utf-8")
+    logger.info("Wrote profile %s from %d samples", name, sum(stacks.values()))
+
+
+@contextmanager
+def profile_section(suffix: str):
+    """
+    Sample the enclosed code into its own profile, "<profile id>-<suffix>",
+    when it runs on behalf of a profiled request. Does nothing otherwise.
+    """
+    profile_id = active_profile.get()
+    if profile_id is None:
+        yield
+        return
+
+    profiler = SamplingProfiler(config.PROFILE_INTERVAL)
+    profiler.start()
+    try:
+        yield
+    finally:
+        write_profile(f"{profile_id}-{suffix}", profiler.stop())
+
+
+def is_profile_authorised(value: Optional[str]) -> bool:
+    return bool(value) and bool(config.PROFILE_TOKEN) and hmac.compare_digest(value, config.PROFILE_TOKEN)
+
+
+class ProfilingMiddleware:
+    """
+    Runs requests that carry the PROFILE_TOKEN, in the X-Profile header or
+    the `profile` query parameter, under a SamplingProfiler.
+
+    The profile is written to PROFILE_DIR as "<id>.folded", and its id
+    returned in the X-Profile-Id header. Background work the request starts,
+    like the person ingest of an upload, is written as "<id>-<section>.folded"
+    when it finishes.
+
+    Only added to the app when PROFILE_TOKEN is set, so it costs nothing
+    otherwise.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not self._requested(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = uuid.uuid4().hex
+        profiler = SamplingProfiler(config.PROFILE_INTERVAL)
+
+        async def send_profiled(message: Message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append(PROFILE_ID_HEADER, profile_id)
+            await send(message)
+            # Ends with the response, so background tasks aren't counted in the request
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                finish()
+
+        def finish():
+            if profiler.running:
+                write_profile(profile_id, profiler.stop())
+
+        context_token = active_profile.set(profile_id)
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_profiled)
+        finally:
+            finish()
+            active_profile.reset(context_token)
+
+    @staticmethod
+    def _requested(scope: Scope) -> bool:
+        value = Headers(scope=scope).get(PROFILE_HEADER)
+        if value is None and scope.get("query_string"):
+            value = dict(parse_qsl(scope["query_string"].decode("latin-1"))).get(PROFILE_QUERY_PARAM)
+
+        return is_profile_authorised(value)
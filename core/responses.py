@@ -0,0 +1,34 @@
+from typing import Any
+
+import orjson
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+def _default(obj: Any):
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dumps(content: Any) -> bytes:
+    """
+    Serialise the given content to JSON with orjson.
+
+    Datetimes, enums and NumPy values are handled natively, and pydantic and
+    SQLModel objects are dumped without going through `jsonable_encoder`.
+    """
+    return orjson.dumps(content, default=_default, option=OPTIONS)
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    The app-wide default response class. Renders with `dumps`.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,117 @@
+import math
+import re
+from collections import defaultdict
+from typing import Iterable, Optional
+
+TOKEN_PATTERN = re.compile(r"[-\w]+")
+
+# Roughly the words Postgres' english configuration leaves out
+STOP_WORDS = frozenset("""
+a about an and are as at be been but by can do for from had has have how i if in is it its just me my no not
+of on or our so than that the their them then there they this to too up was we were what when where which
+who will with would you your
+""".split())
+
+SUFFIXES = ("ingly", "edly", "ing", "ies", "ed", "es", "ly", "s")
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+def stem(token: str) -> str:
+    """
+    Strip a common English suffix, so "hiking", "hikes" and "hiked" match.
+    Much cruder than Postgres' Snowball stemmer, but applied the same way to
+    documents and queries.
+    """
+    for suffix in SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            token = token[:-len(suffix)]
+            break
+    return token.rstrip("e") if len(token) > 3 else token
+
+
+def tokenize(text: Optional[str]) -> list[str]:
+    if not text:
+        return []
+
+    return [stem(token) for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOP_WORDS]
+
+
+class InvertedIndex:
+    """
+    An in-memory inverted index over short documents made of weighted fields,
+    ranked with BM25. Stands in for Postgres full-text search where there is
+    none, such as on SQLite.
+
+    Queries follow `websearch_to_tsquery` loosely: every word must match, and
+    a word with a leading "-" must not.
+    """
+
+    def __init__(self):
+        self._postings: dict[str, dict[int, float]] = defaultdict(dict)
+        self._lengths: dict[int, float] = {}
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def add(self, document_id: int, fields: Iterable[tuple[Optional[str], float]]):
+        """
+        :param document_id: The id returned for matches on this document.
+        :param fields: Pairs of text and the weight of a match in it.
+        """
+        length = 0.0
+        for text, weight in fields:
+            for token in tokenize(text):
+                postings = self._postings[token]
+                postings[document_id] = postings.get(document_id, 0.0) + weight
+                length += weight
+
+        if length:
+            self._lengths[document_id] = length
+
+    def search(self, query: str) -> list[tuple[int, float]]:
+        """
+        The ids of the documents matching the query and their scores, best
+        first.
+        """
+        required, excluded = [], set()
+        for word in query.split():
+            if word.startswith("-"):
+                excluded.update(tokenize(word[1:]))
+            else:
+                required.extend(tokenize(word))
+
+        if not required:
+            return []
+
+        # Intersect from the rarest term, so the candidates shrink fastest
+        terms = sorted(set(required), key=lambda term: len(self._postings.get(term, ())))
+        candidates = set(self._postings.get(terms[0], ()))
+        for term in terms[1:]:
+            candidates.intersection_update(self._postings.get(term, ()))
+            if not candidates:
+                return []
+
+        for term in excluded:
+            candidates.difference_update(self._postings.get(term, ()))
+
+        # Nothing matched, or nothing is indexed yet, as for a user whose persons are still being saved
+        document_count = len(self._lengths)
+        if not candidates or not document_count:
+            return []
+
+        average_length = sum(self._lengths.values()) / document_count
+        scores = {}
+        for document_id in candidates:
+            length_norm = K1 * (1 - B + B * self._lengths[document_id] / average_length)
+            score = 0.0
+            for term in terms:
+                postings = self._postings[term]
+                idf = math.log(1 + (document_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                frequency = postings[document_id]
+                score += idf * frequency * (K1 + 1) / (frequency + length_norm)
+            scores[document_id] = score
+
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
@@ -0,0 +1,19 @@
+from uvicorn.workers import UvicornWorker
+
+from config import config
+
+
+class ProductionWorker(UvicornWorker):
+    """
+    The uvicorn worker gunicorn runs in production, see gunicorn.conf.py.
+
+    Uses uvloop and httptools when they're installed, as they are in the
+    Docker image, and falls back to asyncio and h11 otherwise.
+    """
+    CONFIG_KWARGS = {
+        "loop": "auto",
+        "http": "auto",
+        "limit_concurrency": config.WORKER_MAX_CONCURRENCY or None,
+        # Requests, and the ingests they started, get this long to finish once the worker is asked to stop
+        "timeout_graceful_shutdown": config.SHUTDOWN_DRAIN_SECONDS,
+    }
@@ -3,13 +3,16 @@ from sqlmodel import create_engine, Session, SQLModel
 from config import config
 
 db_url = config.DATABASE_URL
-engine = create_engine(db_url)
+engine = create_engine(db_url, pool_size=config.DB_POOL_SIZE)
 
 
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
 
 
-def get_session():
+async def get_session():
+    # Closed on the event loop rather than the threadpool. The endpoints query
+    # on the loop, and one waiting there for a free connection would otherwise
+    # block the closes that hand connections back to the pool
     with Session(engine) as session:
         yield session
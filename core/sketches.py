@@ -0,0 +1,147 @@
+import math
+from typing import Optional
+
+# Values at or below this are counted as zero, as their logarithm is unbounded
+MIN_POSITIVE_VALUE = 1e-9
+
+
+class QuantileSketch:
+    """
+    A mergeable quantile sketch over non-negative values, in the style of
+    DDSketch.
+
+    Values are counted in logarithmic buckets, so any quantile is returned
+    within `relative_accuracy` of the true value. As buckets only hold
+    counts, sketches merge by adding counts and a value can be removed again
+    exactly, which lets a user's old values be swapped for new ones.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, bins: Optional[dict[int, int]] = None,
+                 zero_count: int = 0):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins: dict[int, int] = dict(bins or {})
+        self.zero_count = zero_count
+        self._ranks = None
+
+    @property
+    def count(self) -> int:
+        return self.zero_count + sum(self.bins.values())
+
+    def key(self, value: float) -> int:
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def add(self, value: float, count: int = 1):
+        if value < 0:
+            raise ValueError("QuantileSketch only holds non-negative values")
+
+        if value <= MIN_POSITIVE_VALUE:
+            if self.zero_count + count < 0:
+                raise ValueError("Removed a value that was never added")
+            self.zero_count += count
+        else:
+            key = self.key(value)
+            bin_count = self.bins.get(key, 0) + count
+            if bin_count < 0:
+                raise ValueError("Removed a value that was never added")
+
+            if bin_count:
+                self.bins[key] = bin_count
+            else:
+                self.bins.pop(key, None)
+
+        self._ranks = None
+
+    def remove(self, value: float, count: int = 1):
+        self.add(value, -count)
+
+    def merge(self, other: "QuantileSketch"):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Can only merge sketches with the same relative accuracy")
+
+        self.zero_count += other.zero_count
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self._ranks = None
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        The value at quantile `q`, between 0 and 1.
+        """
+        total = self.count
+        if total == 0:
+            return None
+
+        rank = q * (total - 1)
+        if rank < self.zero_count:
+            return 0.0
+
+        seen = self.zero_count
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                # The bucket's midpoint, within relative_accuracy of every value in it
+                return 2 * self.gamma ** key / (self.gamma + 1)
+
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def rank(self, value: float) -> Optional[float]:
+        """
+        The fraction of values below the given one, counting half of those
+        that share its bucket. Constant time once the sketch has been
+        queried, as the cumulative counts are kept until it next changes.
+        """
+        total = self.count
+        if total == 0:
+            return None
+
+        if self._ranks is None:
+            self._ranks = self._build_ranks()
+        min_key, below = self._ranks
+
+        if value <= MIN_POSITIVE_VALUE:
+            return self.zero_count / 2 / total
+        if not self.bins:
+            return 1.0
+
+        index = self.key(value) - min_key
+        if index < 0:
+            return self.zero_count / total
+        if index >= len(below) - 1:
+            return 1.0
+
+        return (below[index] + (below[index + 1] - below[index]) / 2) / total
+
+    def _build_ranks(self):
+        """
+        The number of values below each bucket, in a dense list from the
+        lowest bucket, plus the total as its last entry.
+        """
+        if not self.bins:
+            return 0, [self.zero_count]
+
+        min_key, max_key = min(self.bins), max(self.bins)
+        below = [self.zero_count]
+        for key in range(min_key, max_key + 1):
+            below.append(below[-1] + self.bins.get(key, 0))
+
+        return min_key, below
+
+    def to_dict(self) -> dict:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "zero_count": self.zero_count,
+            "bins": {str(key): count for key, count in self.bins.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "QuantileSketch":
+        return cls(
+            relative_accuracy=data["relative_accuracy"],
+            bins={int(key): count for key, count in data.get("bins", {}).items()},
+            zero_count=data.get("zero_count", 0)
+        )
@@ -0,0 +1,226 @@
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from enum import IntEnum
+from pathlib import Path
+
+import numpy as np
+
+from config import config
+
+# Bump whenever the layout below changes. Snapshots written with another
+# version are ignored and the read paths fall back to the database.
+FORMAT_VERSION = 1
+MAGIC = b"HGSNAP"
+
+# magic, format version, data version, row count
+HEADER = struct.Struct("<6sHqq")
+
+US_PER_DAY = 86_400_000_000
+US_PER_HOUR = 3_600_000_000
+EPOCH = datetime(1970, 1, 1)
+ONE_US = timedelta(microseconds=1)
+
+
+class EventKind(IntEnum):
+    LIKE = 1
+    MATCH = 2
+    BLOCK = 3
+
+
+class EventFlag(IntEnum):
+    MATCHED = 1
+    WE_MET = 2
+    YOU_LIKED = 4
+
+
+# Column name, dtype. Stored one after the other in this order, widest
+# first so every column starts aligned.
+COLUMNS = (
+    ("timestamps", np.int64),
+    ("kinds", np.uint8),
+    ("like_types", np.uint8),
+    ("flags", np.uint8),
+)
+
+
+def to_epoch_us(timestamp: datetime) -> int:
+    # Naive timestamps are stored as-is in the database, so treat them as UTC
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return (timestamp - EPOCH) // ONE_US
+
+
+def from_epoch_us(timestamp: int) -> datetime:
+    return EPOCH + int(timestamp) * ONE_US
+
+
+def user_hash(user_id: str) -> str:
+    return hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:32]
+
+
+def snapshot_path(user_id: str) -> Path:
+    return Path(config.SNAPSHOT_DIR) / f"{user_hash(user_id)}.snap"
+
+
+class SnapshotBuilder:
+    """
+    Collects event rows during ingest and writes them out as a snapshot.
+    """
+
+    def __init__(self):
+        self._rows = {name: [] for name, _ in COLUMNS}
+
+    def extend(self, kind: EventKind, timestamps: np.ndarray, like_types, flags):
+        """
+        Add a row per epoch microsecond timestamp. `like_types` and `flags`
+        are arrays of the same length, or a value for every row.
+        """
+        count = len(timestamps)
+        self._rows["timestamps"].extend(timestamps.tolist())
+        self._rows["kinds"].extend([kind] * count)
+        self._rows["like_types"].extend(np.broadcast_to(like_types, count).tolist())
+        self._rows["flags"].extend(np.broadcast_to(flags, count).tolist())
+
+    def write(self, user_id: str):
+        """
+        Write the snapshot for the given user, replacing any previous one.
+
+        The file is written to a temporary path and renamed into place, so
+        readers only ever see a complete snapshot.
+        """
+        columns = {name: np.asarray(self._rows[name], dtype=dtype) for name, dtype in COLUMNS}
+        order = np.argsort(columns["timestamps"], kind="stable")
+        row_count = len(order)
+        data_version = time.time_ns() // 1000
+
+        path = snapshot_path(user_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(HEADER.pack(MAGIC, FORMAT_VERSION, data_version, row_count))
+                for name, _ in COLUMNS:
+                    file.write(columns[name][order].tobytes())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        return data_version
+
+
+class EventSnapshot:
+    """
+    A read-only, memory-mapped view over a user's events.
+
+    Each column is a NumPy array backed directly by the mapped file, sorted by
+    timestamp. Nothing is copied until a computation needs to.
+    """
+
+    def __init__(self, buffer: mmap.mmap, data_version: int, row_count: int):
+        self._buffer = buffer
+        self.data_version = data_version
+        self.row_count = row_count
+
+        offset = HEADER.size
+        for name, dtype in COLUMNS:
+            column = np.frombuffer(buffer, dtype=dtype, count=row_count, offset=offset)
+            setattr(self, name, column)
+            offset += column.nbytes
+
+    def __len__(self):
+        return self.row_count
+
+    def kind_mask(self, kind: EventKind) -> np.ndarray:
+        return self.kinds == kind
+
+    def has_flag(self, flag: EventFlag) -> np.ndarray:
+        return (self.flags & flag) != 0
+
+    def date_range(self):
+        if not self.row_count:
+            return {"start_date": None, "end_date": None}
+        return {
+            "start_date": from_epoch_us(self.timestamps[0]),
+            "end_date": from_epoch_us(self.timestamps[-1])
+        }
+
+    def per_day(self, mask: np.ndarray) -> float:
+        """
+        The same calculation as `utils.dates.calc_per_day`, over the masked rows.
+        """
+        timestamps = self.timestamps[mask]
+        return round(len(timestamps) / int((timestamps[-1] - timestamps[0]) // US_PER_DAY), 2)
+
+    def between(self, start_date: datetime | None, end_date: datetime | None) -> np.ndarray:
+        mask = np.ones(self.row_count, dtype=bool)
+        if start_date is not None:
+            mask &= self.timestamps >= to_epoch_us(start_date)
+        if end_date is not None:
+            mask &= self.timestamps <= to_epoch_us(end_date)
+        return mask
+
+    def buckets(self, mask: np.ndarray, interval: str) -> list[tuple[datetime, int]]:
+        """
+        Count the masked rows per "day", "week" or "month", matching Postgres'
+        date_trunc. Weeks start on Monday.
+        """
+        timestamps = self.timestamps[mask]
+        days = timestamps // US_PER_DAY
+
+        if interval == "week":
+            # 1970-01-01 was a Thursday
+            days = days - (days + 3) % 7
+        elif interval == "month":
+            days = timestamps.astype("datetime64[us]").astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+
+        buckets, counts = np.unique(days, return_counts=True)
+        return [(EPOCH + timedelta(days=int(bucket)), int(count)) for bucket, count in zip(buckets, counts)]
+
+    def hour_of_week(self, mask: np.ndarray) -> list[int]:
+        """
+        Count the masked rows per hour of the week, 0 being Sunday 00:00.
+        """
+        timestamps = self.timestamps[mask]
+        day_of_week = (timestamps // US_PER_DAY + 4) % 7
+        hour = (timestamps // US_PER_HOUR) % 24
+        return np.bincount(day_of_week * 24 + hour, minlength=7 * 24).tolist()
+
+
+def load_snapshot(user_id: str) -> EventSnapshot | None:
+    """
+    Memory-map the given user's snapshot.
+
+    :return: The snapshot, or None if there isn't one or it was written by
+        another format version.
+    """
+    try:
+        with open(snapshot_path(user_id), "rb") as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        # ValueError is raised when mapping an empty file
+        return None
+
+    if len(buffer) < HEADER.size:
+        return None
+
+    magic, format_version, data_version, row_count = HEADER.unpack_from(buffer)
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        return None
+
+    return EventSnapshot(buffer, data_version, row_count)
+
+
+def delete_snapshot(user_id: str):
+    snapshot_path(user_id).unlink(missing_ok=True)
+
+
+def delete_all_snapshots():
+    for path in Path(config.SNAPSHOT_DIR).glob("*.snap"):
+        path.unlink(missing_ok=True)
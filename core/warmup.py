@@ -0,0 +1,82 @@
+import gc
+import time
+from contextlib import ExitStack
+
+from pydantic import BaseModel
+from sqlalchemy import text
+from sqlalchemy.orm import configure_mappers
+from starlette.concurrency import run_in_threadpool
+
+import models.models
+from config import config
+from core import session as db
+from utils.dates import parse_timestamp
+
+
+def warm_db_pool(connections: int):
+    """
+    Open the given number of pooled connections at once and hand them back,
+    so the first requests find them already connected.
+    """
+    with ExitStack() as stack:
+        for _ in range(connections):
+            connection = stack.enter_context(db.engine.connect())
+            connection.execute(text("SELECT 1"))
+
+
+def warm_models():
+    """
+    Configure the ORM mappers and finish any pydantic model whose schema was
+    deferred, both of which otherwise happen on first use.
+    """
+    configure_mappers()
+
+    for model in vars(models.models).values():
+        if isinstance(model, type) and issubclass(model, BaseModel) and model is not BaseModel:
+            if not model.__pydantic_complete__:
+                model.model_rebuild()
+
+
+def warm_parsers():
+    # Imports dateparser and loads its language data
+    parse_timestamp({"timestamp": "2023-01-01 00:00:00"})
+
+
+def warm_ner_model(model_path: str):
+    from nlp.ner import load_ner_model
+
+    load_ner_model(model_path)
+
+
+async def warm_up():
+    """
+    Pay the one-off costs of a new worker at startup instead of on its first
+    requests.
+
+    Each step runs in the threadpool, the way sync endpoints and
+    dependencies do, which also starts a worker thread and loads anyio's
+    backend ahead of the first request.
+
+    :return: How long each step took, in seconds.
+    """
+    steps = [
+        ("db_pool", lambda: warm_db_pool(config.DB_POOL_SIZE)),
+        ("models", warm_models),
+        ("parsers", warm_parsers),
+    ]
+    if config.NER_MODEL_PATH:
+        steps.append(("ner_model", lambda: warm_ner_model(config.NER_MODEL_PATH)))
+
+    timings = {}
+    for name, step in steps:
+        start = time.perf_counter()
+        await run_in_threadpool(step)
+        timings[name] = time.perf_counter() - start
+
+    # Everything loaded so far lives as long as the worker. Moving it out of
+    # the collected generations keeps the first full collections, which
+    # otherwise land on early requests, from walking all of it.
+    gc.collect()
+    gc.freeze()
+
+    return timings
@@ -0,0 +1,73 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from config import config
+
+
+class IngestPool:
+    """
+    The process pool that builds ingest rows on other cores, when
+    INGEST_WORKERS is set. Started on first use, or by the startup warm-up.
+
+    Only worth it with cores to spare. On a single core the workers take
+    turns with the parent, and an ingest takes as long as it does in-process.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    # Creates a singleton. Ensuring a single instance only gets create across the app
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    cls._instance = super().__new__(cls)
+
+                    cls._instance._executor: Optional[ProcessPoolExecutor] = None
+                    cls._instance.workers = config.INGEST_WORKERS
+
+        return cls._instance
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    @property
+    def max_in_flight(self) -> int:
+        # Enough queued chunks to keep every worker busy while the parent writes
+        return self.workers * 2
+
+    def executor(self) -> Optional[ProcessPoolExecutor]:
+        """
+        The pool, or None when ingests build their rows in-process.
+        """
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            if self._executor is None:
+                # Spawned rather than forked, as the app process has threads running
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def start(self):
+        """
+        Start every worker process now, so the first ingest doesn't wait for
+        them to spawn and import the app's modules.
+        """
+        executor = self.executor()
+        if executor is not None:
+            for future in [executor.submit(os.getpid) for _ in range(self.workers)]:
+                future.result()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+ingest_pool = IngestPool()
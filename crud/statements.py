@@ -1,32 +1,239 @@
-from sqlmodel import Session, select, delete
+from datetime import datetime
+from typing import Callable
 
-from models.models import Matches, Likes, Person, UserMetaData
+from sqlalchemy import ARRAY, Float, case, exists
+from sqlalchemy.dialects.postgresql import array
+from sqlmodel import Session, select, delete, func
 
+from core.cache import bump_data_version
+from core.snapshot import delete_snapshot
+from models.models import Person, PersonMedia, Chat, UserMetaData, ConversationStats, ActivityInterval
 
-def check_existing_and_delete(user_id: str, session: Session):
-    matches_statement = select(Matches).where(Matches.user_id == user_id)
-    matches_results = session.exec(matches_statement).first()
 
-    likes_statement = select(Likes).where(Likes.user_id == user_id)
-    likes_results = session.exec(likes_statement).first()
+def check_existing_and_delete(user_id: str, session: Session, remove_metrics: Callable[[str, Session], None]):
+    """
+    Delete everything held for the user, if they have persons and metadata.
 
+    :param remove_metrics: Takes the user's values out of the percentile
+        sketches in the same transaction, such as
+        `services.percentiles.remove_user_metrics`.
+    """
     persons_statement = select(Person).where(Person.user_id == user_id)
     persons_results = session.exec(persons_statement).first()
 
     user_meta_data_statement = select(UserMetaData).where(UserMetaData.user_id == user_id)
     user_meta_data_results = session.exec(user_meta_data_statement).first()
 
-    if matches_results and likes_results and persons_results and user_meta_data_results:
-        delete_statement_matches = delete(Matches).where(Matches.user_id == user_id)
-        session.exec(delete_statement_matches)
-
-        delete_statement_likes = delete(Likes).where(Likes.user_id == user_id)
-        session.exec(delete_statement_likes)
+    if persons_results and user_meta_data_results:
+        # Cascades from person on Postgres, but deleting by user is one index range either way
+        delete_statement_chats = delete(Chat).where(Chat.user_id == user_id)
+        session.exec(delete_statement_chats)
 
+        # Takes the user's likes and matches with them
         delete_statement_persons = delete(Person).where(Person.user_id == user_id)
         session.exec(delete_statement_persons)
 
         delete_statement_user_meta_data = delete(UserMetaData).where(UserMetaData.user_id == user_id)
         session.exec(delete_statement_user_meta_data)
 
+        delete_statement_conversation_stats = delete(ConversationStats).where(ConversationStats.user_id == user_id)
+        session.exec(delete_statement_conversation_stats)
+
+        remove_metrics(user_id, session)
+
         session.commit()
+        delete_snapshot(user_id)
+        bump_data_version(user_id)
+
+
+def matches_rows():
+    """
+    Every user's Matches, read from the matched persons. A match you liked
+    first is type 1, and one they started type 2.
+
+    Filter on the columns of the returned subquery, e.g. `.c.user_id`.
+    """
+    match_type = case((Person.like_type.is_not(None), 1), else_=2)
+
+    return (select(Person.id, Person.user_id, match_type.label("type"), Person.match_timestamp.label("timestamp"))
+            .where(Person.matched.is_(True))
+            .subquery("matches"))
+
+
+def likes_rows():
+    """
+    Every user's Likes, read from the persons you liked. A like that led to
+    a match is both a like and a match person, so it's counted twice, as it
+    always has been in the stats.
+
+    Filter on the columns of the returned subquery, e.g. `.c.user_id`.
+    """
+    return (select(Person.id, Person.user_id, Person.like_type.label("type"),
+                   Person.like_timestamp.label("timestamp"))
+            .where(Person.like_type.is_not(None), Person.like_timestamp.is_not(None))
+            .subquery("likes"))
+
+
+def activity_filters(rows, user_id: str, event_type: int | None, start_date: datetime | None,
+                     end_date: datetime | None):
+    filters = [rows.user_id == user_id, rows.timestamp.is_not(None)]
+
+    if event_type is not None:
+        filters.append(rows.type == event_type)
+    if start_date is not None:
+        filters.append(rows.timestamp >= start_date)
+    if end_date is not None:
+        filters.append(rows.timestamp <= end_date)
+
+    return filters
+
+
+def select_activity_buckets(rows, interval: ActivityInterval, filters: list):
+    """
+    Count the `rows`, the columns of matches_rows or likes_rows, per day,
+    week or month, grouped in the database.
+    """
+    bucket = func.date_trunc(interval.value, rows.timestamp).label("bucket")
+
+    return (select(bucket, func.count().label("count"))
+            .where(*filters)
+            .group_by(bucket)
+            .order_by(bucket))
+
+
+def select_hour_of_week(rows, filters: list):
+    """
+    Count the `rows`, the columns of matches_rows or likes_rows, per hour of
+    the week, 0 being Sunday 00:00.
+    """
+    hour_of_week = (func.extract("dow", rows.timestamp) * 24
+                    + func.extract("hour", rows.timestamp)).label("hour_of_week")
+
+    return (select(hour_of_week, func.count().label("count"))
+            .where(*filters)
+            .group_by(hour_of_week))
+
+
+# Fractions of the time-to-match distribution reported by the funnel
+FUNNEL_PERCENTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+# Upper bounds, in seconds, of the time-to-match histogram buckets: an hour, 6 hours, a day, 3 days, a week and
+# 30 days, with one more bucket for anything longer
+TIME_TO_MATCH_BUCKETS = (3600, 21600, 86400, 259200, 604800, 2592000)
+
+
+def funnel_rows(user_id: str):
+    """
+    One row per like you sent, along with its content type, and one per match
+    that came from a like, with whether it got to a chat and a date.
+
+    The content type is a core.events.LikeType, 0 being a like with only a
+    comment.
+    """
+    # Only looked up for matches, each a probe of the chat primary key
+    chatted = case(
+        (Person.matched, exists().where(Chat.user_id == user_id, Chat.person_id == Person.id)),
+        else_=False
+    ).label("chatted")
+    time_to_match = func.extract("epoch", Person.match_timestamp - Person.like_timestamp).cast(Float)
+
+    return (select(Person.matched, Person.like_type, chatted, Person.we_met, time_to_match.label("time_to_match"))
+            .where(Person.user_id == user_id, Person.like_timestamp.is_not(None))
+            .cte("funnel"))
+
+
+def select_funnel(funnel):
+    """
+    Count the likes, matches, chats and dates of each like type. The row with
+    a null like type is every like type together.
+    """
+    matched = funnel.c.matched.is_(True)
+
+    return (select(funnel.c.like_type,
+                   func.count().filter(funnel.c.matched.is_(False)).label("liked"),
+                   func.count().filter(matched).label("matched"),
+                   func.count().filter(matched & funnel.c.chatted).label("chatted"),
+                   func.count().filter(matched & funnel.c.we_met.is_(True)).label("met"))
+            .group_by(func.rollup(funnel.c.like_type)))
+
+
+def select_time_to_match(funnel):
+    """
+    The FUNNEL_PERCENTILES of the time from like to match of each like type,
+    in seconds, and the number of matches in each TIME_TO_MATCH_BUCKETS
+    bucket. The row with a null like type is every like type together.
+
+    Only matches are sorted for the percentiles, rather than every like.
+    """
+    percentiles = (func.percentile_cont(array(FUNNEL_PERCENTILES))
+                   .within_group(funnel.c.time_to_match)
+                   .label("percentiles"))
+    # Typed so the array comes back as floats rather than Decimals
+    percentiles.type = ARRAY(Float)
+
+    bucket = func.width_bucket(funnel.c.time_to_match, array(TIME_TO_MATCH_BUCKETS))
+    bucket_counts = [func.count().filter(bucket == index).label(f"bucket_{index}")
+                     for index in range(len(TIME_TO_MATCH_BUCKETS) + 1)]
+
+    return (select(funnel.c.like_type, percentiles, *bucket_counts)
+            .where(funnel.c.time_to_match.is_not(None))
+            .group_by(func.rollup(funnel.c.like_type)))
+
+
+def select_funnel_by_like_type(user_id: str):
+    """
+    The counts of select_funnel for each like type, without the row of every
+    like type together, in SQL that any database runs.
+    """
+    matched = Person.matched.is_(True)
+    chatted = exists().where(Chat.user_id == user_id, Chat.person_id == Person.id)
+
+    def count(condition):
+        return func.sum(case((condition, 1), else_=0))
+
+    return (select(Person.like_type,
+                   count(Person.matched.is_(False)).label("liked"),
+                   count(matched).label("matched"),
+                   count(matched & chatted).label("chatted"),
+                   count(matched & Person.we_met.is_(True)).label("met"))
+            .where(Person.user_id == user_id, Person.like_timestamp.is_not(None))
+            .group_by(Person.like_type))
+
+
+def select_match_timestamps(user_id: str):
+    """
+    The like type, like timestamp and match timestamp of every match that
+    came from a like, to work out the times to match without Postgres.
+    """
+    return (select(Person.like_type, Person.like_timestamp, Person.match_timestamp)
+            .where(Person.user_id == user_id,
+                   Person.like_timestamp.is_not(None),
+                   Person.match_timestamp.is_not(None)))
+
+
+def select_export_tables(user_id: str):
+    """
+    One statement per table holding the given user's data, selecting plain
+    rows rather than ORM objects so they can be streamed.
+
+    :return: (name, statement) pairs.
+    """
+    person = Person.__table__
+    person_media = PersonMedia.__table__
+    matches = matches_rows()
+    likes = likes_rows()
+
+    return [
+        ("user_metadata", select(UserMetaData.__table__).where(UserMetaData.user_id == user_id)),
+        ("matches", select(matches).where(matches.c.user_id == user_id).order_by(matches.c.timestamp)),
+        ("likes", select(likes).where(likes.c.user_id == user_id).order_by(likes.c.timestamp)),
+        ("persons", select(person).where(person.c.user_id == user_id).order_by(person.c.id)),
+        ("person_media", select(person_media)
+         .join(person, person_media.c.person_id == person.c.id)
+         .where(person.c.user_id == user_id)
+         .order_by(person_media.c.person_id, person_media.c.kind)),
+        ("chats", select(Chat.__table__).where(Chat.user_id == user_id)
+         .order_by(Chat.person_id, Chat.timestamp, Chat.position)),
+        ("conversation_stats", select(ConversationStats.__table__)
+         .where(ConversationStats.user_id == user_id)
+         .order_by(ConversationStats.match_timestamp)),
+    ]
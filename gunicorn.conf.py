@@ -0,0 +1,24 @@
+"""
+Production server settings, read by gunicorn from the working directory:
+
+    gunicorn main:app
+
+Runs WEB_WORKERS uvicorn workers, restarting any that die. Settings given on
+the command line, or in GUNICORN_CMD_ARGS, take precedence.
+"""
+# Not imported as config, which gunicorn would take for its own setting of that name
+from config import config as service_config
+
+bind = "0.0.0.0:8000"
+workers = service_config.WEB_WORKERS
+worker_class = "core.server.ProductionWorker"
+keepalive = service_config.KEEP_ALIVE_SECONDS
+
+# A worker that doesn't check in for this long is restarted. Parsing a large
+# upload blocks its event loop for a few seconds
+timeout = 120
+# A stopping worker drains requests, then any ingests it resumed, for up to
+# SHUTDOWN_DRAIN_SECONDS each before it's killed
+graceful_timeout = service_config.SHUTDOWN_DRAIN_SECONDS * 2 + 30
+
+accesslog = "-"
@@ -0,0 +1,81 @@
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+HASH_SIZE = 8
+# The image is shrunk to this size before the DCT, as in the usual pHash
+DCT_SIZE = 32
+
+# A hash is split into this many bands for the near-duplicate lookup
+BAND_COUNT = 4
+BAND_BITS = 64 // BAND_COUNT
+
+
+@lru_cache
+def _dct_matrix(size: int) -> np.ndarray:
+    rows = np.arange(size)[:, None]
+    columns = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * columns + 1) * rows / (2 * size))
+    matrix[0] /= np.sqrt(2)
+    return matrix * np.sqrt(2 / size)
+
+
+def perceptual_hash(image: Image.Image) -> int:
+    """
+    The 64 bit perceptual hash of the given image. Copies of the same image
+    at other sizes, qualities or formats hash to the same or nearby values.
+
+    The lowest frequencies of the image's DCT are compared to their median,
+    one bit each, so the hash follows the image's overall structure rather
+    than its pixels.
+
+    Args:
+        image: The PIL image to hash.
+
+    Returns:
+        The hash, as an unsigned 64 bit integer.
+    """
+    pixels = np.asarray(
+        image.convert("L").resize((DCT_SIZE, DCT_SIZE), Image.Resampling.LANCZOS),
+        dtype=np.float64
+    )
+
+    matrix = _dct_matrix(DCT_SIZE)
+    frequencies = (matrix @ pixels @ matrix.T)[:HASH_SIZE, :HASH_SIZE].flatten()
+
+    # The DC term is the average brightness, which says nothing about structure
+    bits = frequencies > np.median(frequencies[1:])
+
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(first: int, second: int) -> int:
+    return (first ^ second).bit_count()
+
+
+def hash_bands(image_hash: int) -> list[int]:
+    """
+    The hash split into BAND_COUNT bands of BAND_BITS bits, highest first.
+    """
+    mask = (1 << BAND_BITS) - 1
+    return [(image_hash >> (BAND_BITS * (BAND_COUNT - 1 - band))) & mask for band in range(BAND_COUNT)]
+
+
+def band_probes(band: int, radius: int) -> list[int]:
+    """
+    Every band value within `radius` bits of the given one, itself included.
+    """
+    probes = {band}
+    for _ in range(radius):
+        probes |= {probe ^ (1 << bit) for probe in probes for bit in range(BAND_BITS)}
+    return sorted(probes)
+
+
+def to_signed(image_hash: int) -> int:
+    # Postgres has no unsigned 64 bit integer
+    return image_hash - (1 << 64) if image_hash >= 1 << 63 else image_hash
+
+
+def to_unsigned(image_hash: int) -> int:
+    return image_hash + (1 << 64) if image_hash < 0 else image_hash
@@ -1,29 +1,43 @@
-import json
+import asyncio
 import math
 import os
-import uuid
-from datetime import datetime
 from pathlib import Path
 from typing import List
 
-import uvicorn
 from dotenv import load_dotenv
 from fastapi import FastAPI, Depends, HTTPException, Response, UploadFile, BackgroundTasks
-from google.auth.transport import requests
-from google.oauth2 import id_token
-from jose import jwt
 from sqlmodel import Session, select, delete
 from starlette.middleware.cors import CORSMiddleware
 
+from api.routes.activity import router as activity_routes
+from api.routes.chats import router as chat_routes
+from api.routes.export import router as export_routes
+from api.routes.funnel import router as funnel_routes
 from api.routes.person import router as all_routes
+from api.routes.profiles import router as profile_routes
 from auth.auth import get_user_dep
+from config import config
+from core.admission import ingest_admission, AdmissionRejected
+from core.cache import cached_response_dep, cached_stats_response_dep, bump_all_data_versions, response_cache
+from core.compression import CompressionMiddleware
+from core.profiling import ProfilingMiddleware
+from core.responses import FastJSONResponse
+from core import session as db
 from core.session import create_db_and_tables, get_session
-from models.models import Events, HingeStats, Matches, Likes, Token, HingeStatsLikes, HingeStatsMatches, Person, \
-    UserMetaData, MatchesPerDayForGivenRange, LikesReceivedPerDayForGivenRange, FlexibleModel
-from models.tasks import TaskManager, TaskStatus
-from services.matches_likes import save_hinge_data
-from services.person import save_person_data
-from utils.dates import calc_per_day, get_date_ranges
+from core.snapshot import load_snapshot, delete_all_snapshots, EventSnapshot, EventKind, EventFlag
+from core.warmup import warm_up
+from core.workers import ingest_pool
+from crud.statements import matches_rows, likes_rows
+from models.models import HingeStats, Matches, Likes, Token, HingeStatsLikes, HingeStatsMatches, Person, \
+    UserMetaData, MatchesPerDayForGivenRange, LikesReceivedPerDayForGivenRange, ConversationStats, Chat
+from models.tasks import TaskManager, TaskStatus, save_tasks_periodically
+from services.checkpoints import checkpoint_upload_paths
+from services.ingest import (save_upload_data, finish_ingest, run_queued_ingest, resume_stale_ingests_periodically,
+                             drain_ingests)
+from services.percentiles import ensure_metric_sketches, reset_sketches, sketch_cache, user_percentiles, \
+    rebuild_sketches_periodically
+from services.uploads import spool_upload, load_events, remove_upload, remove_stale_uploads
+from utils.dates import calc_per_day
 
 # Initialise task state
 task_manager = TaskManager()
@@ -33,8 +47,13 @@ env_path = Path(".") / ".env"
 load_dotenv(env_path)
 
 # Create app
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
 app.include_router(all_routes, prefix="/api/v1")
+app.include_router(chat_routes, prefix="/api/v1")
+app.include_router(activity_routes, prefix="/api/v1")
+app.include_router(funnel_routes, prefix="/api/v1")
+app.include_router(export_routes, prefix="/api/v1")
+app.include_router(profile_routes, prefix="/api/v1")
 app.add_middleware(
     CORSMiddleware,
     allow_origins=['http://localhost:5173', 'http://127.0.0.1:5173',
@@ -44,15 +63,95 @@ app.add_middleware(
     allow_headers=["*"],
 
 )
+app.add_middleware(CompressionMiddleware, minimum_size=config.COMPRESSION_MIN_SIZE)
+if config.PROFILE_TOKEN:
+    # Outermost, so the profile covers compression too
+    app.add_middleware(ProfilingMiddleware)
 
 
 @app.on_event("startup")
 def on_startup(session: Session = Depends(get_session)):
     create_db_and_tables()
+    ensure_metric_sketches()
+
+    # Uploads with an unfinished ingest stay until it's resumed
+    with Session(db.engine) as startup_session:
+        remove_stale_uploads(keep=checkpoint_upload_paths(startup_session))
+
+
+@app.on_event("startup")
+async def on_startup_warm_up():
+    if config.WARMUP_ON_STARTUP:
+        await warm_up()
+
+
+@app.on_event("startup")
+async def on_startup_start_ingest_pool():
+    if ingest_pool.enabled:
+        # Spawning the workers blocks until they've imported the app's modules
+        await asyncio.to_thread(ingest_pool.start)
+
+
+@app.on_event("startup")
+async def on_startup_schedule_percentiles():
+    if config.PERCENTILE_REBUILD_INTERVAL:
+        # Kept on the app so the task isn't garbage collected while it sleeps
+        app.state.percentile_rebuild = asyncio.create_task(
+            rebuild_sketches_periodically(config.PERCENTILE_REBUILD_INTERVAL)
+        )
+
+
+@app.on_event("startup")
+async def on_startup_resume_ingests():
+    # Kept on the app so the task isn't garbage collected while it sleeps
+    app.state.ingest_resume = asyncio.create_task(resume_stale_ingests_periodically(config.INGEST_LEASE_SECONDS))
+
+
+@app.on_event("startup")
+async def on_startup_save_tasks():
+    # Kept on the app so the task isn't garbage collected while it sleeps
+    app.state.task_saving = asyncio.create_task(save_tasks_periodically(config.TASK_SAVE_INTERVAL))
+
+
+@app.on_event("shutdown")
+async def on_shutdown_cancel_percentiles():
+    task = getattr(app.state, "percentile_rebuild", None)
+    if task is not None:
+        task.cancel()
+
+
+@app.on_event("shutdown")
+async def on_shutdown_drain_ingests():
+    task = getattr(app.state, "ingest_resume", None)
+    if task is not None:
+        task.cancel()
+
+    # Uploads' own ingests were waited for with their requests, this covers the ones resumed from other workers
+    await drain_ingests(config.SHUTDOWN_DRAIN_SECONDS)
+
+
+@app.on_event("shutdown")
+def on_shutdown_save_tasks():
+    task = getattr(app.state, "task_saving", None)
+    if task is not None:
+        task.cancel()
+
+    # The last progress of the tasks handed over, for the workers that carry them on
+    task_manager.save_pending()
+
+
+@app.on_event("shutdown")
+def on_shutdown_stop_ingest_pool():
+    ingest_pool.shutdown()
 
 
 @app.post("/token")
 async def login_for_access_token(token: Token, response: Response):
+    # google-auth takes a while to import and is only needed to log in
+    from google.auth.transport import requests
+    from google.oauth2 import id_token
+    from jose import jwt
+
     try:
         id_info = id_token.verify_oauth2_token(
             token.id_token,
@@ -76,12 +175,17 @@ async def login_for_access_token(token: Token, response: Response):
 @app.delete("/api/v1/delete-all")
 async def delete_table_data(user_data: get_user_dep, session: Session = Depends(get_session)):
     # dev endpoint to delete all table data
-    session.exec(delete(Likes))
+    session.exec(delete(Chat))
     session.exec(delete(Person))
-    session.exec(delete(Matches))
     session.exec(delete(UserMetaData))
+    session.exec(delete(ConversationStats))
+    reset_sketches(session)
 
     session.commit()
+    delete_all_snapshots()
+    bump_all_data_versions()
+    response_cache.clear()
+    sketch_cache.clear()
 
 
 @app.post("/api/v1/upload")
@@ -92,14 +196,15 @@ async def create_upload_file(
         session: Session = Depends(get_session)
 ):
     """
-    Uploads and processes a JSON file containing 'matches' data.
+    Uploads and processes a JSON file containing 'matches' data, or the Hinge
+    data export ZIP that contains it.
 
     This endpoint reads the uploaded file, decodes its JSON content, and processes
     the data to update user metadata and save matches information in the database.
     It also triggers background tasks for processing person data.
 
     Args:
-        file (UploadFile): The uploaded JSON file containing matches data.
+        file (UploadFile): The uploaded matches JSON file, or the export ZIP.
         background_tasks (BackgroundTasks): FastAPI background task manager for
             executing tasks asynchronously.
         user_data (get_user_dep): Dependency that fetches user data from the current
@@ -108,49 +213,54 @@ async def create_upload_file(
 
     Returns:
         dict: A dictionary containing the status of the operation, file size, file name,
-        and the start and end date of the uploaded data.
+        and the start and end date of the uploaded data. When every ingest slot is
+        busy the upload is queued instead, and only the file details, task id and
+        queue position are returned.
 
     Raises:
         HTTPException: If the uploaded file content is not a valid JSON or cannot be
-        processed.
+        processed. 429 if the user already has an upload being processed, and 503
+        if the ingest queue is full, both with a Retry-After header.
     """
-    content = await file.read(file.size)
-    event_types = []
+    user_id = user_data.get("email")
 
     try:
-        raw_data = json.loads(content)
+        admitted = ingest_admission.acquire_nowait(user_id)
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail,
+                            headers={"Retry-After": str(e.retry_after)})
 
-        # Preprocess each item, wrapping its entire content in FlexibleModel
-        processed_data = [FlexibleModel(data=item) for item in raw_data]
+    task_id = task_manager.create_task()
+    if not admitted:
+        ingest_admission.enqueue(user_id, task_id)
 
-        # Create Events Model
-        events = Events(root=processed_data)
+    handed_to_background = False
+    upload_path = None
+    event_types = []
 
-        # Get date ranges
-        date_range = get_date_ranges(events)
+    try:
+        upload_path = await spool_upload(file)
 
-        # Check if user exists in database
-        statement = (select(UserMetaData)
-                     .where(UserMetaData.user_id == user_data.get("email")))
-        user_metadata = session.exec(statement).one_or_none()
+        if not admitted:
+            # Every slot is busy, so the whole ingest waits in the queue in the
+            # background. The task status reports the queue position.
+            background_tasks.add_task(run_queued_ingest, upload_path, user_id, task_id)
+            handed_to_background = True
 
-        if user_metadata is None:
-            uuid_capital = str(uuid.uuid4()).replace('-', '').upper()
-            db_user_metadata = UserMetaData(user_id=user_data.get("email"),
-                                            created_timestamp=datetime.now(),
-                                            uuid=uuid_capital,
-                                            login_timestamp=datetime.now(),
-                                            start_range_timestamp=date_range.get("start_date"),
-                                            end_range_timestamp=date_range.get("end_date"))
+            return {
+                "file_size": file.size,
+                "file_name": file.filename,
+                "hinge_event_types": None,
+                "task_id": task_id,
+                "queue_position": task_manager.get_task(task_id).queue_position,
+            }
 
-            session.add(db_user_metadata)
-            session.commit()
+        ingest_admission.start(task_id)
+        events = load_events(upload_path)
 
-        # Save matches and likes
-        save_hinge_data(events, user_data.get("email"), session)
+        save_upload_data(events, user_id, session)
 
         # Trigger background task
-        task_id = task_manager.create_task()
         task_manager.update_task(
             task_id,
             status=TaskStatus.PENDING,
@@ -158,17 +268,26 @@ async def create_upload_file(
             message="Persons processing started"
         )
 
-        background_tasks.add_task(save_person_data, events, user_data.get("email"), task_id, session)
+        # The event table is compact enough to hand to the background task,
+        # rather than parsing the spooled file again
+        background_tasks.add_task(finish_ingest, upload_path, user_id, task_id, session, events)
+        handed_to_background = True
 
-        for event in events.root:
-            for key, value in event.data.items():
-                event_types.append(key)
+        event_types = events.event_types
 
     except (ValueError, TypeError, Exception) as e:
         raise e
         # raise HTTPException(status_code=422,
         #                     detail="Unable to process file contents. Upload a valid 'matches' JSON file.")
 
+    finally:
+        if not handed_to_background:
+            remove_upload(upload_path)
+            if admitted:
+                ingest_admission.release(user_id, task_id)
+            else:
+                ingest_admission.cancel(user_id, task_id)
+
     return {
         "file_size": file.size,
         "file_name": file.filename,
@@ -178,45 +297,65 @@ async def create_upload_file(
 
 
 @app.get("/api/v1/matches", response_model=List[Matches])
-async def read_matches(user_data: get_user_dep, session: Session = Depends(get_session)):
-    statement = (select(Matches)
-                 .where(Matches.user_id == user_data.get("email"))
-                 .order_by(Matches.timestamp))
-    matches = session.exec(statement)
-    if not matches:
+async def read_matches(user_data: get_user_dep, cache: cached_response_dep, session: Session = Depends(get_session)):
+    if (cached := cache.hit()) is not None:
+        return cached
+
+    matches = matches_rows()
+    statement = (select(*matches.c)
+                 .where(matches.c.user_id == user_data.get("email"))
+                 .order_by(matches.c.timestamp))
+    rows = session.exec(statement).all()
+    if not rows:
         raise HTTPException(status_code=404, detail="Matches not found for that user")
-    return matches
+    return cache.respond([row._asdict() for row in rows])
 
 
 @app.get("/api/v1/likes", response_model=List[Likes])
-async def read_likes(user_data: get_user_dep, session: Session = Depends(get_session)):
-    statement = (select(Likes)
-                 .where(Likes.user_id == user_data.get("email"))
-                 .order_by(Likes.timestamp))
-    likes = session.exec(statement)
-    if not likes:
+async def read_likes(user_data: get_user_dep, cache: cached_response_dep, session: Session = Depends(get_session)):
+    if (cached := cache.hit()) is not None:
+        return cached
+
+    likes = likes_rows()
+    statement = (select(*likes.c)
+                 .where(likes.c.user_id == user_data.get("email"))
+                 .order_by(likes.c.timestamp))
+    rows = session.exec(statement).all()
+    if not rows:
         raise HTTPException(status_code=404, detail="Likes not found for that user")
-    return likes
+    return cache.respond([row._asdict() for row in rows])
 
 
 @app.get("/api/v1/stats", response_model=HingeStats)
-async def read_stats(user_data: get_user_dep, session: Session = Depends(get_session)):
+async def read_stats(user_data: get_user_dep, cache: cached_stats_response_dep,
+                     session: Session = Depends(get_session)):
+    if (cached := cache.hit()) is not None:
+        return cached
+
+    snapshot = load_snapshot(user_data.get("email"))
+    if snapshot is not None:
+        stats = read_stats_from_snapshot(snapshot)
+        stats.percentiles = user_percentiles(stats)
+        return cache.respond(stats)
+
     # statements
-    matches_statement = (select(Matches)
-                         .where(Matches.user_id == user_data.get("email"))
-                         .order_by(Matches.timestamp))
-    likes_statement = (select(Likes)
-                       .where(Likes.user_id == user_data.get("email"))
-                       .order_by(Likes.timestamp))
-
-    they_liked_me_statement = (select(Matches)
-                               .where(Matches.user_id == user_data.get("email"))
-                               .where(Matches.type == 2)
-                               .order_by(Matches.timestamp))
-    i_liked_them_statement = (select(Matches)
-                              .where(Matches.user_id == user_data.get("email"))
-                              .where(Matches.type == 1)
-                              .order_by(Matches.timestamp))
+    match_rows = matches_rows()
+    like_rows = likes_rows()
+    matches_statement = (select(*match_rows.c)
+                         .where(match_rows.c.user_id == user_data.get("email"))
+                         .order_by(match_rows.c.timestamp))
+    likes_statement = (select(*like_rows.c)
+                       .where(like_rows.c.user_id == user_data.get("email"))
+                       .order_by(like_rows.c.timestamp))
+
+    they_liked_me_statement = (select(*match_rows.c)
+                               .where(match_rows.c.user_id == user_data.get("email"))
+                               .where(match_rows.c.type == 2)
+                               .order_by(match_rows.c.timestamp))
+    i_liked_them_statement = (select(*match_rows.c)
+                              .where(match_rows.c.user_id == user_data.get("email"))
+                              .where(match_rows.c.type == 1)
+                              .order_by(match_rows.c.timestamp))
 
     # execute
     matches = session.exec(matches_statement).all()
@@ -261,8 +400,46 @@ async def read_stats(user_data: get_user_dep, session: Session = Depends(get_ses
             "description": "How many matches converted from total likes I sent"
         }
     )
-
-    return stats
+    stats.percentiles = user_percentiles(stats)
+
+    return cache.respond(stats)
+
+
+def read_stats_from_snapshot(snapshot: EventSnapshot):
+    matches = snapshot.kind_mask(EventKind.MATCH)
+    likes = snapshot.kind_mask(EventKind.LIKE)
+    i_liked_them = matches & snapshot.has_flag(EventFlag.YOU_LIKED)
+
+    match_count = int(matches.sum())
+    like_count = int(likes.sum())
+    i_liked_them_count = int(i_liked_them.sum())
+
+    upload_date_range = snapshot.date_range()
+
+    return HingeStats(
+        matches=HingeStatsMatches(
+            total_match_count=match_count,
+            they_liked_matched_count=match_count - i_liked_them_count,
+            i_liked_matched_count=i_liked_them_count,
+            matches_per_day_for_given_range=MatchesPerDayForGivenRange(
+                date_range=upload_date_range,
+                matches=snapshot.per_day(matches)
+            )
+        ),
+        likes=HingeStatsLikes(
+            description="Every like I have sent",
+            total_like_count=like_count,
+            likes_received_per_day_for_given_range=LikesReceivedPerDayForGivenRange(
+                date_range=upload_date_range,
+                likes=snapshot.per_day(likes)
+            )
+        ),
+        event_date_range=upload_date_range,
+        conversion_percentage={
+            "percentage": math.ceil((match_count / like_count) * 100),
+            "description": "How many matches converted from total likes I sent"
+        }
+    )
 
 
 @app.get("/api/v1/base")
@@ -271,4 +448,7 @@ async def read_base(user_data: get_user_dep):
 
 
 if __name__ == "__main__":
+    # For local development. Production runs under gunicorn, see gunicorn.conf.py
+    import uvicorn
+
     uvicorn.run("main:app", reload=True)
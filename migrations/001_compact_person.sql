@@ -0,0 +1,40 @@
+-- Compact the person table.
+--
+-- who_liked becomes a smallint (1 = Them, 2 = You), blocked a boolean and
+-- what_you_liked_prompt jsonb. The photo, video and thumbnail URLs move to
+-- the personmedia table (kind 1 = photo, 3 = video, 4 = thumbnail).
+--
+-- Run once against a database created before this change, with the app
+-- stopped:
+--
+--     psql "$DATABASE_URL" -f migrations/001_compact_person.sql
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS personmedia (
+    person_id INTEGER NOT NULL REFERENCES person (id) ON DELETE CASCADE,
+    kind SMALLINT NOT NULL,
+    url VARCHAR NOT NULL,
+    PRIMARY KEY (person_id, kind)
+);
+
+INSERT INTO personmedia (person_id, kind, url)
+SELECT id, 1, what_you_liked_photo FROM person WHERE what_you_liked_photo IS NOT NULL
+UNION ALL
+SELECT id, 3, what_you_liked_video FROM person WHERE what_you_liked_video IS NOT NULL
+UNION ALL
+SELECT id, 4, thumbnail FROM person WHERE thumbnail IS NOT NULL;
+
+ALTER TABLE person
+    ALTER COLUMN who_liked TYPE SMALLINT USING CASE who_liked WHEN 'Them' THEN 1 WHEN 'You' THEN 2 END,
+    ALTER COLUMN blocked TYPE BOOLEAN USING blocked::boolean,
+    ALTER COLUMN what_you_liked_prompt TYPE JSONB USING what_you_liked_prompt::jsonb,
+    DROP COLUMN what_you_liked_photo,
+    DROP COLUMN what_you_liked_video,
+    DROP COLUMN thumbnail;
+
+COMMIT;
+
+-- Dropped columns keep their space until the table is rewritten
+VACUUM FULL ANALYZE person;
+VACUUM ANALYZE personmedia;
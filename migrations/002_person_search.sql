@@ -0,0 +1,24 @@
+-- Full-text search over liked prompts and like comments.
+--
+-- Adds the like_comment column, and the generated search_vector column and
+-- GIN index /persons/search uses on Postgres. The expression must stay the
+-- same as models.models.PERSON_SEARCH_DOCUMENT.
+--
+-- Run once against a database created before this change, with the app
+-- stopped, as adding a stored generated column rewrites the table:
+--
+--     psql "$DATABASE_URL" -f migrations/002_person_search.sql
+
+BEGIN;
+
+ALTER TABLE person ADD COLUMN IF NOT EXISTS like_comment VARCHAR;
+
+ALTER TABLE person ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+    setweight(to_tsvector('english', coalesce(what_you_liked_prompt ->> 'answer', '')), 'A')
+    || setweight(to_tsvector('english', coalesce(like_comment, '')), 'A')
+    || setweight(to_tsvector('english', coalesce(what_you_liked_prompt ->> 'question', '')), 'B')
+) STORED;
+
+CREATE INDEX IF NOT EXISTS ix_person_search ON person USING gin (search_vector);
+
+COMMIT;
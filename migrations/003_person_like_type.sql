@@ -0,0 +1,82 @@
+-- Read matches and likes from the person table.
+--
+-- Every like and match was saved twice, once as a person and once as a row
+-- of the matches or likes table. The person table becomes the only copy:
+-- it gains the like_type column (the core.events.LikeType of your like,
+-- null for a match they started), and /matches, /likes, /stats and
+-- /activity read from it.
+--
+-- like_type is worked out the way it was when the like was saved. A photo
+-- or video like has that media, a prompt like has other media, and a like
+-- with only a comment has none. A match person was a like of yours when it
+-- has a like timestamp, and a person that isn't matched always was.
+--
+-- A user whose person ingest failed before it saved any persons gets one
+-- person per match and one per like, without their media or chats, so
+-- their likes and matches read the same as before. A user whose person
+-- ingest is still to be resumed gets the rest of them when it is. For
+-- anyone else, the migration stops before dropping the tables if the
+-- persons don't hold every one of their likes and matches. Those users
+-- are listed in the error. Delete their persons and run it again to
+-- have them filled in, or have them upload again first.
+--
+-- Run once against a database created before this change, with the app
+-- stopped:
+--
+--     psql "$DATABASE_URL" -v ON_ERROR_STOP=1 -f migrations/003_person_like_type.sql
+
+BEGIN;
+
+ALTER TABLE person ADD COLUMN IF NOT EXISTS like_type SMALLINT;
+
+UPDATE person SET like_type = CASE
+    WHEN EXISTS (SELECT FROM personmedia WHERE person_id = person.id AND kind = 1) THEN 1
+    WHEN EXISTS (SELECT FROM personmedia WHERE person_id = person.id AND kind = 3) THEN 3
+    WHEN has_media THEN 2
+    ELSE 0
+END
+WHERE matched IS NOT TRUE OR like_timestamp IS NOT NULL;
+
+-- Users whose person ingest failed before saving any persons. Those with a
+-- checkpoint are resumed instead
+CREATE TEMPORARY TABLE users_without_persons ON COMMIT DROP AS
+SELECT user_id FROM (SELECT user_id FROM matches UNION SELECT user_id FROM likes) AS saved
+WHERE NOT EXISTS (SELECT FROM person WHERE person.user_id = saved.user_id)
+  AND NOT EXISTS (SELECT FROM ingestcheckpoint WHERE ingestcheckpoint.user_id = saved.user_id);
+
+-- A match you liked first (type 1) keeps a like type, so it reads as type 1
+-- again. Its like is the separate like person, as the two can't be paired
+INSERT INTO person (user_id, matched, who_liked, like_type, match_timestamp, has_media)
+SELECT user_id, TRUE, CASE type WHEN 1 THEN 2 ELSE 1 END, CASE type WHEN 1 THEN 0 END, timestamp, FALSE
+FROM matches WHERE user_id IN (SELECT user_id FROM users_without_persons);
+
+INSERT INTO person (user_id, matched, who_liked, like_type, like_timestamp, has_media)
+SELECT user_id, FALSE, 2, type, timestamp, FALSE
+FROM likes WHERE user_id IN (SELECT user_id FROM users_without_persons);
+
+DO $$
+DECLARE
+    mismatched TEXT;
+BEGIN
+    SELECT string_agg(saved.user_id, ', ') INTO mismatched
+    FROM (SELECT user_id FROM matches UNION SELECT user_id FROM likes) AS saved
+    WHERE NOT EXISTS (SELECT FROM ingestcheckpoint WHERE ingestcheckpoint.user_id = saved.user_id)
+      AND ((SELECT count(*) FROM matches WHERE matches.user_id = saved.user_id)
+               <> (SELECT count(*) FROM person WHERE person.user_id = saved.user_id AND matched IS TRUE)
+           OR (SELECT count(*) FROM likes WHERE likes.user_id = saved.user_id)
+               <> (SELECT count(*) FROM person WHERE person.user_id = saved.user_id
+                   AND like_type IS NOT NULL AND like_timestamp IS NOT NULL));
+
+    IF mismatched IS NOT NULL THEN
+        RAISE EXCEPTION 'The persons of % are missing some of their likes or matches', mismatched
+            USING HINT = 'Delete their persons and run this again, or have them upload again first';
+    END IF;
+END $$;
+
+DROP TABLE IF EXISTS matches;
+DROP TABLE IF EXISTS likes;
+
+COMMIT;
+
+-- Every row was rewritten by the update
+VACUUM FULL ANALYZE person;
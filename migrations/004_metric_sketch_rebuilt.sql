@@ -0,0 +1,11 @@
+-- Record when the percentile sketches were last rebuilt.
+--
+-- Every web worker runs the periodic rebuild, and skips it when another
+-- worker rebuilt the sketches recently. A database created before this
+-- change lacks the column that's read from.
+--
+-- Run once against a database created before this change:
+--
+--     psql "$DATABASE_URL" -f migrations/004_metric_sketch_rebuilt.sql
+
+ALTER TABLE metricsketch ADD COLUMN IF NOT EXISTS rebuilt_timestamp TIMESTAMP WITHOUT TIME ZONE;
@@ -1,10 +1,12 @@
 import json
 from datetime import datetime
-from enum import Enum
-from typing import List, Optional, Any
+from enum import Enum, IntEnum
+from typing import List, Optional
 
-from pydantic import BaseModel, field_validator
-from sqlmodel import Field, SQLModel
+from pydantic import BaseModel
+from sqlalchemy import BigInteger, Column, DDL, ForeignKey, Integer, JSON, SmallInteger, event
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlmodel import Field, SQLModel, Relationship
 
 
 class MatchType(Enum):
@@ -14,9 +16,37 @@ class MatchType(Enum):
     BLOCK = "block"
 
 
-class WhoLiked(Enum):
-    THEM = "Them"
-    YOU = "You"
+class WhoLiked(IntEnum):
+    THEM = 1
+    YOU = 2
+
+    @property
+    def label(self):
+        return self.name.title()
+
+
+class MediaKind(IntEnum):
+    # Matches the like content types of core.events.LikeType
+    PHOTO = 1
+    VIDEO = 3
+    THUMBNAIL = 4
+
+
+class ActivityInterval(Enum):
+    DAY = "day"
+    WEEK = "week"
+    MONTH = "month"
+
+
+class ExportFormat(Enum):
+    CSV = "csv"
+    NDJSON = "ndjson"
+
+
+class PercentileMetric(Enum):
+    CONVERSION_PERCENTAGE = "conversion_percentage"
+    MATCHES_PER_DAY = "matches_per_day"
+    LIKES_PER_DAY = "likes_per_day"
 
 
 class UserMetaData(SQLModel, table=True):
@@ -33,6 +63,98 @@ class Person(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: Optional[str] = Field(index=True)
     matched: Optional[bool] = Field(None)
+    who_liked: Optional[int] = Field(default=None, sa_column=Column(SmallInteger))
+    # The core.events.LikeType of your like, null for a match you didn't like first
+    like_type: Optional[int] = Field(default=None, sa_column=Column(SmallInteger))
+    what_you_liked_prompt: Optional[dict] = Field(default=None, sa_column=Column(JSON().with_variant(JSONB(), "postgresql")))
+    like_timestamp: Optional[datetime] = None
+    match_timestamp: Optional[datetime] = None
+    we_met: Optional[bool] = None
+    blocked: Optional[bool] = None
+    has_media: Optional[bool] = None
+    like_comment: Optional[str] = None
+    media: List["PersonMedia"] = Relationship(
+        back_populates="person",
+        sa_relationship_kwargs={"cascade": "all, delete-orphan", "passive_deletes": True}
+    )
+    # name_found: Optional[str] = None
+    # ghosted: bool | None = None
+
+    def media_url(self, kind: MediaKind) -> Optional[str]:
+        return next((media.url for media in self.media if media.kind == kind), None)
+
+
+# The text search document of a Person: the answer to the prompt they liked
+# and their like comment, weighted above the prompt's question. Stored on
+# Postgres as the generated search_vector column, which isn't mapped here so
+# it's never loaded with a Person.
+PERSON_SEARCH_DOCUMENT = """
+    setweight(to_tsvector('english', coalesce(what_you_liked_prompt ->> 'answer', '')), 'A')
+    || setweight(to_tsvector('english', coalesce(like_comment, '')), 'A')
+    || setweight(to_tsvector('english', coalesce(what_you_liked_prompt ->> 'question', '')), 'B')
+"""
+
+# Postgres only, SQLite searches use the in-process index in services.search
+event.listen(Person.__table__, "after_create", DDL(
+    f"ALTER TABLE person ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ({PERSON_SEARCH_DOCUMENT}) STORED"
+).execute_if(dialect="postgresql"))
+event.listen(Person.__table__, "after_create", DDL(
+    "CREATE INDEX ix_person_search ON person USING gin (search_vector)"
+).execute_if(dialect="postgresql"))
+
+
+class PersonMedia(SQLModel, table=True):
+    """
+    Photo, video and thumbnail URLs for a Person, kept out of the person table
+    so scans over it stay narrow.
+    """
+    # A person has at most one of each kind, and the primary key doubles as
+    # the index for loading a person's media
+    person_id: Optional[int] = Field(
+        default=None,
+        sa_column=Column(Integer, ForeignKey("person.id", ondelete="CASCADE"), primary_key=True)
+    )
+    kind: int = Field(sa_column=Column(SmallInteger, primary_key=True))
+    url: str
+    person: Optional[Person] = Relationship(back_populates="media")
+
+
+class Chat(SQLModel, table=True):
+    """
+    A message from a Person's conversation. The primary key doubles as the
+    (user_id, person_id, timestamp) index, so a page of a conversation is
+    one range of it, and the table needs no other index.
+    """
+    user_id: str = Field(primary_key=True)
+    person_id: int = Field(
+        sa_column=Column(Integer, ForeignKey("person.id", ondelete="CASCADE"), primary_key=True)
+    )
+    timestamp: datetime = Field(primary_key=True)
+    # The message's place in the conversation, for messages sent in the same instant
+    position: int = Field(sa_column=Column(SmallInteger, primary_key=True))
+    body: str
+
+
+class ChatMessage(BaseModel):
+    timestamp: datetime
+    body: str
+
+
+class ChatPage(BaseModel):
+    person_id: int
+    messages: List[ChatMessage]
+    # Pass as `cursor` to get the following page, None on the last page
+    next_cursor: Optional[str] = None
+
+
+class PersonRead(BaseModel):
+    """
+    A Person as returned by the API, in the shape it had before the media
+    moved to PersonMedia.
+    """
+    id: Optional[int] = None
+    user_id: Optional[str] = None
+    matched: Optional[bool] = None
     who_liked: Optional[str] = None
     what_you_liked_photo: Optional[str] = None
     what_you_liked_prompt: Optional[str] = None
@@ -40,11 +162,34 @@ class Person(SQLModel, table=True):
     like_timestamp: Optional[datetime] = None
     match_timestamp: Optional[datetime] = None
     we_met: Optional[bool] = None
-    blocked: Optional[str] = None
+    blocked: Optional[bool] = None
     has_media: Optional[bool] = None
-    thumbnail: Optional[str] = Field()
-    # name_found: Optional[str] = None
-    # ghosted: bool | None = None
+    thumbnail: Optional[str] = None
+    like_comment: Optional[str] = None
+
+    @classmethod
+    def from_person(cls, person: Person):
+        return cls(
+            id=person.id,
+            user_id=person.user_id,
+            matched=person.matched,
+            who_liked=WhoLiked(person.who_liked).label if person.who_liked is not None else None,
+            what_you_liked_photo=person.media_url(MediaKind.PHOTO),
+            what_you_liked_prompt=(json.dumps(person.what_you_liked_prompt)
+                                   if person.what_you_liked_prompt is not None else None),
+            what_you_liked_video=person.media_url(MediaKind.VIDEO),
+            like_timestamp=person.like_timestamp,
+            match_timestamp=person.match_timestamp,
+            we_met=person.we_met,
+            blocked=person.blocked,
+            has_media=person.has_media,
+            thumbnail=person.media_url(MediaKind.THUMBNAIL),
+            like_comment=person.like_comment
+        )
+
+
+class PersonSearchResult(PersonRead):
+    rank: Optional[float] = None
 
 
 class PersonTaskResult(BaseModel):
@@ -54,49 +199,118 @@ class PersonTaskResult(BaseModel):
     progress: float
 
 
-class Matches(SQLModel, table=True):
-    id: int = Field(default=None, primary_key=True)
-    user_id: str = Field(index=True)
-    type: int = Field(index=True)
-    timestamp: Optional[datetime] = Field(None)
+class IngestCheckpoint(SQLModel, table=True):
+    """
+    How far a person ingest has got, committed with each chunk of persons.
+    A row only exists while the ingest is unfinished, and one that stops
+    being updated is picked up and resumed by any worker.
+    """
+    task_id: str = Field(primary_key=True)
+    user_id: str
+    # The spooled upload, kept until the ingest finishes
+    upload_path: Optional[str] = None
+    total_events: int
+    # Every event before this one has had its persons committed
+    next_event: int = 0
+    owner: Optional[str] = None
+    updated_timestamp: datetime = Field(index=True)
+
+
+class UploadTask(SQLModel, table=True):
+    """
+    The last reported state of an upload's task, so any worker can answer
+    progress requests for it, not just the one running it. Kept for
+    TASK_RETENTION_SECONDS after its last update.
+    """
+    task_id: str = Field(primary_key=True)
+    status: str
+    progress: float = 0.0
+    message: Optional[str] = None
+    queue_position: Optional[int] = None
+    updated_timestamp: datetime = Field(index=True)
 
 
-class Likes(SQLModel, table=True):
-    id: int = Field(default=None, primary_key=True)
-    user_id: str = Field(index=True)
-    type: int = Field(index=True)
-    timestamp: datetime
+class UserMetrics(SQLModel, table=True):
+    """
+    The values a user last added to the cross-user percentile sketches, so
+    they can be taken out again when the user uploads new data.
+    """
+    user_id: str = Field(primary_key=True)
+    conversion_percentage: Optional[float] = None
+    matches_per_day: Optional[float] = None
+    likes_per_day: Optional[float] = None
+    updated_timestamp: Optional[datetime] = None
 
 
-class FlexibleModel(BaseModel):
+class MetricSketch(SQLModel, table=True):
     """
-    A recursive model that can parse nested JSON structures of unknown depth
+    A serialised `core.sketches.QuantileSketch` of one PercentileMetric
+    across every user.
     """
-    data: Any = Field(default_factory=dict)
+    metric: str = Field(primary_key=True)
+    sketch: dict = Field(sa_column=Column(JSON().with_variant(JSONB(), "postgresql"), nullable=False))
+    updated_timestamp: Optional[datetime] = None
+    # When it was last rebuilt from every user's values, by any worker
+    rebuilt_timestamp: Optional[datetime] = None
 
-    @field_validator("data", mode="before")
-    def parse_nested_json(cls, value):
-        return cls.parse_nested(value)
 
-    @staticmethod
-    def parse_nested(value):
-        def recursive_parse(item):
-            if isinstance(item, str):
-                try:
-                    return recursive_parse(json.loads(item))
-                except (json.JSONDecodeError, TypeError):
-                    return item
-            elif isinstance(item, dict):
-                return {k: recursive_parse(v) for k, v in item.items()}
-            elif isinstance(item, list):
-                return [recursive_parse(i) for i in item]
-            return item
+class StoredThumbnail(SQLModel, table=True):
+    """
+    A thumbnail kept in THUMBNAIL_DIR, with the perceptual hash of the image
+    it was made from. Near-duplicate images share one.
 
-        return recursive_parse(value)
+    The hash is also stored as four 16 bit bands, each indexed, for the
+    near-duplicate lookup in `services.thumbnails`.
+    """
+    id: Optional[int] = Field(default=None, primary_key=True)
+    phash: int = Field(sa_column=Column(BigInteger, nullable=False))
+    band_0: int = Field(index=True)
+    band_1: int = Field(index=True)
+    band_2: int = Field(index=True)
+    band_3: int = Field(index=True)
+    image_format: str
+    file_name: str
+    created_timestamp: Optional[datetime] = None
 
 
-class Events(BaseModel):
-    root: List[FlexibleModel]
+class ThumbnailSource(SQLModel, table=True):
+    """
+    An image URL a thumbnail has been made for, so asking again skips the
+    fetch.
+    """
+    url: str = Field(primary_key=True)
+    thumbnail_id: int = Field(foreign_key="storedthumbnail.id", index=True)
+
+
+# Matches and likes are no longer tables of their own, but read from the
+# person rows they came from, see crud.statements.matches_rows and likes_rows.
+# The id is that of the person.
+class Matches(SQLModel):
+    id: int
+    user_id: str
+    # 1 you liked them first, 2 they liked you
+    type: int
+    timestamp: Optional[datetime] = None
+
+
+class Likes(SQLModel):
+    id: int
+    user_id: str
+    # The core.events.LikeType
+    type: int
+    timestamp: datetime
+
+
+class ConversationStats(SQLModel, table=True):
+    id: int = Field(default=None, primary_key=True)
+    user_id: str = Field(index=True)
+    match_timestamp: Optional[datetime] = Field(None)
+    message_count: int = 0
+    median_reply_gap: Optional[float] = None
+    p90_reply_gap: Optional[float] = None
+    time_to_first_message: Optional[float] = None
+    conversation_length: Optional[float] = None
+    ghosted: bool = False
 
 
 class Token(BaseModel):
@@ -149,8 +363,81 @@ class HingeStatsLikes(BaseModel):
     likes_received_per_day_for_given_range: LikesReceivedPerDayForGivenRange | None = None
 
 
+class HingeStatsPercentiles(BaseModel):
+    description: str | None = None
+    compared_user_count: int | None = None
+    conversion_percentage: float | None = None
+    matches_per_day: float | None = None
+    likes_per_day: float | None = None
+
+
 class HingeStats(BaseModel):
     matches: HingeStatsMatches | None = None
     likes: HingeStatsLikes | None = None
     event_date_range: dict | None = None
     conversion_percentage: dict | None = None
+    percentiles: HingeStatsPercentiles | None = None
+
+
+class HingeChatStatsSummary(BaseModel):
+    conversation_count: int | None = None
+    message_count: int | None = None
+    ghosted_count: int | None = None
+    ghosted_percentage: float | None = None
+    median_reply_gap: float | None = None
+    median_time_to_first_message: float | None = None
+
+
+class HingeChatStats(BaseModel):
+    summary: HingeChatStatsSummary | None = None
+    conversations: List[ConversationStats] | None = None
+
+
+class HingeFunnelStage(BaseModel):
+    stage: str
+    count: int
+    percentage_of_previous: float | None = None
+    percentage_of_likes: float | None = None
+
+
+class HingeTimeToMatchBucket(BaseModel):
+    # In seconds, None for the last bucket
+    up_to: float | None = None
+    count: int
+
+
+class HingeTimeToMatch(BaseModel):
+    match_count: int
+    percentiles: dict[str, float] | None = None
+    buckets: List[HingeTimeToMatchBucket] | None = None
+
+
+class HingeFunnelBreakdown(BaseModel):
+    # None for every like type together
+    like_type: int | None = None
+    stages: List[HingeFunnelStage]
+    time_to_match: HingeTimeToMatch
+
+
+class HingeFunnel(BaseModel):
+    description: str | None = None
+    overall: HingeFunnelBreakdown
+    like_types: List[HingeFunnelBreakdown]
+
+
+class ActivityBucket(BaseModel):
+    bucket: datetime
+    count: int
+
+
+class HingeActivityHourOfWeek(BaseModel):
+    description: str | None = None
+    likes: List[int] | None = None
+    matches: List[int] | None = None
+
+
+class HingeActivity(BaseModel):
+    interval: ActivityInterval
+    likes: List[ActivityBucket] | None = None
+    matches: List[ActivityBucket] | None = None
+    hour_of_week: HingeActivityHourOfWeek | None = None
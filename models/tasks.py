@@ -1,16 +1,32 @@
+import asyncio
 import json
+import logging
 import threading
+import time
 import uuid
 from dataclasses import dataclass
+from datetime import datetime, timedelta
 from enum import Enum
 from typing import Optional, Dict
 
+from sqlmodel import Session, delete
+
+from config import config
+from core import session as db
+from models.models import UploadTask
+
+logger = logging.getLogger(__name__)
+
+# Seconds between prunes of the tasks past TASK_RETENTION_SECONDS
+TASK_PRUNE_INTERVAL = 60 * 60
+
 
 class TaskStatus(Enum):
     PENDING = "pending"
     COMPLETED = "completed"
     FAILED = "failed"
     PROCESSING = "processing"
+    QUEUED = "queued"
 
 
 @dataclass
@@ -19,12 +35,14 @@ class TaskInfo:
     status: TaskStatus = TaskStatus.PENDING
     progress: float = 0.0
     message: str = None
+    queue_position: Optional[int] = None
 
     def update(
             self,
             status: Optional[TaskStatus] = None,
             progress: Optional[float] = None,
-            message: Optional[str] = None
+            message: Optional[str] = None,
+            queue_position: Optional[int] = None
     ):
 
         if status is not None:
@@ -36,12 +54,16 @@ class TaskInfo:
         if message is not None:
             self.message = message
 
+        if queue_position is not None:
+            self.queue_position = queue_position
+
     def to_dict(self):
         return {
             'task_id': self.task_id,
             'status': self.status.value,
             'progress': self.progress,
-            'message': self.message
+            'message': self.message,
+            'queue_position': self.queue_position
         }
 
     def to_json(self):
@@ -50,6 +72,13 @@ class TaskInfo:
 
 # TODO: Is a singleton actually a good idea? Hundreds of uploads could occur at the same time
 class TaskManager:
+    """
+    The tasks this worker is running, also written to the UploadTask table
+    where the other workers look up the ones they aren't running. A status
+    change is written straight away, while progress is written at most every
+    TASK_SAVE_INTERVAL seconds, by the task's next update or by
+    `save_tasks_periodically`.
+    """
     _instance = None
     _lock = threading.Lock()
 
@@ -61,35 +90,149 @@ class TaskManager:
                     cls._instance = super().__new__(cls)
 
                     cls._instance._tasks: Dict[str, TaskInfo] = {}
+                    # When each task was last written, on the monotonic clock
+                    cls._instance._saved_at: Dict[str, float] = {}
+                    # Tasks updated since they were last written
+                    cls._instance._unsaved: set[str] = set()
 
         return cls._instance
 
-    def create_task(self):
+    def create_task(self, task_id: Optional[str] = None):
+        """
+        :param task_id: The id of a task carried over from another worker, such
+            as a resumed ingest. A new one is made up when not given.
+        """
         with self._lock:
-            task_id = str(uuid.uuid4()).replace('-', '').upper()
+            task_id = task_id or str(uuid.uuid4()).replace('-', '').upper()
             task_info = TaskInfo(task_id=task_id)
 
             self._tasks[task_id] = task_info
+            self._saved_at[task_id] = time.monotonic()
 
-            return task_id
+        self._save([task_info])
+        return task_id
 
     def update_task(
             self,
             task_id: str,
             status: Optional[TaskStatus] = None,
             progress: Optional[float] = None,
-            message: Optional[str] = None
+            message: Optional[str] = None,
+            queue_position: Optional[int] = None
     ):
         with self._lock:
             if task_id not in self._tasks:
                 KeyError(f"Task {task_id} not found")
 
             task = self._tasks[task_id]
-            task.update(status=status, progress=progress, message=message)
+            status_changed = status is not None and status != task.status
+            task.update(status=status, progress=progress, message=message, queue_position=queue_position)
+
+            now = time.monotonic()
+            if not status_changed and now - self._saved_at.get(task_id, 0.0) < config.TASK_SAVE_INTERVAL:
+                self._unsaved.add(task_id)
+                return
+
+            self._unsaved.discard(task_id)
+            self._saved_at[task_id] = now
+
+        self._save([task])
+
+    def forget_task(self, task_id: str):
+        """
+        Stop tracking a task another worker has taken over, so its lookups
+        and writes are left to that worker.
+        """
+        with self._lock:
+            self._tasks.pop(task_id, None)
+            self._saved_at.pop(task_id, None)
+            self._unsaved.discard(task_id)
 
     def get_task(self, task_id: str):
         with self._lock:
-            return self._tasks.get(task_id)
+            task = self._tasks.get(task_id)
+
+        return task if task is not None else self._load(task_id)
+
+    def save_pending(self):
+        """
+        Write the tasks updated since they were last written.
+        """
+        with self._lock:
+            tasks = [self._tasks[task_id] for task_id in self._unsaved]
+            self._unsaved.clear()
+
+            now = time.monotonic()
+            for task in tasks:
+                self._saved_at[task.task_id] = now
+
+        if tasks:
+            self._save(tasks)
+
+    def prune(self):
+        """
+        Forget the tasks past TASK_RETENTION_SECONDS. Finished ones are only
+        dropped from memory once they've been written.
+        """
+        with Session(db.engine) as session:
+            cutoff = datetime.now() - timedelta(seconds=config.TASK_RETENTION_SECONDS)
+            session.exec(delete(UploadTask).where(UploadTask.updated_timestamp < cutoff))
+            session.commit()
+
+        with self._lock:
+            cutoff = time.monotonic() - config.TASK_RETENTION_SECONDS
+            for task_id, saved_at in list(self._saved_at.items()):
+                task = self._tasks[task_id]
+                finished = task.status in (TaskStatus.COMPLETED, TaskStatus.FAILED)
+                if finished and saved_at < cutoff and task_id not in self._unsaved:
+                    del self._tasks[task_id]
+                    del self._saved_at[task_id]
+
+    @staticmethod
+    def _save(tasks: list[TaskInfo]):
+        now = datetime.now()
+        with Session(db.engine) as session:
+            for task in tasks:
+                session.merge(UploadTask(
+                    task_id=task.task_id,
+                    status=task.status.value,
+                    progress=task.progress,
+                    message=task.message,
+                    queue_position=task.queue_position,
+                    updated_timestamp=now
+                ))
+            session.commit()
+
+    @staticmethod
+    def _load(task_id: str) -> Optional[TaskInfo]:
+        with Session(db.engine) as session:
+            row = session.get(UploadTask, task_id)
+
+        if row is None:
+            return None
+
+        return TaskInfo(task_id=row.task_id, status=TaskStatus(row.status), progress=row.progress,
+                        message=row.message, queue_position=row.queue_position)
 
 
 task_manager = TaskManager()
+
+
+async def save_tasks_periodically(interval: float):
+    """
+    Write the progress the tasks made since their last write every
+    `interval` seconds, and prune the expired ones every TASK_PRUNE_INTERVAL,
+    off the event loop.
+    """
+    pruned_at = 0.0
+    while True:
+        try:
+            await asyncio.to_thread(task_manager.save_pending)
+
+            if time.monotonic() - pruned_at >= TASK_PRUNE_INTERVAL:
+                await asyncio.to_thread(task_manager.prune)
+                pruned_at = time.monotonic()
+        except Exception:
+            logger.exception("Saving upload tasks failed")
+
+        await asyncio.sleep(interval)
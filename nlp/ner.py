@@ -0,0 +1,19 @@
+from functools import lru_cache
+from pathlib import Path
+
+DEFAULT_MODEL_PATH = Path("nlp-output") / "model-best"
+
+
+@lru_cache(maxsize=None)
+def load_ner_model(model_path: Path = DEFAULT_MODEL_PATH):
+    """
+    Load the trained names NER pipeline, once per process.
+
+    spaCy is only imported here, so nothing pays for it until a model is
+    actually needed.
+
+    :param model_path: The directory the pipeline was saved to.
+    """
+    import spacy
+
+    return spacy.load(model_path)
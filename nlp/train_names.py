@@ -1,28 +1,33 @@
+import argparse
 import csv
 import os
 import random
+from concurrent.futures import ProcessPoolExecutor, ALL_COMPLETED, FIRST_COMPLETED, wait
+from itertools import islice
+from pathlib import Path
 
 import spacy
 from spacy.tokens import DocBin
 from tqdm import tqdm
 
-nlp = spacy.blank("en")
-db = DocBin()
-TRAIN_DATA = []
+from nlp.ner import DEFAULT_MODEL_PATH, load_ner_model
 
+DEFAULT_SHARD_SIZE = 50_000
 
-def load_or_create_ner():
-    if True:
-        nlp1 = spacy.load(r".\nlp-output\model-best")
-        doc = nlp1(
-            "sup Gemma what is happening? Sophie and i are going to see Olivia")
-        for blah in doc.ents:
-            print(blah.label_, blah.text)
-    else:
-        create_ner()
+# Blank pipeline used by each worker process. Created lazily so importing
+# this module does not build a spaCy pipeline.
+_nlp = None
 
 
-def fluff(person: str):
+def load_or_create_ner(model_path: Path = DEFAULT_MODEL_PATH):
+    nlp1 = load_ner_model(model_path)
+    doc = nlp1(
+        "sup Gemma what is happening? Sophie and i are going to see Olivia")
+    for blah in doc.ents:
+        print(blah.label_, blah.text)
+
+
+def fluff(person: str, rng: random.Random = random):
     random_fluff = [
         "Hi {}",
         "Hey {}, how are you?",
@@ -32,11 +37,9 @@ def fluff(person: str):
         "Yes {}",
         "No {}"
     ]
-    choice: str = random.choice(random_fluff).format(person)
-    choice.lower().strip(",.?!")
+    choice: str = rng.choice(random_fluff).format(person)
     start = choice.find(person)
     end = start + len(person)
-    print(choice, start, end)
 
     return (
         choice,
@@ -44,23 +47,164 @@ def fluff(person: str):
     )
 
 
-def create_ner():
-    with open('names.csv', mode='r') as file:
-        csv_file = csv.reader(file)
-        for lines in csv_file:
-            TRAIN_DATA.append(fluff(lines[2]))
+def iter_names(csv_path: Path, column: int = 2):
+    """
+    Stream names from the given CSV file, one row at a time.
+
+    :param csv_path: The CSV file containing the names.
+    :param column: The index of the column holding the name.
+    """
+    with open(csv_path, mode='r', newline='', encoding='utf-8') as file:
+        for line in csv.reader(file):
+            if len(line) > column and line[column]:
+                yield line[column]
+
+
+def iter_shards(names, shard_size: int):
+    names = iter(names)
+    while shard := list(islice(names, shard_size)):
+        yield shard
+
+
+def _get_nlp():
+    global _nlp
+    if _nlp is None:
+        _nlp = spacy.blank("en")
+    return _nlp
+
 
-    for text, annot in tqdm(TRAIN_DATA):
+def build_shard(shard_index: int, names: list, output_dir: Path, shard_seed: int):
+    """
+    Build a single DocBin from the given names and write it to disk.
+
+    Runs inside a worker process. Each shard gets its own seeded random
+    generator so the output is reproducible regardless of scheduling.
+
+    :param shard_seed: The shard's own seed, drawn from the run's seed.
+
+    :return: A tuple of the shard path, docs written and entities skipped.
+    """
+    nlp = _get_nlp()
+    rng = random.Random(shard_seed)
+    db = DocBin(attrs=["ENT_IOB", "ENT_TYPE"])
+    skipped = 0
+
+    for name in names:
+        text, annot = fluff(name, rng)
         doc = nlp.make_doc(text)
         ents = []
         for start, end, label in annot['entities']:
             span = doc.char_span(start, end, label=label, alignment_mode="contract")
             if span is None:
-                print("Skipping entity")
+                skipped += 1
             else:
                 ents.append(span)
         doc.ents = ents
         db.add(doc)
 
-    os.chdir(r'./')
-    db.to_disk("./train.spacy")
+    shard_path = output_dir / f"train-{shard_index:05d}.spacy"
+    db.to_disk(shard_path)
+
+    return shard_path, len(db), skipped
+
+
+def create_ner(
+        input_path: Path,
+        output_dir: Path,
+        shard_size: int = DEFAULT_SHARD_SIZE,
+        workers: int | None = None,
+        seed: int = 0,
+        overwrite: bool = False
+):
+    """
+    Build the NER training set from a CSV of names.
+
+    The CSV is streamed and split into shards of `shard_size` names, which are
+    turned into DocBin files across a process pool. At most two shards per
+    worker are held in memory at once, so memory stays bounded however large
+    the input is. The output directory can be passed straight to
+    `spacy train` as `--paths.train`, as the corpus reader loads every
+    .spacy file in it.
+
+    :param input_path: The CSV file containing the names.
+    :param output_dir: The directory to write the DocBin shards to.
+    :param shard_size: The number of names per shard.
+    :param workers: The number of worker processes. Defaults to the CPU count.
+    :param seed: The seed used to pick the example sentences.
+    :param overwrite: Remove the shards of an earlier run from `output_dir`
+        first. Otherwise their presence is an error, as `spacy train` would
+        train on any left over from a larger run.
+    :return: A tuple of the total docs written and entities skipped.
+    :raises FileExistsError: If `output_dir` already holds shards and
+        `overwrite` isn't set.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    existing_shards = sorted(output_dir.glob("train-*.spacy"))
+    if existing_shards and not overwrite:
+        raise FileExistsError(f"{output_dir} already holds {len(existing_shards)} training shards")
+    for shard_path in existing_shards:
+        shard_path.unlink()
+
+    # Each shard's seed is drawn from the run's, rather than offset from it,
+    # so runs with nearby seeds don't share shard streams
+    shard_seeds = random.Random(seed)
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = workers * 2
+
+    total_docs = 0
+    total_skipped = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as executor, tqdm(unit="docs") as progress:
+        pending = set()
+
+        def drain(return_when):
+            nonlocal pending, total_docs, total_skipped
+            done, pending = wait(pending, return_when=return_when)
+            for future in done:
+                _, docs, skipped = future.result()
+                total_docs += docs
+                total_skipped += skipped
+                progress.update(docs)
+
+        for shard_index, names in enumerate(iter_shards(iter_names(input_path), shard_size)):
+            if len(pending) >= max_in_flight:
+                drain(FIRST_COMPLETED)
+            pending.add(executor.submit(build_shard, shard_index, names, output_dir, shard_seeds.getrandbits(64)))
+
+        if pending:
+            drain(ALL_COMPLETED)
+
+    if total_skipped:
+        print(f"Skipped {total_skipped} entities that did not align to token boundaries")
+
+    return total_docs, total_skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the spaCy NER training set from a CSV of names.")
+    parser.add_argument("--input", type=Path, default=Path("names.csv"),
+                        help="CSV file with a name in the third column")
+    parser.add_argument("--output", type=Path, default=Path("train"),
+                        help="directory to write the .spacy shards to")
+    parser.add_argument("--shard-size", type=int, default=DEFAULT_SHARD_SIZE,
+                        help="number of names per DocBin shard")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes (defaults to the CPU count)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--overwrite", action="store_true",
+                        help="remove the .spacy shards of an earlier run from the output directory first")
+    args = parser.parse_args(argv)
+
+    if args.shard_size < 1:
+        parser.error("--shard-size must be at least 1")
+
+    try:
+        total_docs, _ = create_ner(args.input, args.output, args.shard_size, args.workers, args.seed,
+                                   args.overwrite)
+    except FileExistsError as e:
+        parser.error(f"{e}. Pass --overwrite to replace them")
+    print(f"Wrote {total_docs} docs to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import math
+from datetime import datetime, timezone
+
+from sqlmodel import Session, delete
+
+from core.events import EventTable
+from models.models import ConversationStats
+from utils.chats import get_chat_metrics
+
+
+def _optional(value: float):
+    return None if math.isnan(value) else value
+
+
+def save_chat_stats(events: EventTable, user_id: str, session: Session):
+    """
+    Compute the conversation metrics for every match and save them to the database.
+
+    Any stats from a previous upload are replaced.
+
+    :param events: The EventTable to compute the metrics from.
+    :param user_id: The user_id to associate with the ConversationStats.
+    :param session: The session to use to communicate with the database.
+    """
+    metrics = get_chat_metrics(events)
+
+    session.exec(delete(ConversationStats).where(ConversationStats.user_id == user_id))
+
+    columns = zip(
+        metrics.match_timestamps.tolist(),
+        metrics.message_count.tolist(),
+        metrics.median_reply_gap.tolist(),
+        metrics.p90_reply_gap.tolist(),
+        metrics.time_to_first_message.tolist(),
+        metrics.conversation_length.tolist(),
+        metrics.ghosted.tolist()
+    )
+    session.add_all(
+        ConversationStats(
+            user_id=user_id,
+            match_timestamp=datetime.fromtimestamp(match_timestamp, timezone.utc).replace(tzinfo=None),
+            message_count=message_count,
+            median_reply_gap=_optional(median_reply_gap),
+            p90_reply_gap=_optional(p90_reply_gap),
+            time_to_first_message=_optional(time_to_first_message),
+            conversation_length=_optional(conversation_length),
+            ghosted=ghosted
+        )
+        for (match_timestamp, message_count, median_reply_gap, p90_reply_gap,
+             time_to_first_message, conversation_length, ghosted) in columns
+    )
+
+    session.commit()
+
@@ -0,0 +1,137 @@
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+from sqlmodel import Session, select, update
+
+from models.models import IngestCheckpoint
+
+# Identifies this worker process as the owner of the ingests it runs
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def open_checkpoint(task_id: str, user_id: str, upload_path: Optional[Path], total_events: int,
+                    session: Session) -> IngestCheckpoint:
+    """
+    The task's checkpoint, created on its first run. A resumed task gets the
+    one it left behind, and carries on from its `next_event`.
+    """
+    checkpoint = session.get(IngestCheckpoint, task_id)
+    if checkpoint is None:
+        checkpoint = IngestCheckpoint(task_id=task_id,
+                                      user_id=user_id,
+                                      upload_path=str(upload_path) if upload_path is not None else None,
+                                      total_events=total_events)
+
+    checkpoint.owner = WORKER_ID
+    checkpoint.updated_timestamp = datetime.now()
+    session.add(checkpoint)
+    session.commit()
+    session.refresh(checkpoint)
+
+    return checkpoint
+
+
+class CheckpointLost(Exception):
+    """
+    The ingest's checkpoint was taken over by another worker, which carries
+    on with the ingest from there.
+    """
+
+
+def commit_chunk(task_id: str, expected_event: int, next_event: int, session: Session):
+    """
+    Commit the pending persons together with the checkpoint. Either both or
+    neither are saved, so a resumed ingest never adds a chunk twice.
+
+    The checkpoint only moves while this worker still owns it and it's still
+    at `expected_event`, the end of the previous chunk. Otherwise the chunk is
+    rolled back, as another worker has claimed the ingest and is saving the
+    same events.
+
+    :raises CheckpointLost: If the checkpoint was taken over.
+    """
+    statement = (update(IngestCheckpoint)
+                 .where(IngestCheckpoint.task_id == task_id)
+                 .where(IngestCheckpoint.owner == WORKER_ID)
+                 .where(IngestCheckpoint.next_event == expected_event)
+                 .values(next_event=next_event, updated_timestamp=datetime.now()))
+
+    if session.execute(statement).rowcount != 1:
+        session.rollback()
+        raise CheckpointLost(f"Ingest {task_id} was taken over by another worker")
+
+    session.commit()
+
+
+def drop_checkpoint(task_id: str, session: Session):
+    checkpoint = session.get(IngestCheckpoint, task_id)
+    if checkpoint is not None:
+        session.delete(checkpoint)
+        session.commit()
+
+
+def checkpoint_upload_paths(session: Session) -> set[Path]:
+    statement = select(IngestCheckpoint.upload_path).where(IngestCheckpoint.upload_path.is_not(None))
+    return {Path(path) for path in session.exec(statement).all()}
+
+
+def find_stale_checkpoints(lease_seconds: int, session: Session) -> list[IngestCheckpoint]:
+    """
+    Checkpoints that haven't moved for `lease_seconds`, oldest first. Their
+    worker has most likely died.
+    """
+    cutoff = datetime.now() - timedelta(seconds=lease_seconds)
+    statement = (select(IngestCheckpoint)
+                 .where(IngestCheckpoint.updated_timestamp < cutoff)
+                 .order_by(IngestCheckpoint.updated_timestamp))
+    return list(session.exec(statement).all())
+
+
+def claim_checkpoint(checkpoint: IngestCheckpoint, session: Session) -> bool:
+    """
+    Take the stale checkpoint over for this worker. Only one worker wins, as
+    the claim only goes through while the checkpoint is as it was read.
+
+    :return: Whether this worker now owns the checkpoint.
+    """
+    statement = (update(IngestCheckpoint)
+                 .where(IngestCheckpoint.task_id == checkpoint.task_id)
+                 .where(IngestCheckpoint.updated_timestamp == checkpoint.updated_timestamp)
+                 .values(owner=WORKER_ID, updated_timestamp=datetime.now()))
+    claimed = session.execute(statement).rowcount == 1
+    session.commit()
+
+    return claimed
+
+
+def release_checkpoint(task_id: str, session: Session):
+    """
+    Give up this worker's checkpoint of the task, so any worker resumes it
+    once its lease is up.
+    """
+    statement = (update(IngestCheckpoint)
+                 .where(IngestCheckpoint.task_id == task_id)
+                 .where(IngestCheckpoint.owner == WORKER_ID)
+                 .values(owner=None, updated_timestamp=datetime.now()))
+    session.execute(statement)
+    session.commit()
+
+
+def release_checkpoints(session: Session) -> int:
+    """
+    Mark the checkpoints of this worker's unfinished ingests as stale, so
+    another worker resumes them on its next look rather than after a lease.
+
+    :return: How many were released.
+    """
+    statement = (update(IngestCheckpoint)
+                 .where(IngestCheckpoint.owner == WORKER_ID)
+                 .values(owner=None, updated_timestamp=datetime.min))
+    released = session.execute(statement).rowcount
+    session.commit()
+
+    return released
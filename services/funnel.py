@@ -0,0 +1,84 @@
+from typing import NamedTuple, Optional
+
+import numpy as np
+from sqlmodel import Session
+
+from crud.statements import (FUNNEL_PERCENTILES, TIME_TO_MATCH_BUCKETS, funnel_rows, select_funnel, select_time_to_match,
+                             select_funnel_by_like_type, select_match_timestamps)
+
+
+class FunnelCounts(NamedTuple):
+    # None for every like type together
+    like_type: Optional[int]
+    liked: int
+    matched: int
+    chatted: int
+    met: int
+
+
+class TimesToMatch(NamedTuple):
+    # The FUNNEL_PERCENTILES in seconds, None without any matches
+    percentiles: Optional[list[float]]
+    # The number of matches in each TIME_TO_MATCH_BUCKETS bucket, then in the one above them
+    bucket_counts: list[int]
+
+
+def count_funnel(user_id: str, session: Session) -> tuple[list[FunnelCounts], dict[Optional[int], TimesToMatch]]:
+    """
+    Count how the user's likes converted into matches, chats and dates, and
+    how long their matches took to come, for each like type and for every
+    like type together.
+
+    Grouped by Postgres, with the percentiles worked out there too. Elsewhere
+    only the counts per like type are grouped in SQL, and the rest is worked
+    out in-process.
+
+    :param user_id: The user whose likes to count.
+    :param session: The session to use to communicate with the database.
+    :return: The counts of each like type and of every like type together,
+        and the times to match of each, by like type. None is every like type
+        together.
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        return _count_funnel_postgres(user_id, session)
+
+    return _count_funnel_in_process(user_id, session)
+
+
+def _count_funnel_postgres(user_id: str, session: Session):
+    funnel = funnel_rows(user_id)
+
+    counts = [FunnelCounts(*row) for row in session.exec(select_funnel(funnel)).all()]
+    times_to_match = {
+        row.like_type: TimesToMatch(row.percentiles, list(row[2:]))
+        for row in session.exec(select_time_to_match(funnel)).all()
+    }
+
+    return counts, times_to_match
+
+
+def _count_funnel_in_process(user_id: str, session: Session):
+    counts = [FunnelCounts(*row) for row in session.exec(select_funnel_by_like_type(user_id)).all()]
+    # The row Postgres' ROLLUP adds, which is there even without any likes
+    counts.append(FunnelCounts(None, *(sum(column) for column in list(zip(*counts))[1:]))
+                  if counts else FunnelCounts(None, 0, 0, 0, 0))
+
+    seconds_by_type: dict[Optional[int], list[float]] = {}
+    for like_type, like_timestamp, match_timestamp in session.exec(select_match_timestamps(user_id)).all():
+        seconds_by_type.setdefault(like_type, []).append((match_timestamp - like_timestamp).total_seconds())
+
+    times_to_match = {like_type: _times_to_match(seconds) for like_type, seconds in seconds_by_type.items()}
+    if seconds_by_type:
+        times_to_match[None] = _times_to_match([s for seconds in seconds_by_type.values() for s in seconds])
+
+    return counts, times_to_match
+
+
+def _times_to_match(seconds: list[float]) -> TimesToMatch:
+    seconds = np.asarray(seconds)
+
+    # Linear interpolation, as percentile_cont does, and buckets as width_bucket counts them
+    percentiles = np.percentile(seconds, [fraction * 100 for fraction in FUNNEL_PERCENTILES]).tolist()
+    buckets = np.searchsorted(TIME_TO_MATCH_BUCKETS, seconds, side="right")
+
+    return TimesToMatch(percentiles, np.bincount(buckets, minlength=len(TIME_TO_MATCH_BUCKETS) + 1).tolist())
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from sqlmodel import Session, select
+
+from core import session as db
+from core.admission import ingest_admission, AdmissionRejected
+from core.cache import bump_data_version
+from core.events import EventTable
+from core.profiling import profile_section
+from core.snapshot import load_snapshot
+from models.models import UserMetaData, IngestCheckpoint
+from models.tasks import TaskStatus
+from services.chats import save_chat_stats
+from services.checkpoints import find_stale_checkpoints, claim_checkpoint, drop_checkpoint, release_checkpoints
+from services.matches_likes import save_hinge_data
+from services.percentiles import update_user_metrics
+from services.person import save_person_data, save_person_data_from_file
+from services.uploads import load_events, remove_upload
+
+logger = logging.getLogger(__name__)
+
+# Ingests this worker resumed from others. Unlike those of uploads, they
+# aren't waited for by the server when it stops
+_resumed_ingests: set[asyncio.Task] = set()
+
+
+def save_upload_data(events: EventTable, user_id: str, session: Session):
+    """
+    The synchronous part of an ingest. Creates the user's metadata on their
+    first upload, then saves the event snapshot and chat stats. The matches
+    and likes reach the database with the persons, in the background part.
+
+    :param events: The uploaded events.
+    :param user_id: The user the events belong to.
+    :param session: The session to use to communicate with the database.
+    """
+    # Get date ranges
+    date_range = events.date_range()
+
+    # Check if user exists in database
+    statement = (select(UserMetaData)
+                 .where(UserMetaData.user_id == user_id))
+    user_metadata = session.exec(statement).one_or_none()
+
+    if user_metadata is None:
+        uuid_capital = str(uuid.uuid4()).replace('-', '').upper()
+        db_user_metadata = UserMetaData(user_id=user_id,
+                                        created_timestamp=datetime.now(),
+                                        uuid=uuid_capital,
+                                        login_timestamp=datetime.now(),
+                                        start_range_timestamp=date_range.get("start_date"),
+                                        end_range_timestamp=date_range.get("end_date"))
+
+        session.add(db_user_metadata)
+        session.commit()
+
+    # Snapshot the matches and likes
+    save_hinge_data(events, user_id)
+    save_chat_stats(events, user_id, session)
+
+    # Swap the user's values in the cross-user percentiles for the new ones
+    snapshot = load_snapshot(user_id)
+    if snapshot is not None:
+        update_user_metrics(user_id, snapshot, session)
+
+    bump_data_version(user_id)
+
+
+async def finish_ingest(path: Path, user_id: str, task_id: str, session: Session,
+                        events: Optional[EventTable] = None):
+    """
+    Background stage of an admitted upload. Saves the persons, then gives
+    the ingest slot back.
+
+    :param events: The upload's events, if they're still around. They're
+        read from the spooled upload otherwise, as when resuming.
+    """
+    try:
+        with profile_section("ingest"):
+            if events is None:
+                await save_person_data_from_file(path, user_id, task_id, session)
+            else:
+                if await save_person_data(events, user_id, task_id, session, path):
+                    remove_upload(path)
+    finally:
+        ingest_admission.release(user_id, task_id)
+
+
+async def run_queued_ingest(path: Path, user_id: str, task_id: str):
+    """
+    Background ingest of an upload that arrived while every slot was busy.
+    Waits its turn in the queue, then runs both stages of the ingest.
+    """
+    from models.tasks import task_manager
+
+    try:
+        await ingest_admission.wait(task_id)
+    except BaseException:
+        remove_upload(path)
+        raise
+
+    ingest_admission.start(task_id)
+    try:
+        with Session(db.engine) as session, profile_section("ingest"):
+            events = load_events(path)
+            save_upload_data(events, user_id, session)
+            finished = await save_person_data(events, user_id, task_id, session, path)
+
+        # Not removed when the worker is stopped midway or the ingest is taken over, so it can be resumed
+        if finished:
+            remove_upload(path)
+
+    except Exception as e:
+        remove_upload(path)
+        task_manager.update_task(
+            task_id,
+            status=TaskStatus.FAILED,
+            progress=0,
+            message=str(e)
+        )
+
+    finally:
+        ingest_admission.release(user_id, task_id)
+
+
+async def resume_ingest(checkpoint: IngestCheckpoint):
+    """
+    Carry on with a person ingest another worker left unfinished, from its
+    last committed chunk. Its ingest slot must already be taken.
+    """
+    from models.tasks import task_manager
+
+    task_manager.create_task(checkpoint.task_id)
+    task_manager.update_task(
+        checkpoint.task_id,
+        status=TaskStatus.PENDING,
+        progress=round(checkpoint.next_event / checkpoint.total_events * 100, 2) if checkpoint.total_events else 0,
+        message="Persons processing resumed"
+    )
+
+    ingest_admission.start(checkpoint.task_id)
+    with Session(db.engine) as session:
+        await finish_ingest(Path(checkpoint.upload_path), checkpoint.user_id, checkpoint.task_id, session)
+
+
+def claim_stale_ingests(lease_seconds: int) -> list[IngestCheckpoint]:
+    """
+    Claim the unfinished ingests that have stopped moving, as many as there
+    are free ingest slots for.
+    """
+    from models.tasks import task_manager
+
+    claimed = []
+    with Session(db.engine) as session:
+        for checkpoint in find_stale_checkpoints(lease_seconds, session):
+            if checkpoint.upload_path is None or not Path(checkpoint.upload_path).exists():
+                # Nothing left to resume from
+                drop_checkpoint(checkpoint.task_id, session)
+                task_manager.create_task(checkpoint.task_id)
+                task_manager.update_task(
+                    checkpoint.task_id,
+                    status=TaskStatus.FAILED,
+                    progress=0,
+                    message="The upload could not be resumed, as its file is gone. Upload it again"
+                )
+                continue
+
+            try:
+                admitted = ingest_admission.acquire_nowait(checkpoint.user_id)
+            except AdmissionRejected:
+                continue
+            if not admitted:
+                # Only free slots are taken, the queue is for new uploads
+                ingest_admission.cancel(checkpoint.user_id)
+                break
+
+            if claim_checkpoint(checkpoint, session):
+                session.refresh(checkpoint)
+                session.expunge(checkpoint)
+                claimed.append(checkpoint)
+            else:
+                ingest_admission.release(checkpoint.user_id)
+
+    return claimed
+
+
+async def resume_stale_ingests_periodically(lease_seconds: int):
+    """
+    Look for ingests left behind by a stopped worker every half lease, and
+    resume them in the background.
+    """
+    while True:
+        try:
+            for checkpoint in claim_stale_ingests(lease_seconds):
+                task = asyncio.create_task(resume_ingest(checkpoint))
+                _resumed_ingests.add(task)
+                task.add_done_callback(_resumed_ingests.discard)
+        except Exception:
+            logger.exception("Resuming stale ingests failed")
+
+        await asyncio.sleep(lease_seconds / 2)
+
+
+async def drain_ingests(timeout: float):
+    """
+    Stop taking on ingests and let the running ones finish, for up to
+    `timeout` seconds. Whatever is still unfinished then is stopped at its
+    last committed chunk and handed over to the other workers.
+    """
+    ingest_admission.close()
+    if not await ingest_admission.drain(timeout):
+        for task in _resumed_ingests:
+            task.cancel()
+        await asyncio.gather(*_resumed_ingests, return_exceptions=True)
+
+    # Also hands over the ingests of uploads the server stopped waiting for
+    with Session(db.engine) as session:
+        released = release_checkpoints(session)
+    if released:
+        logger.warning("Handed %d unfinished ingests over to the other workers", released)
@@ -1,40 +1,45 @@
-from sqlmodel import Session
+import numpy as np
 
-from models.models import Matches, Likes, Events
-from utils.dates import parse_timestamp
-from utils.events import get_like_content
+from core.events import EventTable, EventField, NO_TIMESTAMP
+from core.snapshot import SnapshotBuilder, EventKind, EventFlag
 
 
-def save_hinge_data(events: Events, user_id: str, session: Session):
+def save_hinge_data(events: EventTable, user_id: str):
     """
-    Save the given events to the database.
+    Save the given events' likes, matches and blocks to the user's columnar event snapshot, replacing any previous one.
 
-    This function takes in an Events object and adds the various likes and matches to the database, with the associated user_id.
+    The database only holds them as persons, written by services.person, which the Matches and Likes are read from.
 
-    :param events: The Events object to save.
-    :param user_id: The user_id to associate with the created Likes and Matches.
-    :param session: The session to use to communicate with the database.
+    :param events: The EventTable to save.
+    :param user_id: The user the snapshot belongs to.
     """
-    for event in events.root:
-        for key, value in event.data.items():
-            if key == "match" and "like" in event.data:
-                match_timestamp = parse_timestamp(event.data["match"][0])
-                like_timestamp = parse_timestamp(event.data["like"][0])
-                db_match = Matches(user_id=user_id, type=1, timestamp=match_timestamp)
-                db_like = Likes(user_id=user_id, type=get_like_content(event.data["like"][0]),
-                                timestamp=like_timestamp)
-                session.add(db_match)
-                session.add(db_like)
-
-            elif key == "match" in event.data:
-                match_timestamp = parse_timestamp(event.data["match"][0])
-                db_match = Matches(user_id=user_id, type=2, timestamp=match_timestamp)
-                session.add(db_match)
-
-            elif key == "like" in event.data:
-                like_timestamp = parse_timestamp(event.data["like"][0])
-                db_like = Likes(user_id=user_id, type=get_like_content(event.data["like"][0]),
-                                timestamp=like_timestamp)
-                session.add(db_like)
-
-    session.commit()
+    snapshot = SnapshotBuilder()
+
+    liked = events.has(EventField.LIKE)
+    matched = events.has(EventField.MATCH)
+    flags = (np.where(matched, EventFlag.MATCHED, 0) | np.where(events.has(EventField.MET), EventFlag.WE_MET, 0))
+    flags = flags.astype(np.uint8)
+
+    # A match you liked first is flagged, one they started isn't
+    match_rows = np.flatnonzero(matched)
+    match_flags = flags[match_rows] | np.where(liked[match_rows], EventFlag.YOU_LIKED, 0).astype(np.uint8)
+
+    # A like that led to a match is saved twice, with its match and on its own, which the stats have always
+    # been computed from
+    like_rows = np.concatenate([np.flatnonzero(liked & matched), np.flatnonzero(liked)])
+    like_types = events.like_types[like_rows]
+    like_flags = flags[like_rows] | EventFlag.YOU_LIKED
+
+    match_timestamps = events.match_timestamps[match_rows]
+    like_timestamps = events.like_timestamps[like_rows]
+
+    # The snapshot skips events without a timestamp
+    has_timestamp = match_timestamps != NO_TIMESTAMP
+    snapshot.extend(EventKind.MATCH, match_timestamps[has_timestamp], 0, match_flags[has_timestamp])
+    has_timestamp = like_timestamps != NO_TIMESTAMP
+    snapshot.extend(EventKind.LIKE, like_timestamps[has_timestamp], like_types[has_timestamp],
+                    like_flags[has_timestamp])
+    block_rows = np.flatnonzero(events.has(EventField.BLOCK) & (events.block_timestamps != NO_TIMESTAMP))
+    snapshot.extend(EventKind.BLOCK, events.block_timestamps[block_rows], 0, flags[block_rows])
+
+    snapshot.write(user_id)
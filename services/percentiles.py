@@ -0,0 +1,310 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select, delete
+from starlette.concurrency import run_in_threadpool
+
+from config import config
+from core import session as db
+from core.cache import bump_percentile_version, get_percentile_version
+from core.sketches import QuantileSketch
+from core.snapshot import EventSnapshot, EventKind
+from models.models import PercentileMetric, MetricSketch, UserMetrics, HingeStats, HingeStatsPercentiles
+
+logger = logging.getLogger(__name__)
+
+Metrics = dict[PercentileMetric, Optional[float]]
+
+
+def _per_day(snapshot: EventSnapshot, mask) -> Optional[float]:
+    # Less than a day of events has no per day rate
+    try:
+        return snapshot.per_day(mask)
+    except (IndexError, ZeroDivisionError):
+        return None
+
+
+def user_metrics(snapshot: EventSnapshot) -> Metrics:
+    """
+    The user's values for each PercentileMetric, calculated the way the
+    stats endpoint does. None where the user has no value.
+    """
+    matches = snapshot.kind_mask(EventKind.MATCH)
+    likes = snapshot.kind_mask(EventKind.LIKE)
+    match_count = int(matches.sum())
+    like_count = int(likes.sum())
+
+    return {
+        PercentileMetric.CONVERSION_PERCENTAGE: math.ceil((match_count / like_count) * 100) if like_count else None,
+        PercentileMetric.MATCHES_PER_DAY: _per_day(snapshot, matches),
+        PercentileMetric.LIKES_PER_DAY: _per_day(snapshot, likes),
+    }
+
+
+def stats_metrics(stats: HingeStats) -> Metrics:
+    """
+    The user's values for each PercentileMetric, read back from their stats.
+    """
+    return {
+        PercentileMetric.CONVERSION_PERCENTAGE: stats.conversion_percentage.get("percentage"),
+        PercentileMetric.MATCHES_PER_DAY: stats.matches.matches_per_day_for_given_range.matches,
+        PercentileMetric.LIKES_PER_DAY: stats.likes.likes_received_per_day_for_given_range.likes,
+    }
+
+
+def _empty_sketch() -> QuantileSketch:
+    return QuantileSketch(relative_accuracy=config.PERCENTILE_RELATIVE_ACCURACY)
+
+
+def _lock_sketches(session: Session) -> dict[PercentileMetric, MetricSketch]:
+    """
+    Select every metric's sketch row for update, creating any that are
+    missing. Rows are always locked in the same order, so concurrent ingests
+    and rebuilds queue up behind each other instead of deadlocking.
+    """
+    statement = select(MetricSketch).order_by(MetricSketch.metric).with_for_update()
+    rows = {row.metric: row for row in session.exec(statement).all()}
+
+    for metric in PercentileMetric:
+        if metric.value not in rows:
+            rows[metric.value] = MetricSketch(metric=metric.value, sketch=_empty_sketch().to_dict())
+            session.add(rows[metric.value])
+
+    return {metric: rows[metric.value] for metric in PercentileMetric}
+
+
+def _replace_user_metrics(user_id: str, metrics: Optional[Metrics], session: Session):
+    """
+    Take the user's previous values out of the sketches and add the given
+    ones, or only take them out when `metrics` is None. Doesn't commit.
+    """
+    rows = _lock_sketches(session)
+    user_row = session.get(UserMetrics, user_id)
+    if user_row is None and metrics is None:
+        return
+
+    now = datetime.now()
+    for metric, row in rows.items():
+        sketch = QuantileSketch.from_dict(row.sketch)
+        old_value = getattr(user_row, metric.value) if user_row is not None else None
+        new_value = metrics.get(metric) if metrics is not None else None
+
+        if old_value is not None:
+            try:
+                sketch.remove(old_value)
+            except ValueError:
+                # The sketch was reset since, the next rebuild evens it out
+                pass
+        if new_value is not None:
+            sketch.add(new_value)
+
+        row.sketch = sketch.to_dict()
+        row.updated_timestamp = now
+
+    if metrics is None:
+        session.delete(user_row)
+        return
+
+    if user_row is None:
+        user_row = UserMetrics(user_id=user_id)
+        session.add(user_row)
+
+    for metric, value in metrics.items():
+        setattr(user_row, metric.value, value)
+    user_row.updated_timestamp = now
+
+
+def update_user_metrics(user_id: str, snapshot: EventSnapshot, session: Session):
+    """
+    Swap the user's values in the percentile sketches for the ones in their
+    new snapshot. Called after every ingest.
+
+    :param user_id: The user the snapshot belongs to.
+    :param snapshot: The user's newly written event snapshot.
+    :param session: The session to use to communicate with the database.
+    """
+    _replace_user_metrics(user_id, user_metrics(snapshot), session)
+    session.commit()
+
+
+def remove_user_metrics(user_id: str, session: Session):
+    """
+    Take the user's values out of the percentile sketches. Doesn't commit, so
+    it goes through with the rest of the user's deletion.
+    """
+    _replace_user_metrics(user_id, None, session)
+
+
+def reset_sketches(session: Session):
+    """
+    Empty every sketch and forget every user's values. Doesn't commit.
+    """
+    for row in _lock_sketches(session).values():
+        row.sketch = _empty_sketch().to_dict()
+        row.updated_timestamp = datetime.now()
+    session.exec(delete(UserMetrics))
+
+
+def rebuild_sketches(session: Session, batch_size: int = 1000, min_age: float = 0) -> Optional[int]:
+    """
+    Rebuild every sketch from the stored per user values, sketching each
+    batch of users on its own and merging the batches. Evens out anything
+    the incremental updates missed, such as users deleted outside the API.
+
+    The sketch rows stay locked throughout, so no ingest can update them
+    between reading the users and writing the result, and no other worker
+    can rebuild them at the same time.
+
+    :param min_age: Skip the rebuild if any worker rebuilt the sketches less
+        than this many seconds ago.
+    :return: The number of users in the rebuilt sketches, or None if it was
+        skipped.
+    """
+    rows = _lock_sketches(session)
+
+    rebuilt = [row.rebuilt_timestamp for row in rows.values() if row.rebuilt_timestamp is not None]
+    if rebuilt and datetime.now() - max(rebuilt) < timedelta(seconds=min_age):
+        session.rollback()
+        return None
+
+    sketches = {metric: _empty_sketch() for metric in PercentileMetric}
+
+    result = session.execute(select(UserMetrics).execution_options(yield_per=batch_size))
+    user_count = 0
+    for partition in result.partitions():
+        batch = {metric: _empty_sketch() for metric in PercentileMetric}
+        for (user_row,) in partition:
+            for metric in PercentileMetric:
+                value = getattr(user_row, metric.value)
+                if value is not None:
+                    batch[metric].add(value)
+        user_count += len(partition)
+
+        for metric, sketch in batch.items():
+            sketches[metric].merge(sketch)
+
+    now = datetime.now()
+    for metric, row in rows.items():
+        row.sketch = sketches[metric].to_dict()
+        row.updated_timestamp = now
+        row.rebuilt_timestamp = now
+
+    session.commit()
+    return user_count
+
+
+def _rebuild_all_sketches(min_age: float) -> Optional[int]:
+    with Session(db.engine) as session:
+        return rebuild_sketches(session, min_age=min_age)
+
+
+def ensure_metric_sketches():
+    """
+    Create the sketch rows at startup, so the first ingests don't race to.
+    """
+    with Session(db.engine) as session:
+        _lock_sketches(session)
+        try:
+            session.commit()
+        except IntegrityError:
+            # Another worker starting up created them first
+            session.rollback()
+
+
+class SketchCache:
+    """
+    The sketches as last read from the database, reused for
+    PERCENTILE_CACHE_SECONDS so each stats request is a lookup in memory.
+    Read again straight away once any worker rebuilds them.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    # Creates a singleton. Ensuring a single instance only gets create across the app
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    cls._instance = super().__new__(cls)
+
+                    cls._instance._sketches: dict[PercentileMetric, QuantileSketch] = {}
+                    cls._instance._loaded_at = None
+                    cls._instance._version = None
+
+        return cls._instance
+
+    def get(self) -> dict[PercentileMetric, QuantileSketch]:
+        version = get_percentile_version()
+        with self._lock:
+            if (self._loaded_at is not None and self._version == version
+                    and time.monotonic() - self._loaded_at < config.PERCENTILE_CACHE_SECONDS):
+                return self._sketches
+
+            with Session(db.engine) as session:
+                rows = session.exec(select(MetricSketch)).all()
+
+            self._sketches = {
+                PercentileMetric(row.metric): QuantileSketch.from_dict(row.sketch)
+                for row in rows
+            }
+            self._loaded_at = time.monotonic()
+            self._version = version
+            return self._sketches
+
+    def clear(self):
+        with self._lock:
+            self._loaded_at = None
+
+
+sketch_cache = SketchCache()
+
+
+def user_percentiles(stats: HingeStats) -> Optional[HingeStatsPercentiles]:
+    """
+    Where the user's stats fall among every user's, as percentiles from 0
+    to 100. None until any user has been sketched.
+    """
+    sketches = sketch_cache.get()
+    compared_user_count = max((sketch.count for sketch in sketches.values()), default=0)
+    if not compared_user_count:
+        return None
+
+    percentiles = {}
+    for metric, value in stats_metrics(stats).items():
+        sketch = sketches.get(metric)
+        rank = sketch.rank(value) if sketch is not None and value is not None else None
+        percentiles[metric.value] = round(rank * 100, 1) if rank is not None else None
+
+    return HingeStatsPercentiles(
+        description="The share of users with lower values than mine, as a percentage",
+        compared_user_count=compared_user_count,
+        **percentiles
+    )
+
+
+async def rebuild_sketches_periodically(interval: int):
+    """
+    Rebuild the sketches every `interval` seconds, then expire the cached
+    stats so they pick up the new percentiles.
+
+    Every web worker runs this, but a worker skips its rebuild when another
+    rebuilt the sketches within the last half interval, so there is about
+    one rebuild per interval however many workers there are.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            user_count = await run_in_threadpool(_rebuild_all_sketches, interval / 2)
+        except Exception:
+            logger.exception("Rebuilding the percentile sketches failed")
+            continue
+
+        if user_count is not None:
+            sketch_cache.clear()
+            bump_percentile_version()
@@ -1,176 +1,228 @@
 import asyncio
-import json
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+from sqlmodel import Session, insert
+
+from config import config
+from core.cache import bump_data_version
+from core.events import EventTable, EventField, LikeType, to_datetimes
+from core.workers import ingest_pool
+from models.models import WhoLiked, Person, PersonMedia, MediaKind, Chat
+from models.tasks import TaskStatus
+from services.checkpoints import open_checkpoint, commit_chunk, drop_checkpoint, release_checkpoint, CheckpointLost
+from services.uploads import load_events, remove_upload
 
-from sqlmodel import Session
+logger = logging.getLogger(__name__)
 
-from models.models import Events, WhoLiked, Person
-from models.tasks import TaskStatus
-from utils.dates import parse_timestamp
-from utils.events import get_like_content
 
+@dataclass
+class PersonRows:
+    """
+    The rows to save for a range of events. Media and chats refer to their
+    person by its position in `persons`, as it has no id yet.
+    """
+    persons: list[dict] = field(default_factory=list)
+    # (person position, media kind, url)
+    media: list[tuple[int, int, str]] = field(default_factory=list)
+    # (person position, timestamp, position in the conversation, body)
+    chats: list[tuple[int, datetime, int, str]] = field(default_factory=list)
+
+
+def _person_row(**values) -> dict:
+    # Every row has every column, so they're all written by one executemany
+    row = dict.fromkeys(("matched", "who_liked", "like_type", "what_you_liked_prompt", "like_timestamp",
+                         "match_timestamp", "we_met", "blocked", "has_media", "like_comment"))
+    row["has_media"] = False
+    row.update(values)
+    return row
+
+
+def _add_like_content(events: EventTable, index: int, person: dict, position: int, rows: PersonRows):
+    person["like_comment"] = events.string(events.like_comments[index])
+
+    like_type = events.like_types[index]
+    person["like_type"] = int(like_type)
+    # Likes sent with only a comment have no content
+    if like_type == LikeType.UNKNOWN:
+        return
+
+    person["has_media"] = True
+
+    if like_type == LikeType.PHOTO:
+        rows.media.append((position, MediaKind.PHOTO.value, events.string(events.like_media_urls[index])))
+    elif like_type == LikeType.PROMPT:
+        person["what_you_liked_prompt"] = {
+            "question": events.string(events.like_questions[index]),
+            "answer": events.string(events.like_answers[index])
+        }
+    elif like_type == LikeType.VIDEO:
+        rows.media.append((position, MediaKind.VIDEO.value, events.string(events.like_media_urls[index])))
+
+
+def build_person_rows(events: EventTable, start: int = 0, stop: Optional[int] = None) -> PersonRows:
+    """
+    Work out who each of the events `start` to `stop` was with, as rows to
+    save. Pure, so it can run in an ingest pool process.
+
+    Every like is a person you liked, whether or not it led to a match, and
+    every match is a matched person. These rows are the only record of the
+    likes and matches in the database. A match you met or blocked is taken to
+    have started with your like. An event's chats belong to its match, or to
+    its like when there's no match.
+    """
+    stop = len(events) if stop is None else stop
+    rows = PersonRows()
+
+    like_timestamps = to_datetimes(events.like_timestamps[start:stop])
+    match_timestamps = to_datetimes(events.match_timestamps[start:stop])
+
+    for offset, fields in enumerate(events.fields[start:stop].tolist()):
+        index = start + offset
+
+        like_position = None
+        if fields & EventField.LIKE:
+            like_position = len(rows.persons)
+            person = _person_row(matched=False, who_liked=WhoLiked.YOU.value, like_timestamp=like_timestamps[offset])
+            _add_like_content(events, index, person, like_position, rows)
+            rows.persons.append(person)
+
+        match_position = None
+        if fields & EventField.MATCH:
+            match_position = len(rows.persons)
+            person = _person_row(matched=True, who_liked=WhoLiked.THEM.value, match_timestamp=match_timestamps[offset])
+
+            if fields & (EventField.WE_MET | EventField.BLOCK):
+                person["blocked"] = True
+            if fields & (EventField.WE_MET | EventField.BLOCK | EventField.LIKE):
+                person["who_liked"] = WhoLiked.YOU.value
+            if fields & EventField.LIKE:
+                person["like_timestamp"] = like_timestamps[offset]
+                _add_like_content(events, index, person, match_position, rows)
+            if fields & EventField.WE_MET:
+                person["we_met"] = bool(fields & EventField.MET)
+
+            # TODO finish NLP
+            # for chat in event.get("chats"):
+            #     doc1 = nlp(chat.get("body"))
+            #     for blah in doc1.ents:
+            #         print(blah.text, blah.label_)
+
+            rows.persons.append(person)
+
+        conversation_position = match_position if match_position is not None else like_position
+        if conversation_position is not None and fields & EventField.CHATS:
+            chat_rows = events.chat_rows(index)
+            timestamps = to_datetimes(events.chat_timestamps[chat_rows.start:chat_rows.stop])
+            for position, (row, timestamp) in enumerate(zip(chat_rows, timestamps)):
+                if timestamp is not None:
+                    rows.chats.append((conversation_position, timestamp, position,
+                                       events.string(events.chat_bodies[row])))
+
+    return rows
+
+
+def write_person_rows(rows: PersonRows, user_id: str, session: Session):
+    """
+    Bulk insert the rows in the session's transaction: the persons first,
+    returning their ids, then their media and chats.
+    """
+    if not rows.persons:
+        return
+
+    # On the table rather than the model, as the ORM's bulk insert sends a statement per few rows when returning
+    statement = insert(Person.__table__).returning(Person.id, sort_by_parameter_order=True)
+    person_ids = session.execute(statement, [{"user_id": user_id, **person} for person in rows.persons]).scalars().all()
+
+    if rows.media:
+        session.execute(insert(PersonMedia), [
+            {"person_id": person_ids[position], "kind": kind, "url": url}
+            for position, kind, url in rows.media
+        ])
+    if rows.chats:
+        session.execute(insert(Chat), [
+            {"user_id": user_id, "person_id": person_ids[position], "timestamp": timestamp,
+             "position": chat_position, "body": body}
+            for position, timestamp, chat_position, body in rows.chats
+        ])
+
+
+async def iter_person_rows(events: EventTable, start: int) -> AsyncIterator[tuple[int, PersonRows]]:
+    """
+    Build the rows for the events from `start` on, PERSON_INGEST_CHUNK_SIZE
+    events at a time, in order.
+
+    With an ingest pool the chunks are built in parallel by its processes,
+    a few ahead of the one being saved. Otherwise they're built here, giving
+    way to other requests between chunks.
 
-async def save_person_data(events: Events, user_id: str, task_id: str, session: Session):
+    :return: Pairs of the index after the chunk's last event, and its rows.
+    """
+    chunk_size = config.PERSON_INGEST_CHUNK_SIZE
+    chunks = [(chunk_start, min(chunk_start + chunk_size, len(events)))
+              for chunk_start in range(start, len(events), chunk_size)]
+
+    executor = ingest_pool.executor()
+    if executor is None:
+        for chunk_start, chunk_stop in chunks:
+            yield chunk_stop, build_person_rows(events, chunk_start, chunk_stop)
+            await asyncio.sleep(0)
+        return
+
+    loop = asyncio.get_running_loop()
+    in_flight = deque()
+    try:
+        for chunk_start, chunk_stop in chunks:
+            # Only the chunk's own events and strings are sent to the worker
+            future = loop.run_in_executor(executor, build_person_rows, events.slice(chunk_start, chunk_stop))
+            in_flight.append((chunk_stop, future))
+            if len(in_flight) >= ingest_pool.max_in_flight:
+                chunk_stop, future = in_flight.popleft()
+                yield chunk_stop, await future
+
+        while in_flight:
+            chunk_stop, future = in_flight.popleft()
+            yield chunk_stop, await future
+    finally:
+        for _, future in in_flight:
+            future.cancel()
+
+
+async def save_person_data(events: EventTable, user_id: str, task_id: str, session: Session,
+                           upload_path: Optional[Path] = None) -> bool:
     from models.tasks import task_manager
     """
-    Iterate over the given events and save a Person object for each event that has a match and/or like.
+    Save a Person for each like and each match in the given events, along with their media and chat messages.
+
+    The rows are built PERSON_INGEST_CHUNK_SIZE events at a time, across the ingest pool when INGEST_WORKERS is set,
+    and each chunk is bulk inserted and committed along with the task's checkpoint. A task that was interrupted
+    carries on after its last committed chunk when it's run again. One that fails keeps its checkpoint too, and is
+    resumed from there after INGEST_LEASE_SECONDS, as the matches and likes are only saved as these persons.
 
     :param task_id:
     :param events: The events to save.
     :param user_id: The user_id to associate with the Person objects.
     :param session: The database session to use.
+    :param upload_path: The spooled upload the events came from, kept in the checkpoint so another worker can resume.
+    :return: Whether the ingest finished here. False when it failed or another worker took it over, as it's resumed
+        from the spooled upload, so that must be kept.
     """
-    total_events = len(events.root)
-    processed_events = 0
+    total_events = len(events)
+    checkpoint = open_checkpoint(task_id, user_id, upload_path, total_events, session)
+    processed_events = checkpoint.next_event
 
     try:
-        for event in events.root:
-            for key, value in event.data.items():
-                if key == "match" and "like" and "chats" and "block" and "we_met" in event.data:
-                    db_person = Person()
-                    db_person.user_id = user_id
-                    db_person.has_media = False
-
-                    db_person.matched = True
-                    db_person.who_liked = WhoLiked.YOU.value
-                    db_person.blocked = True
-
-                    if event.data.get("like") is not None:
-                        db_person.like_timestamp = parse_timestamp(event.data["like"][0])
-                        await build_like_content(event.data["like"][0], db_person)
-                    if event.data.get("match") is not None:
-                        db_person.match_timestamp = parse_timestamp(event.data["match"][0])
-
-                    if event.data["we_met"][0].get("did_meet_subject") == "Yes":
-                        db_person.we_met = True
-                    else:
-                        db_person.we_met = False
-
-                    # TODO finish NLP
-                    # for chat in event.get("chats"):
-                    #     doc1 = nlp(chat.get("body"))
-                    #     for blah in doc1.ents:
-                    #         print(blah.text, blah.label_)
-
-                    session.add(db_person)
-
-                elif key == "match" and "like" and "chats" and "block" in event.data:
-                    db_person = Person()
-
-                    db_person.user_id = user_id
-                    db_person.has_media = False
-
-                    db_person.matched = True
-                    db_person.who_liked = WhoLiked.YOU.value
-                    db_person.blocked = True
-
-                    if event.data.get("like") is not None:
-                        db_person.like_timestamp = parse_timestamp(event.data["like"][0])
-                        await build_like_content(event.data["like"][0], db_person)
-                    if event.data.get("match") is not None:
-                        db_person.match_timestamp = parse_timestamp(event.data["match"][0])
-
-                    session.add(db_person)
-
-                elif key == "match" and "like" and "we_met" in event.data:
-                    db_person = Person()
-
-                    db_person.user_id = user_id
-                    db_person.has_media = False
-
-                    db_person.matched = True
-                    db_person.who_liked = WhoLiked.YOU.value
-
-                    if event.data.get("like") is not None:
-                        db_person.like_timestamp = parse_timestamp(event.data["like"][0])
-                        await build_like_content(event.data["like"][0], db_person)
-                    if event.data.get("match") is not None:
-                        db_person.match_timestamp = parse_timestamp(event.data["match"][0])
-
-                    if event.data["we_met"][0].get("did_meet_subject") == "Yes":
-                        db_person.we_met = True
-                    else:
-                        db_person.we_met = False
-
-                    session.add(db_person)
-
-                elif key == "match" and "like" in event.data:
-                    db_person = Person()
-
-                    db_person.user_id = user_id
-                    db_person.has_media = False
-
-                    db_person.matched = True
-                    db_person.who_liked = WhoLiked.YOU.value
-
-                    if event.data.get("like") is not None:
-                        db_person.like_timestamp = parse_timestamp(event.data["like"][0])
-                        await build_like_content(event.data["like"][0], db_person)
-                    if event.data.get("match") is not None:
-                        db_person.match_timestamp = parse_timestamp(event.data["match"][0])
-
-                    session.add(db_person)
-
-                elif key == "match" and "chats" in event.data:
-                    db_person = Person()
-
-                    db_person.user_id = user_id
-                    db_person.has_media = False
+        async for chunk_stop, rows in iter_person_rows(events, checkpoint.next_event):
+            write_person_rows(rows, user_id, session)
+            commit_chunk(task_id, processed_events, chunk_stop, session)
+            processed_events = chunk_stop
 
-                    db_person.matched = True
-                    db_person.who_liked = WhoLiked.THEM.value
-                    db_person.match_timestamp = parse_timestamp(event.data["match"][0])
-
-                    session.add(db_person)
-
-                elif key == "match" and "we_met" in event.data:
-                    db_person = Person()
-
-                    db_person.user_id = user_id
-                    db_person.has_media = False
-
-                    db_person.matched = True
-                    db_person.who_liked = WhoLiked.THEM.value
-                    db_person.match_timestamp = parse_timestamp(event.data["match"][0])
-
-                    if event.data["we_met"][0].get("did_meet_subject") == "Yes":
-                        db_person.we_met = True
-                    else:
-                        db_person.we_met = False
-
-                    session.add(db_person)
-
-                elif key == "like" in event.data:
-                    db_person = Person()
-
-                    db_person.user_id = user_id
-                    db_person.has_media = False
-
-                    db_person.matched = False
-                    db_person.who_liked = WhoLiked.YOU.value
-                    db_person.like_timestamp = parse_timestamp(event.data["like"][0])
-
-                    await build_like_content(event.data["like"][0], db_person)
-
-                    session.add(db_person)
-
-                elif key == "match" in event.data:
-                    db_person = Person()
-
-                    db_person.user_id = user_id
-                    db_person.has_media = False
-
-                    db_person.matched = True
-                    db_person.who_liked = WhoLiked.THEM.value
-                    db_person.match_timestamp = parse_timestamp(event.data["match"][0])
-
-                    session.add(db_person)
-
-                elif key == "we_met" or "block" in event.data:
-                    continue
-
-            processed_events += 1
             progress = (processed_events / total_events) * 100
-            print(progress, "events processed", processed_events, "of", total_events)
+            logger.debug("Ingest %s saved %d of %d events", task_id, processed_events, total_events)
 
             task_manager.update_task(
                 task_id,
@@ -180,9 +232,9 @@ async def save_person_data(events: Events, user_id: str, task_id: str, session:
                         f"{processed_events}/{total_events} complete."
             )
 
-            await asyncio.sleep(0.1)
-
-        session.commit()
+        commit_chunk(task_id, processed_events, processed_events, session)
+        drop_checkpoint(task_id, session)
+        bump_data_version(user_id)
 
         task_manager.update_task(
             task_id,
@@ -191,35 +243,57 @@ async def save_person_data(events: Events, user_id: str, task_id: str, session:
             message=f"{processed_events}/{total_events} completed"
         )
 
+    except CheckpointLost as e:
+        # The worker that took the ingest over reports its progress from here
+        logger.warning("%s, stopping at event %d of %d", e, processed_events, total_events)
+        task_manager.forget_task(task_id)
+        return False
+
     except Exception as e:
+        # Chunks committed so far stay, and the rest are saved when the task is resumed
+        logger.exception("Ingest %s failed at event %d of %d", task_id, processed_events, total_events)
+        session.rollback()
+        release_checkpoint(task_id, session)
+
         task_manager.update_task(
             task_id,
-            status=TaskStatus.FAILED,
-            progress=0,
-            message=str(e)
+            status=TaskStatus.PENDING,
+            message=f"Stopped at event {processed_events} of {total_events}, carrying on from there in "
+                    f"{config.INGEST_LEASE_SECONDS} seconds. {e}"
         )
+        # Whichever worker resumes it reports its progress from here
+        task_manager.save_pending()
+        task_manager.forget_task(task_id)
+        return False
 
+    return True
 
-async def build_like_content(item, db_person):
-    like_content = item.get("content")[0]
-
-    if get_like_content(item) in [1, 2, 3]:
-        db_person.has_media = True
 
-    if get_like_content(item) == 1:
-        db_person.what_you_liked_photo = like_content.get("photo").get("url")
+async def save_person_data_from_file(path: Path, user_id: str, task_id: str, session: Session):
+    from models.tasks import task_manager
+    """
+    Load the events from a spooled upload and save the Person objects for them.
 
-        # Generate photo thumbnail
-        # db_person.thumbnail = await generate_thumbnail(
-        #     ImageUrl(url=like_content.get("photo").get("url"))
-        # )
+    The spooled file is removed once processing finishes, whether or not it succeeded. It's left in place if the
+    worker stops midway or the task is taken over, for the worker that resumes it.
 
-    elif get_like_content(item) == 2:
-        question_answer = {
-            "question": like_content.get("prompt").get("question"),
-            "answer": like_content.get("prompt").get("answer")
-        }
-        db_person.what_you_liked_prompt = json.dumps(question_answer)
+    :param path: The spooled upload to read the events from.
+    :param user_id: The user_id to associate with the Person objects.
+    :param task_id: The task to report progress to.
+    :param session: The database session to use.
+    """
+    try:
+        events = load_events(path)
+    except Exception as e:
+        drop_checkpoint(task_id, session)
+        remove_upload(path)
+        task_manager.update_task(
+            task_id,
+            status=TaskStatus.FAILED,
+            progress=0,
+            message=str(e)
+        )
+        return
 
-    elif get_like_content(item) == 3:
-        db_person.what_you_liked_video = like_content.get("video").get("url")
+    if await save_person_data(events, user_id, task_id, session, path):
+        remove_upload(path)
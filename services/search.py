@@ -0,0 +1,134 @@
+import threading
+from collections import OrderedDict
+from typing import Tuple
+
+from sqlalchemy import literal_column
+from sqlalchemy.orm import selectinload
+from sqlmodel import Session, select, desc, func, or_
+
+from config import config
+from core.cache import get_data_version
+from core.search import InvertedIndex
+from models.models import Person
+
+SEARCH_CONFIG = "english"
+# Generated from models.models.PERSON_SEARCH_DOCUMENT, on Postgres only
+SEARCH_VECTOR = literal_column("person.search_vector")
+
+# Field weights for the in-process index, the defaults Postgres gives weights A and B
+ANSWER_WEIGHT = 1.0
+COMMENT_WEIGHT = 1.0
+QUESTION_WEIGHT = 0.4
+
+
+class SearchIndexCache:
+    """
+    An LRU of per user inverted indexes, for databases without full-text
+    search. An index is rebuilt when the user's data version moves on.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    # Creates a singleton. Ensuring a single instance only gets create across the app
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            with cls._lock:
+                if not cls._instance:
+                    cls._instance = super().__new__(cls)
+
+                    cls._instance._indexes: OrderedDict[str, Tuple[int, InvertedIndex]] = OrderedDict()
+                    cls._instance.max_entries = config.SEARCH_INDEX_CACHE_SIZE
+
+        return cls._instance
+
+    def get(self, user_id: str, session: Session) -> InvertedIndex:
+        version = get_data_version(user_id)
+        with self._lock:
+            entry = self._indexes.get(user_id)
+            if entry is not None and entry[0] == version:
+                self._indexes.move_to_end(user_id)
+                return entry[1]
+
+        index = build_person_index(user_id, session)
+
+        with self._lock:
+            self._indexes[user_id] = (version, index)
+            self._indexes.move_to_end(user_id)
+            while len(self._indexes) > self.max_entries:
+                self._indexes.popitem(last=False)
+
+        return index
+
+
+search_index_cache = SearchIndexCache()
+
+
+def build_person_index(user_id: str, session: Session) -> InvertedIndex:
+    statement = (select(Person.id, Person.what_you_liked_prompt, Person.like_comment)
+                 .where(Person.user_id == user_id)
+                 .where(or_(Person.what_you_liked_prompt.is_not(None), Person.like_comment.is_not(None))))
+
+    index = InvertedIndex()
+    for person_id, prompt, comment in session.exec(statement):
+        prompt = prompt or {}
+        index.add(person_id, [
+            (prompt.get("answer"), ANSWER_WEIGHT),
+            (comment, COMMENT_WEIGHT),
+            (prompt.get("question"), QUESTION_WEIGHT),
+        ])
+
+    return index
+
+
+def search_persons(user_id: str, query: str, page: int, page_size: int,
+                   session: Session) -> Tuple[list[Tuple[Person, float]], int]:
+    """
+    Search the user's persons by the prompt they liked and their like
+    comment, best match first.
+
+    Uses the GIN indexed text search on Postgres, and an in-process inverted
+    index elsewhere.
+
+    :param user_id: The user whose persons to search.
+    :param query: The search, in `websearch_to_tsquery` syntax.
+    :param page: The page of results to return, from 1.
+    :param page_size: How many results a page holds.
+    :param session: The session to use to communicate with the database.
+    :return: The page's persons with their ranks, and the total number of
+        matches.
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        return _search_postgres(user_id, query, page, page_size, session)
+
+    return _search_in_process(user_id, query, page, page_size, session)
+
+
+def _search_postgres(user_id: str, query: str, page: int, page_size: int, session: Session):
+    ts_query = func.websearch_to_tsquery(SEARCH_CONFIG, query)
+    filters = (Person.user_id == user_id, SEARCH_VECTOR.op("@@")(ts_query))
+
+    total = session.exec(select(func.count()).select_from(Person).where(*filters)).one()
+
+    rank = func.ts_rank_cd(SEARCH_VECTOR, ts_query).label("rank")
+    statement = (select(Person, rank)
+                 .where(*filters)
+                 .order_by(desc(rank), Person.id)
+                 .offset((page - 1) * page_size)
+                 .limit(page_size)
+                 .options(selectinload(Person.media)))
+
+    return [(person, person_rank) for person, person_rank in session.exec(statement)], total
+
+
+def _search_in_process(user_id: str, query: str, page: int, page_size: int, session: Session):
+    matches = search_index_cache.get(user_id, session).search(query)
+    page_matches = dict(matches[(page - 1) * page_size:page * page_size])
+    if not page_matches:
+        return [], len(matches)
+
+    statement = (select(Person)
+                 .where(Person.id.in_(page_matches))
+                 .options(selectinload(Person.media)))
+    persons = sorted(session.exec(statement).all(), key=lambda person: (-page_matches[person.id], person.id))
+
+    return [(person, page_matches[person.id]) for person in persons], len(matches)
@@ -0,0 +1,121 @@
+import os
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select, or_
+
+from config import config
+from images.hashing import BAND_COUNT, band_probes, hamming_distance, hash_bands, to_signed, to_unsigned
+from models.models import StoredThumbnail, ThumbnailSource
+
+BAND_COLUMNS = [StoredThumbnail.band_0, StoredThumbnail.band_1, StoredThumbnail.band_2, StoredThumbnail.band_3]
+
+
+def thumbnail_path(thumbnail: StoredThumbnail) -> Path:
+    return Path(config.THUMBNAIL_DIR) / thumbnail.file_name
+
+
+def read_thumbnail(thumbnail: StoredThumbnail) -> Optional[bytes]:
+    try:
+        return thumbnail_path(thumbnail).read_bytes()
+    except FileNotFoundError:
+        return None
+
+
+def find_thumbnail_for_url(url: str, session: Session) -> Optional[StoredThumbnail]:
+    source = session.get(ThumbnailSource, url)
+    if source is None:
+        return None
+
+    return session.get(StoredThumbnail, source.thumbnail_id)
+
+
+def find_near_duplicates(image_hash: int, session: Session,
+                         max_distance: Optional[int] = None) -> list[tuple[int, StoredThumbnail]]:
+    """
+    Stored thumbnails whose images hash within `max_distance` bits of the
+    given hash, nearest first.
+
+    Two hashes within d bits of each other have a band that differs in at
+    most d // BAND_COUNT bits. So it's enough to look up each band, and each
+    value within that many bits of it, on its index, and then check the full
+    distance on the few rows that come back.
+
+    :param image_hash: The perceptual hash to look up.
+    :param session: The session to use to communicate with the database.
+    :param max_distance: The most bits a near-duplicate's hash may differ
+        in. THUMBNAIL_MAX_HASH_DISTANCE by default.
+    :return: Pairs of Hamming distance and stored thumbnail.
+    """
+    if max_distance is None:
+        max_distance = config.THUMBNAIL_MAX_HASH_DISTANCE
+    radius = max_distance // BAND_COUNT
+
+    statement = select(StoredThumbnail).where(or_(*(
+        column.in_(band_probes(band, radius))
+        for column, band in zip(BAND_COLUMNS, hash_bands(image_hash))
+    )))
+
+    duplicates = []
+    for thumbnail in session.exec(statement).all():
+        distance = hamming_distance(image_hash, to_unsigned(thumbnail.phash))
+        if distance <= max_distance:
+            duplicates.append((distance, thumbnail))
+
+    return sorted(duplicates, key=lambda duplicate: duplicate[0])
+
+
+def link_source(url: str, thumbnail: StoredThumbnail, session: Session):
+    """
+    Point the URL at the given thumbnail, replacing any thumbnail it had.
+    """
+    session.merge(ThumbnailSource(url=url, thumbnail_id=thumbnail.id))
+    try:
+        session.commit()
+    except IntegrityError:
+        # Another request for the same URL linked it first
+        session.rollback()
+
+
+def store_thumbnail(url: str, image_hash: int, image_format: str, data: bytes,
+                    session: Session) -> StoredThumbnail:
+    """
+    Write a new thumbnail to THUMBNAIL_DIR and index it by its image's
+    perceptual hash, then point the URL at it.
+
+    :param url: The URL of the image the thumbnail was made from.
+    :param image_hash: The perceptual hash of that image.
+    :param image_format: The PIL format the thumbnail was saved in.
+    :param data: The thumbnail's bytes.
+    :param session: The session to use to communicate with the database.
+    :return: The stored thumbnail.
+    """
+    file_name = f"{image_hash:016x}.{image_format.lower()}"
+    directory = Path(config.THUMBNAIL_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    # Written next to its final name and moved into place, so a reader
+    # never finds half a file
+    descriptor, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(descriptor, "wb") as file:
+        file.write(data)
+    os.replace(temp_path, directory / file_name)
+
+    band_0, band_1, band_2, band_3 = hash_bands(image_hash)
+    thumbnail = StoredThumbnail(phash=to_signed(image_hash),
+                                band_0=band_0,
+                                band_1=band_1,
+                                band_2=band_2,
+                                band_3=band_3,
+                                image_format=image_format,
+                                file_name=file_name,
+                                created_timestamp=datetime.now())
+    session.add(thumbnail)
+    session.commit()
+    session.refresh(thumbnail)
+
+    link_source(url, thumbnail, session)
+    return thumbnail
@@ -0,0 +1,237 @@
+import codecs
+import json
+import mmap
+import os
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator
+
+import orjson
+from fastapi import HTTPException, UploadFile
+from starlette import status
+
+from config import config
+from core.events import EventTable, EventTableBuilder
+
+CHUNK_SIZE = 1024 * 1024
+UPLOAD_SUFFIX = ".upload"
+MATCHES_MEMBER = "matches.json"
+# Whitespace allowed between JSON tokens
+JSON_WHITESPACE = " \t\r\n"
+
+
+def upload_dir() -> Path:
+    path = Path(config.UPLOAD_DIR)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def too_large():
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"Upload exceeds the maximum size of {config.MAX_UPLOAD_SIZE} bytes"
+    )
+
+
+async def spool_upload(file: UploadFile) -> Path:
+    """
+    Copy the uploaded file to a temporary file on disk in fixed-size chunks.
+
+    Only one chunk is held in memory at a time. The caller owns the returned
+    path and must pass it to `remove_upload` once it's done with it.
+
+    :param file: The uploaded file.
+    :return: The path of the spooled file.
+    :raises HTTPException: 413 if the file is larger than `MAX_UPLOAD_SIZE`.
+    """
+    if file.size is not None and file.size > config.MAX_UPLOAD_SIZE:
+        raise too_large()
+
+    fd, path = tempfile.mkstemp(dir=upload_dir(), suffix=UPLOAD_SUFFIX)
+    path = Path(path)
+    written = 0
+
+    try:
+        with os.fdopen(fd, "wb") as spooled:
+            while chunk := await file.read(CHUNK_SIZE):
+                written += len(chunk)
+                if written > config.MAX_UPLOAD_SIZE:
+                    raise too_large()
+                spooled.write(chunk)
+    except BaseException:
+        remove_upload(path)
+        raise
+
+    return path
+
+
+def load_events(path: Path) -> EventTable:
+    """
+    Parse a spooled upload into an EventTable.
+
+    The upload is either the matches.json file itself or the Hinge export ZIP.
+    A plain JSON file is memory-mapped and parsed in place, so the raw JSON is
+    never copied into a bytes object. For a ZIP, only the matches.json member
+    is decompressed, as a stream, and parsed one event at a time. Either way
+    each event is only held as parsed JSON until it's added to the table.
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive, open_matches_member(archive) as member:
+            return EventTableBuilder().extend(iter_json_array(member)).build()
+
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            raise ValueError("Uploaded file is empty")
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            with memoryview(buffer) as view:
+                raw_data = orjson.loads(view)
+
+    if not isinstance(raw_data, list):
+        raise ValueError("Expected a JSON array of Hinge events")
+
+    builder = EventTableBuilder()
+    # Released one by one, so the parsed JSON shrinks as the table grows
+    for index, item in enumerate(raw_data):
+        raw_data[index] = None
+        builder.add(item)
+    return builder.build()
+
+
+def open_matches_member(archive: zipfile.ZipFile) -> BinaryIO:
+    """
+    Open the matches.json member of a Hinge export for streaming reads.
+
+    :raises HTTPException: 422 if the archive has no matches.json, 413 if it
+        would inflate to more than `MAX_UPLOAD_SIZE`.
+    """
+    members = [info for info in archive.infolist()
+               if not info.is_dir() and Path(info.filename).name.lower() == MATCHES_MEMBER]
+    if not members:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"No {MATCHES_MEMBER} found in the uploaded archive"
+        )
+
+    # Prefer the shallowest match, e.g. "matches.json" over "old/matches.json"
+    member = min(members, key=lambda info: info.filename.count("/"))
+    if member.file_size > config.MAX_UPLOAD_SIZE:
+        raise too_large()
+
+    return archive.open(member)
+
+
+def iter_json_array(stream: BinaryIO, chunk_size: int = 64 * 1024) -> Iterator:
+    """
+    Yield the items of a top-level JSON array, reading the stream in chunks.
+
+    Only the current item and one chunk are buffered, so the whole document
+    is never held in memory. Stops with a 413 if the stream inflates past
+    `MAX_UPLOAD_SIZE`.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    position = 0
+    total_read = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, position, total_read, eof
+        chunk = stream.read(chunk_size)
+        total_read += len(chunk)
+        if total_read > config.MAX_UPLOAD_SIZE:
+            raise too_large()
+        eof = not chunk
+        buffer = buffer[position:] + text_decoder.decode(chunk, final=eof)
+        position = 0
+
+    def skip(characters: str):
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in characters:
+                position += 1
+            if position < len(buffer) or eof:
+                return
+            fill()
+
+    def expect_value():
+        skip(JSON_WHITESPACE)
+        if position >= len(buffer):
+            raise ValueError("Unexpected end of JSON array")
+        if buffer[position] in ",]":
+            raise ValueError(f"Unexpected {buffer[position]!r} in JSON array, expected an item")
+
+    def end_array():
+        nonlocal position
+        position += 1
+        skip(JSON_WHITESPACE)
+        if position < len(buffer):
+            raise ValueError("Unexpected data after the JSON array")
+
+    skip(JSON_WHITESPACE)
+    if position >= len(buffer) or buffer[position] != "[":
+        raise ValueError("Expected a JSON array of Hinge events")
+    position += 1
+
+    skip(JSON_WHITESPACE)
+    if position < len(buffer) and buffer[position] == "]":
+        end_array()
+        return
+
+    expect_value()
+    while True:
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+
+        # A value cut off by the chunk boundary can still decode, e.g. "4.5"
+        # out of "4.5e3", so only accept it once a delimiter follows
+        if not eof and (end == len(buffer) or buffer[end] not in JSON_WHITESPACE + ",]"):
+            fill()
+            continue
+
+        position = end
+        yield item
+
+        # Exactly one comma between items, as json.loads and orjson require
+        skip(JSON_WHITESPACE)
+        if position >= len(buffer):
+            raise ValueError("Unexpected end of JSON array")
+        if buffer[position] == "]":
+            end_array()
+            return
+        if buffer[position] != ",":
+            raise ValueError(f"Unexpected {buffer[position]!r} in JSON array, expected ',' or ']'")
+        position += 1
+        expect_value()
+
+
+def remove_upload(path: Path | None):
+    if path is not None:
+        path.unlink(missing_ok=True)
+
+
+def remove_stale_uploads(max_age: float = 24 * 60 * 60, keep: Iterable[Path] = ()):
+    """
+    Remove spooled uploads left behind by a worker that died mid-ingest.
+
+    :param max_age: How old an upload must be to be removed, in seconds.
+    :param keep: Uploads to leave alone, such as ones with an ingest to resume.
+    """
+    cutoff = time.time() - max_age
+    keep = {path.resolve() for path in keep}
+    for path in upload_dir().glob(f"*{UPLOAD_SUFFIX}"):
+        if path.resolve() in keep:
+            continue
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink(missing_ok=True)
+        except FileNotFoundError:
+            continue
@@ -0,0 +1,150 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+from core.events import EventTable, EventField, NO_TIMESTAMP
+
+# Hinge exports only contain the messages you sent, so a reply from the other
+# side shows up as you sending more messages. A match that got at most this
+# many of your messages, and never led to a meeting, is treated as ghosted.
+GHOSTED_MAX_MESSAGES = 2
+
+US_PER_SECOND = 1_000_000
+
+
+@dataclass
+class ChatArrays:
+    """
+    Chat timestamps for every match, flattened into contiguous arrays.
+
+    The chats for match `i` are `chat_timestamps[offsets[i]:offsets[i + 1]]`,
+    sorted ascending. All timestamps are epoch seconds.
+    """
+    match_timestamps: np.ndarray
+    chat_timestamps: np.ndarray
+    offsets: np.ndarray
+    we_met: np.ndarray
+
+
+@dataclass
+class ChatMetrics:
+    """
+    Per-match conversation metrics. Every array has one entry per match and
+    durations are in seconds, with NaN where a metric is undefined.
+    """
+    match_timestamps: np.ndarray
+    message_count: np.ndarray
+    median_reply_gap: np.ndarray
+    p90_reply_gap: np.ndarray
+    time_to_first_message: np.ndarray
+    conversation_length: np.ndarray
+    ghosted: np.ndarray
+
+    def __len__(self):
+        return len(self.match_timestamps)
+
+
+def to_epoch_seconds(timestamps: np.ndarray) -> np.ndarray:
+    """
+    Whole epoch seconds from epoch microseconds.
+    """
+    return (timestamps // US_PER_SECOND).astype(np.float64)
+
+
+def build_chat_arrays(events: EventTable) -> ChatArrays:
+    """
+    Collect the match and chat timestamps of every matched event.
+
+    :param events: The EventTable to read from.
+    :return: The timestamps as flat NumPy arrays.
+    """
+    matches = np.flatnonzero(events.has(EventField.MATCH))
+    starts = events.chat_offsets[matches]
+    counts = events.chat_offsets[matches + 1] - starts
+
+    # The chat rows of every match, back to back
+    segment_ids = np.repeat(np.arange(len(matches)), counts)
+    rows = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+
+    chat_timestamps = events.chat_timestamps[rows]
+    has_timestamp = chat_timestamps != NO_TIMESTAMP
+    segment_ids = segment_ids[has_timestamp]
+    counts = np.bincount(segment_ids, minlength=len(matches))
+
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    chat_seconds = to_epoch_seconds(chat_timestamps[has_timestamp])
+    # Sort within each match so gaps are always measured forwards in time
+    chat_seconds = chat_seconds[np.lexsort((chat_seconds, segment_ids))]
+
+    return ChatArrays(
+        match_timestamps=to_epoch_seconds(events.match_timestamps[matches]),
+        chat_timestamps=chat_seconds,
+        offsets=offsets,
+        we_met=events.has(EventField.MET)[matches]
+    )
+
+
+def _segment_quantile(values: np.ndarray, offsets: np.ndarray, q: float) -> np.ndarray:
+    """
+    Linearly interpolated quantile of each sorted segment of `values`.
+    Empty segments return NaN.
+    """
+    counts = np.diff(offsets)
+    result = np.full(len(counts), np.nan)
+    has_values = counts > 0
+    if not has_values.any():
+        return result
+
+    position = offsets[:-1][has_values] + q * (counts[has_values] - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    result[has_values] = values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+    return result
+
+
+def compute_chat_metrics(chat_arrays: ChatArrays) -> ChatMetrics:
+    """
+    Compute conversation metrics for every match at once.
+
+    No Python level loop runs per match or per message, so this scales to
+    hundreds of thousands of messages.
+
+    :param chat_arrays: The output of `build_chat_arrays`.
+    :return: The metrics for every match.
+    """
+    timestamps = chat_arrays.chat_timestamps
+    offsets = chat_arrays.offsets
+    match_count = len(offsets) - 1
+    message_count = np.diff(offsets)
+    has_messages = message_count > 0
+
+    # Gaps between consecutive messages of the same match
+    segment_ids = np.repeat(np.arange(match_count), message_count)
+    same_match = segment_ids[1:] == segment_ids[:-1]
+    gaps = np.diff(timestamps)[same_match]
+    gap_segments = segment_ids[1:][same_match]
+    gaps = gaps[np.lexsort((gaps, gap_segments))]
+    gap_offsets = np.zeros(match_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(gap_segments, minlength=match_count), out=gap_offsets[1:])
+
+    first_message = np.full(match_count, np.nan)
+    last_message = np.full(match_count, np.nan)
+    first_message[has_messages] = timestamps[offsets[:-1][has_messages]]
+    last_message[has_messages] = timestamps[offsets[1:][has_messages] - 1]
+
+    return ChatMetrics(
+        match_timestamps=chat_arrays.match_timestamps,
+        message_count=message_count,
+        median_reply_gap=_segment_quantile(gaps, gap_offsets, 0.5),
+        p90_reply_gap=_segment_quantile(gaps, gap_offsets, 0.9),
+        time_to_first_message=first_message - chat_arrays.match_timestamps,
+        conversation_length=last_message - first_message,
+        ghosted=(message_count <= GHOSTED_MAX_MESSAGES) & ~chat_arrays.we_met
+    )
+
+
+def get_chat_metrics(events: EventTable) -> ChatMetrics:
+    return compute_chat_metrics(build_chat_arrays(events))